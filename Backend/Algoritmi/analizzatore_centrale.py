@@ -23,7 +23,6 @@
             per trovare gli edifici che soddisfano tutte le condizioni.
         
         MANCA:
-            - proiezione dei risultati in una heatmap.
             - calcolo della media per edificio di soddisfazione della regola, e poi media delle medie per avere le proiezioni a colori sul piano generale;
 """
 
@@ -32,9 +31,10 @@ import pandas as pd
 import logging
 
 #importa le funzioni dagli script singoli
-from .regola3 import run_rule_3
-from .regola30 import run_rule_30
+from .regola3 import run_rule_3, METODO_LINEE
+from .regola30 import run_rule_30, METODO_VETTORIALE
 from .regola300 import run_rule_300
+from .cache_visibilita import cache_visibilita
 
 # costanti conformità algoritmo
 VISIBLE_TREES = 3
@@ -43,8 +43,17 @@ MIN_DISTANCE_GREEN_AREA = 300
 
 """
     Funzione principale che esegue l'analisi completa 3-30-300.
+    @param metodo_regola3: metodo di calcolo della visibilità per la regola 3 (METODO_LINEE o METODO_ISOVISTA di regola3)
+    @param metodo_regola30: metodo di calcolo dell'area arborea per la regola 30 (METODO_VETTORIALE o METODO_RASTER di regola30)
+    @param solo_conformita: modalità "solo conformità" per le mappe di conformità su larga scala. Serve solo is_conforme, quindi:
+        - la regola 3 smette di testare alberi appena un edificio ne vede VISIBLE_TREES (conteggi e id troncati a VISIBLE_TREES);
+        - la regola 300 non raccoglie gli id delle aree verdi e non ricostruisce i percorsi pedonali.
+    @param edifici_percorso: id degli edifici di cui ricostruire il percorso pedonale (None = tutti); gli altri hanno solo la distanza
+    @param campo_verde: campo precalcolato delle distanze dalle aree verdi della città (da graphs_manager), o None
+    @param traccia: TracciaLineeVista opzionale (regola3) in cui registrare le linee di vista della regola 3; il salvataggio spetta al chiamante
 """
-def run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo):
+def run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo, metodo_regola3=METODO_LINEE, solo_conformita=False,
+                      edifici_percorso=None, campo_verde=None, traccia=None, metodo_regola30=METODO_VETTORIALE):
 
     # file di debug output e errori non bloccanti da ritornare al main + inizializzazione logger
     errori_rilevati = []
@@ -59,7 +68,8 @@ def run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo
     #esegue gli algoritmi per ogni regola e ottieni i risultati
     logger.info("--- Esecuzione Regola 3 (Linea di Vista) ---")
     try:
-        risultati_3 = run_rule_3(edifici, alberi)
+        limite_3 = VISIBLE_TREES if solo_conformita else None
+        risultati_3 = run_rule_3(edifici, alberi, cache=cache_visibilita, metodo=metodo_regola3, limite=limite_3, traccia=traccia)
         num_soddisfatti_3 = (risultati_3['visible_trees_count'] >= VISIBLE_TREES).sum()
         logger.info(f"RISULTATO REGOLA 3: {num_soddisfatti_3} edifici soddisfano la regola (su {len(edifici)}).")
     except Exception as e:
@@ -71,7 +81,7 @@ def run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo
 
     logger.info("--- Esecuzione Regola 30 (Copertura Arborea) ---")
     try:
-        percentage_30 = run_rule_30(edifici, alberi, polygon_gdf)
+        percentage_30 = run_rule_30(edifici, alberi, polygon_gdf, metodo=metodo_regola30)
         logger.info(f"RISULTATO REGOLA 30: La copertura arborea è del {percentage_30:.2f}%.")
         if percentage_30 > COVERAGE_PERCENTAGE:
             logger.info("La regola del 30% è soddisfatta a livello di zona.")
@@ -84,7 +94,8 @@ def run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo
 
     logger.info("--- Esecuzione Regola 300 (Area Verde Vicina) ---")
     try:
-        risultati_300 = run_rule_300(edifici, aree_verdi, city_name, grafo)
+        risultati_300 = run_rule_300(edifici, aree_verdi, city_name, grafo, solo_conformita=solo_conformita,
+                                      edifici_percorso=edifici_percorso, campo_verde=campo_verde)
         num_soddisfatti_300 = (risultati_300['score_300'] >= 1).sum()
         logger.info(f"RISULTATO REGOLA 300: {num_soddisfatti_300} edifici soddisfano la regola (su {len(edifici)}).")
     except Exception as e:
@@ -133,6 +144,7 @@ def run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo
     edifici_finali['score_300'] = 0
     edifici_finali['green_areas_id'] = pd.Series([[] for _ in range(len(edifici_finali))], index=edifici_finali.index)
     edifici_finali['distanza_pedonale'] = -1
+    edifici_finali['distanza_linea_aria'] = -1
     edifici_finali['percorso_pedonale'] = None
     if 'score_300' in risultati_300.columns:
         edifici_finali['score_300'] = risultati_300['score_300']
@@ -143,6 +155,9 @@ def run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo
     if 'distanza_pedonale' in risultati_300.columns:
         edifici_finali['distanza_pedonale'] = risultati_300['distanza_pedonale']
 
+    if 'distanza_linea_aria' in risultati_300.columns:
+        edifici_finali['distanza_linea_aria'] = risultati_300['distanza_linea_aria']
+
     if 'percorso_pedonale' in risultati_300.columns:
         edifici_finali['percorso_pedonale'] = risultati_300['percorso_pedonale']
 
@@ -0,0 +1,263 @@
+# Copyright 2026 [Martin Pedron Giuseppe]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Cache persistente della visibilità edificio-albero per la regola 3.
+        Gli utenti ridisegnano spesso poligoni sovrapposti sugli stessi quartieri, e la regola 3 ricalcolerebbe ogni volta
+        la linea di vista per le stesse coppie edificio/albero. La cache salva in un database SQLite sotto Data l'esito
+        di ogni coppia (id edificio, id albero), insieme a una firma delle geometrie coinvolte:
+            - la geometria dell'edificio;
+            - la geometria dell'albero;
+            - le geometrie degli altri edifici nel "corridoio" di vista (il rettangolo che racchiude edificio e albero,
+                che contiene tutte le possibili linee di vista tra i due).
+        Se una di queste geometrie cambia (nuova versione OSM dell'elemento, nuovo edificio in mezzo) la firma cambia
+        e la coppia viene ricalcolata.
+
+        NOTE:
+            1- la dimensione è limitata a max_voci righe: oltre la soglia vengono eliminate le voci usate meno di recente (LRU);
+            2- SQLite gestisce da solo l'accesso concorrente dei worker gunicorn (processi diversi) con il journal WAL;
+                all'interno dello stesso processo l'accesso è serializzato da un lock;
+            3- i contatori di hit/miss/evizioni sono per processo.
+"""
+
+#importazioni
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+import numpy as np
+import shapely
+
+#logger globale
+logger = logging.getLogger("cache_visibilita")
+
+#percorso relativo del database e numero massimo di coppie salvate
+PERCORSO_CACHE = "./Data/cache_visibilita.sqlite"
+MAX_VOCI = 2_000_000
+
+#frazione di max_voci a cui riportare la cache quando viene superata la soglia (evita di evincere a ogni scrittura)
+FRAZIONE_DOPO_EVIZIONE = 0.9
+
+#precisione (in metri) delle coordinate usate per la firma delle geometrie
+PRECISIONE_FIRMA = 0.001
+
+class CacheVisibilita:
+
+    def __init__(self, percorso=PERCORSO_CACHE, max_voci=MAX_VOCI):
+        self.percorso = percorso
+        self.max_voci = max_voci
+        self.hit = 0
+        self.miss = 0
+        self.evizioni = 0
+        self._lock = threading.Lock()
+        self._connessione = None
+        self._pid = None
+
+    """
+    Apre (una volta per processo) la connessione al database e crea la tabella se non esiste.
+    Il controllo sul pid evita di riusare dopo un fork una connessione aperta dal processo padre.
+    """
+    def _connetti(self):
+        if self._connessione is not None and self._pid == os.getpid():
+            return self._connessione
+
+        connessione = sqlite3.connect(self.percorso, timeout=30, check_same_thread=False)
+        connessione.execute("PRAGMA journal_mode=WAL")
+        connessione.execute("PRAGMA synchronous=NORMAL")
+        connessione.execute("""
+            CREATE TABLE IF NOT EXISTS visibilita (
+                edificio_id TEXT NOT NULL,
+                albero_id TEXT NOT NULL,
+                firma INTEGER NOT NULL,
+                visibile INTEGER NOT NULL,
+                ultimo_accesso INTEGER NOT NULL,
+                PRIMARY KEY (edificio_id, albero_id)
+            )
+        """)
+        connessione.execute("CREATE INDEX IF NOT EXISTS idx_visibilita_accesso ON visibilita (ultimo_accesso)")
+        connessione.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS richiesta (
+                pos INTEGER PRIMARY KEY,
+                edificio_id TEXT,
+                albero_id TEXT,
+                firma INTEGER
+            )
+        """)
+        connessione.commit()
+
+        self._connessione = connessione
+        self._pid = os.getpid()
+        return connessione
+
+    """
+    Cerca in cache l'esito delle coppie richieste.
+    Una coppia è nota solo se esiste la voce (id edificio, id albero) con la stessa firma delle geometrie.
+    @return: (noti, esiti), due array booleani allineati alle coppie; esiti è significativo solo dove noti è True.
+    """
+    def leggi(self, id_edifici, id_alberi, firme):
+        n = len(firme)
+        noti = np.zeros(n, dtype=bool)
+        esiti = np.zeros(n, dtype=bool)
+        if n == 0:
+            return noti, esiti
+
+        with self._lock:
+            connessione = self._connetti()
+            connessione.execute("DELETE FROM richiesta")
+            connessione.executemany(
+                "INSERT INTO richiesta VALUES (?, ?, ?, ?)",
+                zip(range(n), id_edifici.tolist(), id_alberi.tolist(), firme.tolist())
+            )
+            righe = connessione.execute("""
+                SELECT r.pos, v.visibile, v.edificio_id, v.albero_id FROM richiesta r
+                JOIN visibilita v ON v.edificio_id = r.edificio_id AND v.albero_id = r.albero_id
+                WHERE v.firma = r.firma
+            """).fetchall()
+
+            #aggiorno l'ultimo accesso delle voci trovate, per l'evizione LRU
+            if righe:
+                adesso = time.time_ns()
+                connessione.executemany(
+                    "UPDATE visibilita SET ultimo_accesso = ? WHERE edificio_id = ? AND albero_id = ?",
+                    ((adesso, riga[2], riga[3]) for riga in righe)
+                )
+            connessione.commit()
+
+            if righe:
+                posizioni = np.array([riga[0] for riga in righe], dtype=np.int64)
+                valori = np.array([riga[1] for riga in righe], dtype=bool)
+                noti[posizioni] = True
+                esiti[posizioni] = valori
+
+            self.hit += int(noti.sum())
+            self.miss += int(n - noti.sum())
+
+        return noti, esiti
+
+    """
+    Salva (o sovrascrive) l'esito delle coppie appena calcolate, poi applica l'evizione se la cache supera max_voci.
+    """
+    def scrivi(self, id_edifici, id_alberi, firme, esiti):
+        if len(firme) == 0:
+            return
+
+        with self._lock:
+            connessione = self._connetti()
+            adesso = time.time_ns()
+            connessione.executemany(
+                "INSERT OR REPLACE INTO visibilita VALUES (?, ?, ?, ?, ?)",
+                zip(id_edifici.tolist(), id_alberi.tolist(), firme.tolist(), esiti.astype(int).tolist(), [adesso] * len(firme))
+            )
+
+            #evizione delle voci usate meno di recente
+            voci = connessione.execute("SELECT COUNT(*) FROM visibilita").fetchone()[0]
+            if voci > self.max_voci:
+                da_eliminare = voci - int(self.max_voci * FRAZIONE_DOPO_EVIZIONE)
+                connessione.execute("""
+                    DELETE FROM visibilita WHERE rowid IN (
+                        SELECT rowid FROM visibilita ORDER BY ultimo_accesso LIMIT ?
+                    )
+                """, (da_eliminare,))
+                self.evizioni += da_eliminare
+                logger.info(f"Cache di visibilità: eliminate {da_eliminare} voci meno recenti.")
+            connessione.commit()
+
+    """
+    Statistiche della cache per il processo corrente (hit, miss, hit rate, evizioni) e numero di voci salvate.
+    """
+    def statistiche(self):
+        with self._lock:
+            voci = self._connetti().execute("SELECT COUNT(*) FROM visibilita").fetchone()[0]
+        totale = self.hit + self.miss
+        return {
+            'hit': self.hit,
+            'miss': self.miss,
+            'hit_rate': self.hit / totale if totale else 0.0,
+            'evizioni': self.evizioni,
+            'voci': voci
+        }
+
+"""
+    Calcola la firma (intero a 64 bit) delle geometrie coinvolte in ogni coppia edificio-albero:
+    edificio, albero e altri edifici che intersecano il corridoio di vista (rettangolo che racchiude edificio e albero).
+    La combinazione degli ostacoli è una somma di hash mescolati, quindi non dipende dall'ordine in cui vengono trovati.
+    @return: array int64 allineato alle coppie, pronto per essere salvato in SQLite.
+"""
+def calcola_firme(edifici_proj, alberi_proj, coppie_edificio, coppie_albero):
+
+    geom_edifici = np.asarray(edifici_proj.geometry.values)
+    geom_alberi = np.asarray(alberi_proj.geometry.values)
+    etichette = edifici_proj.index.to_numpy()
+    n = len(coppie_edificio)
+
+    hash_edifici = _hash_geometrie(geom_edifici)
+    hash_alberi = _hash_geometrie(geom_alberi)
+
+    #corridoio di vista di ogni coppia e ostacoli che lo intersecano (escluso l'edificio di partenza)
+    bounds_edifici = shapely.bounds(geom_edifici[coppie_edificio])
+    bounds_alberi = shapely.bounds(geom_alberi[coppie_albero])
+    corridoi = shapely.box(
+        np.minimum(bounds_edifici[:, 0], bounds_alberi[:, 0]),
+        np.minimum(bounds_edifici[:, 1], bounds_alberi[:, 1]),
+        np.maximum(bounds_edifici[:, 2], bounds_alberi[:, 2]),
+        np.maximum(bounds_edifici[:, 3], bounds_alberi[:, 3])
+    )
+    coppia, ostacolo = edifici_proj.sindex.query(corridoi)
+    altri = etichette[ostacolo] != etichette[coppie_edificio[coppia]]
+    coppia = coppia[altri]
+    ostacolo = ostacolo[altri]
+
+    with np.errstate(over='ignore'):
+        somma_ostacoli = np.zeros(n, dtype=np.uint64)
+        np.add.at(somma_ostacoli, coppia, _mescola(hash_edifici[ostacolo]))
+        numero_ostacoli = np.bincount(coppia, minlength=n).astype(np.uint64)
+
+        firma = (
+            _mescola(hash_edifici[coppie_edificio])
+            ^ _mescola(hash_alberi[coppie_albero] + np.uint64(1))
+            ^ _mescola(somma_ostacoli + numero_ostacoli)
+        )
+
+    return firma.view(np.int64)
+
+"""
+    Hash a 64 bit di ogni geometria, calcolato sul tipo e sulle coordinate arrotondate a PRECISIONE_FIRMA
+    (così piccole differenze numeriche della proiezione non invalidano la cache).
+"""
+def _hash_geometrie(geometrie):
+    coordinate, indice = shapely.get_coordinates(geometrie, return_index=True)
+    coordinate = np.round(coordinate / PRECISIONE_FIRMA).astype(np.int64)
+    confini = np.searchsorted(indice, np.arange(len(geometrie) + 1))
+    tipi = shapely.get_type_id(geometrie).astype(np.int8)
+
+    hash_geometrie = np.empty(len(geometrie), dtype=np.uint64)
+    for i in range(len(geometrie)):
+        digest = hashlib.blake2b(tipi[i].tobytes() + coordinate[confini[i]:confini[i + 1]].tobytes(), digest_size=8).digest()
+        hash_geometrie[i] = int.from_bytes(digest, 'little')
+    return hash_geometrie
+
+"""
+    Funzione di mescolamento splitmix64 su array uint64 (l'overflow è voluto).
+"""
+def _mescola(valori):
+    with np.errstate(over='ignore'):
+        x = valori + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+#istanza globale, condivisa dalle richieste dello stesso processo (la connessione viene aperta al primo uso)
+cache_visibilita = CacheVisibilita()
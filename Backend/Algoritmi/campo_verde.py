@@ -0,0 +1,381 @@
+# Copyright 2026 [Martin Pedron Giuseppe]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Campo precalcolato "distanza dall'area verde più vicina" sui nodi del grafo pedonale di una città (regola 300).
+        Per le città con grafo, ogni richiesta eseguiva Dijkstra multi-sorgente dai nodi di accesso delle aree verdi, anche se
+        grafo e parchi cambiano raramente. Il campo salva per ogni nodo del grafo:
+            - la distanza pedonale dall'area verde più vicina (inf se irraggiungibile);
+            - il predecessore sul percorso minimo verso quell'area (-1 per i nodi di accesso e gli irraggiungibili);
+            - il nodo di accesso da cui parte il percorso (origine), che serve all'aggiornamento incrementale.
+        Il campo è generato offline da generatoreCampiVerdi.py (accanto a generatoreGrafi.py) e salvato in un file .npz
+        accanto al GraphML della città; a ogni richiesta a un edificio basta il nodo più vicino e una lettura dell'array.
+        Lo stesso file fa da registro delle aree verdi qualificate della città: per ognuna salva id, id OSM dei membri del cluster,
+        geometria (nel CRS del grafo) e nodi di accesso, così a ogni richiesta le aree verdi della zona vengono riconosciute con una
+        ricerca spaziale (abbina) invece di ricampionarne il perimetro.
+
+        NOTE:
+            1- i nodi sono salvati nello stesso ordine del grafo: se il grafo cambia (nodi diversi o in ordine diverso)
+                il campo non è più valido e viene rigenerato da zero;
+            2- per ogni area verde sono salvati una firma della geometria e i suoi nodi di accesso. Quando le aree cambiano,
+                solo le aree nuove vengono rimappate sul grafo, e solo i nodi la cui origine non è più un accesso vengono ricalcolati
+                (insieme a quelli che una nuova area rende più vicini);
+            3- la distanza non ha cutoff: il cutoff della regola (cutoff_dist di graphs_calculator) è applicato in lettura;
+            4- il campo riflette le aree verdi al momento della generazione: se una richiesta contiene aree verdi non presenti nel registro
+                (nuove, o fuori dai confini della città), graphs_calculator torna a Dijkstra per richiesta, usando comunque i nodi di accesso
+                salvati per le aree riconosciute. Lo stesso avviene se per qualche edificio l'area più vicina del campo (origini) non è
+                tra quelle della richiesta, così il risultato non dipende dalla presenza del file.
+"""
+
+#importazioni
+import os
+import heapq
+import hashlib
+import logging
+import numpy as np
+import shapely
+
+from .graphs_calculator import nodi_accesso_aree_verdi
+from .grafo_csr import grafo_csr
+
+#logger globale
+logger = logging.getLogger("campo_verde")
+
+#suffisso del file del campo accanto al GraphML della città (es. Verona_campo_verde.npz)
+SUFFISSO_CAMPO = "_campo_verde.npz"
+
+#versione del formato del file: se cambia, i file vecchi vengono ignorati e rigenerati
+VERSIONE_CAMPO = 2
+
+#precisione (in gradi) delle coordinate usate per la firma delle aree verdi
+PRECISIONE_FIRMA = 1e-7
+
+class CampoVerde:
+
+    """
+    @param nodi: id dei nodi del grafo, nell'ordine del grafo
+    @param distanza, predecessore, origine: array allineati a nodi (predecessore e origine sono posizioni in nodi, -1 se assenti)
+    @param aree_firma, aree_id: firma della geometria e id delle aree verdi usate
+    @param accessi_indptr, accessi_nodi: nodi di accesso (posizioni in nodi) di ogni area, accessi_nodi[accessi_indptr[i]:accessi_indptr[i+1]]
+    @param aree_membri: lista degli id OSM dei membri di ogni area (cluster di consolida_aree_verdi)
+    @param aree_geometrie: geometrie shapely delle aree nel CRS del grafo
+    """
+    def __init__(self, nodi, distanza, predecessore, origine, aree_firma, aree_id, accessi_indptr, accessi_nodi, aree_membri, aree_geometrie):
+        self.nodi = np.asarray(nodi, dtype=np.int64)
+        self.distanza = np.asarray(distanza, dtype=float)
+        self.predecessore = np.asarray(predecessore, dtype=np.int64)
+        self.origine = np.asarray(origine, dtype=np.int64)
+        self.aree_firma = np.asarray(aree_firma, dtype=str)
+        self.aree_id = np.asarray(aree_id, dtype=str)
+        self.accessi_indptr = np.asarray(accessi_indptr, dtype=np.int64)
+        self.accessi_nodi = np.asarray(accessi_nodi, dtype=np.int64)
+        self.aree_membri = [list(membri) for membri in aree_membri]
+        self.aree_geometrie = np.asarray(aree_geometrie, dtype=object)
+        self._albero_aree = None
+
+        #indice di ricerca id nodo -> posizione
+        self._ordine = np.argsort(self.nodi, kind="stable")
+        self._nodi_ordinati = self.nodi[self._ordine]
+
+    """
+    Stima dei byte occupati dal campo: array per nodo, registro delle aree e relative geometrie (16 byte per coordinata).
+    """
+    def memoria(self):
+        array = (self.nodi, self.distanza, self.predecessore, self.origine, self.aree_firma, self.aree_id,
+                 self.accessi_indptr, self.accessi_nodi, self._ordine, self._nodi_ordinati)
+        byte = sum(a.nbytes for a in array)
+        byte += 16 * int(shapely.get_num_coordinates(self.aree_geometrie).sum()) if len(self.aree_geometrie) else 0
+        byte += sum(len(membri) for membri in self.aree_membri) * 64
+        return int(byte)
+
+    """
+    Verifica che il campo sia stato calcolato sullo stesso grafo (stessi nodi nello stesso ordine).
+    """
+    def compatibile(self, grafo):
+        return np.array_equal(grafo_csr(grafo).nodi, self.nodi)
+
+    """
+    Posizioni dei nodi richiesti nel campo (-1 per i nodi sconosciuti).
+    """
+    def indici(self, nodi):
+        nodi = np.asarray(nodi, dtype=np.int64)
+        posizioni = np.searchsorted(self._nodi_ordinati, nodi)
+        posizioni = np.minimum(posizioni, len(self._nodi_ordinati) - 1)
+        trovati = self._nodi_ordinati[posizioni] == nodi
+        return np.where(trovati, self._ordine[posizioni], -1)
+
+    """
+    Distanza pedonale dei nodi richiesti dall'area verde più vicina.
+    @param cutoff: distanza massima; oltre, o per i nodi irraggiungibili o sconosciuti, il risultato è mancante
+    @return: array di float allineato ai nodi
+    """
+    def distanze(self, nodi, cutoff=None, mancante=-1):
+        posizioni = self.indici(nodi)
+        risultato = np.full(len(posizioni), float(mancante))
+        noti = posizioni >= 0
+        valori = self.distanza[posizioni[noti]]
+        if cutoff is not None:
+            valori = np.where(valori <= cutoff, valori, np.inf)
+        risultato[noti] = np.where(np.isfinite(valori), valori, float(mancante))
+        return risultato
+
+    """
+    Nodo di accesso da cui parte il percorso minimo di ogni nodo richiesto (l'area verde più vicina secondo il campo).
+    @return: array di id allineato ai nodi, -1 per i nodi sconosciuti o irraggiungibili
+    """
+    def origini(self, nodi):
+        posizioni = self.indici(nodi)
+        origine = np.where(posizioni >= 0, self.origine[np.maximum(posizioni, 0)], -1)
+        return np.where(origine >= 0, self.nodi[np.maximum(origine, 0)], -1)
+
+    """
+    Percorso minimo verso l'area verde più vicina ricostruito dai predecessori.
+    @return: lista di id dei nodi [accesso, ..., nodo] (stesso verso di nx.multi_source_dijkstra), o None se irraggiungibile o oltre il cutoff
+    """
+    def percorso(self, nodo, cutoff=None):
+        posizione = int(self.indici([nodo])[0])
+        if posizione < 0 or not np.isfinite(self.distanza[posizione]):
+            return None
+        if cutoff is not None and self.distanza[posizione] > cutoff:
+            return None
+
+        catena = []
+        while posizione >= 0:
+            catena.append(posizione)
+            posizione = self.predecessore[posizione]
+        return self.nodi[catena[::-1]].tolist()
+
+    """
+    Id dei nodi di accesso dell'area verde in posizione i del registro.
+    """
+    def accessi(self, i):
+        return self.nodi[self.accessi_nodi[self.accessi_indptr[i]:self.accessi_indptr[i + 1]]]
+
+    """
+    Riconosce le aree verdi di una richiesta tra quelle del registro, con una ricerca spaziale sulle geometrie salvate.
+    Un'area della richiesta corrisponde a un'area del registro se le due si intersecano e tutti i suoi membri OSM sono membri
+    dell'area del registro (la query della richiesta può vedere solo una parte di un cluster, mai un cluster più grande).
+    Senza colonna 'membri' i membri sono l'id dell'area (o l'etichetta dell'indice).
+    @param verdi_proj: GDF delle aree verdi della richiesta nel CRS del grafo
+    @return: array con la posizione nel registro di ogni area della richiesta, -1 se non riconosciuta
+    """
+    def abbina(self, verdi_proj):
+        abbinate = np.full(len(verdi_proj), -1, dtype=np.int64)
+        if len(verdi_proj) == 0 or len(self.aree_geometrie) == 0:
+            return abbinate
+
+        if self._albero_aree is None:
+            self._albero_aree = shapely.STRtree(self.aree_geometrie)
+        richiesta, registro = self._albero_aree.query(np.asarray(verdi_proj.geometry.values), predicate="intersects")
+
+        membri_richiesta = _membri_aree(verdi_proj)
+        for i, j in zip(richiesta.tolist(), registro.tolist()):
+            if abbinate[i] < 0 and membri_richiesta[i] <= set(self.aree_membri[j]):
+                abbinate[i] = j
+        return abbinate
+
+    """
+    Salva il campo in un file .npz. La scrittura passa da un file temporaneo rinominato alla fine,
+    così il server non legge mai un file scritto a metà.
+    """
+    def salva(self, percorso):
+        #geometrie come WKB concatenati con i loro offset (niente pickle nel file)
+        wkb = shapely.to_wkb(self.aree_geometrie).tolist() if len(self.aree_geometrie) else []
+        temporaneo = f"{percorso}.tmp"
+        with open(temporaneo, "wb") as file:
+            np.savez_compressed(
+                file,
+                versione=np.int64(VERSIONE_CAMPO),
+                nodi=self.nodi,
+                distanza=self.distanza,
+                predecessore=self.predecessore.astype(np.int32),
+                origine=self.origine.astype(np.int32),
+                aree_firma=self.aree_firma,
+                aree_id=self.aree_id,
+                accessi_indptr=self.accessi_indptr,
+                accessi_nodi=self.accessi_nodi.astype(np.int32),
+                membri_indptr=np.concatenate(([0], np.cumsum([len(m) for m in self.aree_membri]))).astype(np.int64),
+                membri=np.array([str(m) for membri in self.aree_membri for m in membri], dtype=str),
+                wkb_indptr=np.concatenate(([0], np.cumsum([len(w) for w in wkb]))).astype(np.int64),
+                wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8),
+            )
+        os.replace(temporaneo, percorso)
+
+    """
+    Carica il campo da file.
+    @return: il campo, o None se il file non esiste o ha una versione diversa
+    """
+    @classmethod
+    def carica(cls, percorso):
+        if not os.path.exists(percorso):
+            return None
+        with np.load(percorso, allow_pickle=False) as dati:
+            if int(dati['versione']) != VERSIONE_CAMPO:
+                logger.warning(f"Campo {percorso} con versione diversa da {VERSIONE_CAMPO}: ignorato.")
+                return None
+            membri, membri_indptr = dati['membri'].tolist(), dati['membri_indptr']
+            wkb, wkb_indptr = dati['wkb'].tobytes(), dati['wkb_indptr']
+            aree_membri = [membri[inizio:fine] for inizio, fine in zip(membri_indptr[:-1], membri_indptr[1:])]
+            geometrie = shapely.from_wkb([wkb[inizio:fine] for inizio, fine in zip(wkb_indptr[:-1], wkb_indptr[1:])])
+            array = {nome: dati[nome] for nome in ('nodi', 'distanza', 'predecessore', 'origine', 'aree_firma', 'aree_id',
+                                                   'accessi_indptr', 'accessi_nodi')}
+        #il campo caricato non viene mai modificato (costruisci_campo_verde lavora su copie): in sola lettura resta condiviso
+        #copy-on-write tra i worker del server quando è precaricato nel master (vedi graphsManager.precarica)
+        for valori in array.values():
+            valori.setflags(write=False)
+        return cls(array['nodi'], array['distanza'], array['predecessore'], array['origine'], array['aree_firma'],
+                   array['aree_id'], array['accessi_indptr'], array['accessi_nodi'], aree_membri, geometrie)
+
+"""
+Percorso del file del campo di una città, accanto al suo GraphML (stesso nome sicuro usato da generatoreGrafi e graphsManager).
+"""
+def percorso_campo_verde(cartella, city_name):
+    safe_name = city_name.replace(" ", "_").replace(",", "")
+    return os.path.join(cartella, f"{safe_name}{SUFFISSO_CAMPO}")
+
+"""
+Firma di ogni area verde: hash del WKB della geometria in EPSG:4326 con coordinate arrotondate a PRECISIONE_FIRMA.
+Due versioni della stessa area con la stessa geometria hanno la stessa firma, qualunque sia l'id.
+"""
+def firma_aree_verdi(aree_verdi):
+    geometrie = np.asarray(aree_verdi.to_crs("EPSG:4326").geometry.values)
+    wkb = shapely.to_wkb(shapely.set_precision(geometrie, PRECISIONE_FIRMA))
+    return np.array([hashlib.blake2b(w, digest_size=8).hexdigest() for w in wkb], dtype=str)
+
+"""
+Costruisce (o aggiorna) il campo delle distanze dalle aree verdi sul grafo.
+Senza campo precedente, o se quello precedente è di un altro grafo, il calcolo è completo: Dijkstra multi-sorgente da tutti i nodi di accesso.
+Altrimenti l'aggiornamento è incrementale:
+    1. le aree con la stessa firma riusano i nodi di accesso salvati, solo le aree nuove vengono mappate sul grafo;
+    2. i nodi la cui origine non è più un nodo di accesso (area rimossa o modificata) perdono la distanza; il loro percorso minimo
+        passava solo per nodi con la stessa origine, quindi tutti gli altri nodi restano validi;
+    3. Dijkstra riparte dagli archi che entrano nella zona invalidata da nodi ancora validi e dai nuovi nodi di accesso,
+        e aggiorna solo i nodi che trovano una distanza minore.
+@param grafo: grafo della città in metri (come quello di graphs_manager)
+@param aree_verdi: GDF delle aree verdi qualificate (già consolidate e filtrate per area)
+@param precedente: campo già salvato per la città, o None
+@return: il nuovo campo
+"""
+def costruisci_campo_verde(grafo, aree_verdi, precedente=None):
+    csr = grafo_csr(grafo)
+    nodi = csr.nodi
+    n = len(nodi)
+
+    if precedente is not None and not np.array_equal(precedente.nodi, nodi):
+        logger.info("Il grafo è cambiato rispetto al campo salvato: ricalcolo completo.")
+        precedente = None
+
+    #nodi di accesso di ogni area: riuso quelli delle aree invariate, mappo sul grafo solo le altre
+    firme = firma_aree_verdi(aree_verdi) if not aree_verdi.empty else np.empty(0, dtype=str)
+    accessi = [None] * len(aree_verdi)
+    if precedente is not None:
+        salvati = {firma: precedente.accessi_nodi[inizio:fine]
+                   for firma, inizio, fine in zip(precedente.aree_firma, precedente.accessi_indptr[:-1], precedente.accessi_indptr[1:])}
+        for i, firma in enumerate(firme):
+            accessi[i] = salvati.get(firma)
+    da_mappare = [i for i, a in enumerate(accessi) if a is None]
+    if da_mappare:
+        verdi_proj = aree_verdi.iloc[da_mappare].to_crs(grafo.graph['crs'])
+        for i, nodi_area in zip(da_mappare, nodi_accesso_aree_verdi(verdi_proj, grafo)):
+            accessi[i] = csr.indici(nodi_area)
+    logger.info(f"Aree verdi: {len(aree_verdi)}, di cui {len(da_mappare)} mappate sul grafo e {len(aree_verdi) - len(da_mappare)} riusate.")
+
+    lunghezze = np.array([len(a) for a in accessi], dtype=np.int64)
+    accessi_indptr = np.concatenate(([0], np.cumsum(lunghezze)))
+    accessi_nodi = np.concatenate(accessi) if accessi else np.empty(0, dtype=np.int64)
+    sorgenti = np.unique(accessi_nodi)
+
+    #archi del grafo come array di posizioni, dalla versione CSR (degli archi paralleli resta il più corto)
+    da = np.repeat(np.arange(n), np.diff(csr.indptr))
+    a = csr.indices.astype(np.int64)
+    peso = csr.lunghezza
+
+    if precedente is None:
+        distanza = np.full(n, np.inf)
+        predecessore = np.full(n, -1, dtype=np.int64)
+        origine = np.full(n, -1, dtype=np.int64)
+        semi = [(0.0, s, -1, s) for s in sorgenti.tolist()]
+    else:
+        distanza = precedente.distanza.copy()
+        predecessore = precedente.predecessore.copy()
+        origine = precedente.origine.copy()
+        sorgenti_precedenti = np.unique(precedente.accessi_nodi)
+
+        #invalido i nodi raggiunti da accessi che non esistono più
+        invalidati = np.isin(origine, np.setdiff1d(sorgenti_precedenti, sorgenti)) & (origine >= 0)
+        distanza[invalidati] = np.inf
+        predecessore[invalidati] = -1
+        origine[invalidati] = -1
+
+        #semi: archi dai nodi validi verso la zona invalidata, più i nuovi accessi
+        bordo = invalidati[a] & ~invalidati[da] & np.isfinite(distanza[da])
+        semi = list(zip((distanza[da[bordo]] + peso[bordo]).tolist(), a[bordo].tolist(), da[bordo].tolist(), origine[da[bordo]].tolist()))
+        semi += [(0.0, s, -1, s) for s in np.setdiff1d(sorgenti, sorgenti_precedenti).tolist()]
+        logger.info(f"Aggiornamento incrementale: {int(invalidati.sum())} nodi invalidati, {len(semi)} semi.")
+
+    #Dijkstra "seminato" sulla lista di adiacenza CSR (csgraph non accetta distanze iniziali diverse da 0)
+    aggiornati = _dijkstra(csr.indptr.tolist(), a.tolist(), peso.tolist(), distanza, predecessore, origine, semi)
+    logger.info(f"Campo verde calcolato: {aggiornati} nodi aggiornati su {n}, {int(np.isfinite(distanza).sum())} raggiungibili.")
+
+    aree_id = aree_verdi['id'].astype(str).to_numpy() if 'id' in aree_verdi.columns else aree_verdi.index.astype(str).to_numpy()
+    aree_membri = [sorted(membri) for membri in _membri_aree(aree_verdi)]
+    geometrie = np.asarray(aree_verdi.to_crs(grafo.graph['crs']).geometry.values) if not aree_verdi.empty else np.empty(0, dtype=object)
+    return CampoVerde(nodi, distanza, predecessore, origine, firme, aree_id, accessi_indptr, accessi_nodi, aree_membri, geometrie)
+
+"""
+Insieme degli id OSM dei membri di ogni area verde: la colonna 'membri' di consolida_aree_verdi se presente,
+altrimenti l'id dell'area (o l'etichetta dell'indice).
+"""
+def _membri_aree(aree_verdi):
+    if 'membri' in aree_verdi.columns:
+        return [{str(m) for m in membri} for membri in aree_verdi['membri']]
+    ids = aree_verdi['id'] if 'id' in aree_verdi.columns else aree_verdi.index
+    return [{str(i)} for i in ids]
+
+"""
+Dijkstra multi-sorgente "seminato" sugli array del campo, aggiornati sul posto.
+I semi sono tuple (distanza, nodo, predecessore, origine); un nodo viene aggiornato solo se trova una distanza strettamente minore
+di quella che ha già, quindi i nodi validi del campo precedente non vengono toccati se non migliorano.
+@return: numero di nodi aggiornati
+"""
+def _dijkstra(indptr, adiacenti, pesi, distanza, predecessore, origine, semi):
+    dist = distanza.tolist()
+    pred = predecessore.tolist()
+    orig = origine.tolist()
+    aggiornati = set()
+
+    coda = []
+    for d, v, p, o in semi:
+        if d < dist[v]:
+            dist[v], pred[v], orig[v] = d, p, o
+            coda.append((d, v))
+    heapq.heapify(coda)
+
+    while coda:
+        d, u = heapq.heappop(coda)
+        if d > dist[u]:
+            continue
+        aggiornati.add(u)
+        o = orig[u]
+        for k in range(indptr[u], indptr[u + 1]):
+            v = adiacenti[k]
+            nuova = d + pesi[k]
+            if nuova < dist[v]:
+                dist[v], pred[v], orig[v] = nuova, u, o
+                heapq.heappush(coda, (nuova, v))
+
+    distanza[:] = dist
+    predecessore[:] = pred
+    origine[:] = orig
+    return len(aggiornati)
@@ -0,0 +1,340 @@
+# Copyright 2026 [Martin Pedron Giuseppe]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Rappresentazione compatta (CSR) del grafo pedonale di una città per il calcolo dei percorsi della regola 300.
+        Il grafo osmnx/networkx è un MultiDiGraph di dizionari Python, e il Dijkstra di networkx visita nodi e archi uno per uno
+        in Python. Qui lo stesso grafo è tenuto come array numpy:
+            - nodi: id dei nodi nell'ordine del grafo, con le coordinate x/y (nel CRS metrico del grafo);
+            - indptr/indices/lunghezza: lista di adiacenza CSR, gli archi uscenti dal nodo i sono indices[indptr[i]:indptr[i+1]];
+                degli archi paralleli (MultiDiGraph) viene tenuto il più corto, come fa networkx con weight='length'.
+        Dijkstra multi-sorgente con limite di distanza viene eseguito da scipy.sparse.csgraph (codice compilato, min_only=True),
+        e l'aggancio di punti (edifici, perimetri delle aree verdi) al nodo più vicino usa un cKDTree sulle coordinate dei nodi,
+        costruito una sola volta per grafo (ox.nearest_nodes ricostruiva la sua struttura spaziale a ogni chiamata).
+
+        NOTE:
+            1- la versione CSR viene costruita una sola volta per grafo: grafo_csr(grafo) la restituisce dalla cache finché il grafo
+                networkx resta in memoria;
+            2- gli archi senza 'length' pesano 1, come in networkx; gli archi di lunghezza 0 restano archi (zeri espliciti del CSR);
+            3- la versione CSR si salva anche come "snapshot" binario della città (una cartella di file .npy più meta.json, scritta
+                da generatoreGrafi.py accanto al GraphML): caricarla costa una lettura degli array, mappati in memoria in sola lettura,
+                invece del parsing XML di ox.load_graphml e di ox.project_graph. Lo snapshot è già proiettato e tiene solo ciò che
+                serve alla regola 300 (coordinate dei nodi e lunghezza degli archi);
+            4- la regola 300 usa del grafo solo il CRS (grafo.graph['crs']) e la versione CSR: GrafoCSR espone lo stesso attributo graph
+                e grafo_csr() lo restituisce così com'è, quindi graphs_manager passa direttamente la versione CSR al posto del MultiDiGraph.
+            5- sottografo() e unisci() servono alla divisione in tasselli (vedi tasselli.py): ogni tassello è a sua volta una versione CSR,
+                salvata con lo stesso formato di snapshot.
+"""
+
+#importazioni
+import os
+import json
+import shutil
+import hashlib
+import weakref
+import threading
+import numpy as np
+from pyproj import CRS
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+#cache grafo networkx -> versione CSR, finché il grafo esiste
+_cache_csr = weakref.WeakKeyDictionary()
+_lock_cache = threading.Lock()
+
+#snapshot binario: suffisso della cartella accanto al GraphML, versione del formato e array salvati
+SUFFISSO_SNAPSHOT = "_csr"
+VERSIONE_SNAPSHOT = 1
+ARRAY_SNAPSHOT = ('nodi', 'x', 'y', 'indptr', 'indices', 'lunghezza', 'ordine')
+
+class GrafoCSR:
+
+    """
+    @param nodi: id dei nodi (int64) nell'ordine del grafo
+    @param x, y: coordinate dei nodi nel CRS del grafo
+    @param indptr, indices, lunghezza: adiacenza CSR (posizioni dei nodi) e lunghezza in metri degli archi
+    @param crs: CRS del grafo
+    @param ordine: permutazione che ordina nodi (se già nota, ad esempio dallo snapshot)
+    """
+    def __init__(self, nodi, x, y, indptr, indices, lunghezza, crs=None, ordine=None):
+        #indptr e indices con lo stesso tipo intero, così csr_matrix non li copia (gli array dello snapshot restano mappati)
+        self.nodi = np.asarray(nodi, dtype=np.int64)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.lunghezza = np.asarray(lunghezza, dtype=float)
+        self.crs = crs
+        self.graph = {'crs': crs}
+        self._albero = None
+
+        n = len(self.nodi)
+        self.matrice = csr_matrix((self.lunghezza, self.indices, self.indptr), shape=(n, n))
+
+        #indice di ricerca id nodo -> posizione
+        self._ordine = np.argsort(self.nodi, kind="stable") if ordine is None else np.asarray(ordine, dtype=np.int64)
+        self._nodi_ordinati = self.nodi[self._ordine]
+
+    """
+    Costruisce la versione CSR di un grafo networkx (MultiDiGraph osmnx con x/y sui nodi e 'length' sugli archi).
+    """
+    @classmethod
+    def da_grafo(cls, grafo):
+        n = grafo.number_of_nodes()
+        nodi = np.fromiter(grafo.nodes, dtype=np.int64, count=n)
+        x = np.fromiter((d['x'] for _, d in grafo.nodes(data=True)), dtype=float, count=n)
+        y = np.fromiter((d['y'] for _, d in grafo.nodes(data=True)), dtype=float, count=n)
+
+        #estremi degli archi convertiti in posizioni in blocco (sono tutti nodi del grafo)
+        ordine_nodi = np.argsort(nodi, kind="stable")
+        nodi_ordinati = nodi[ordine_nodi]
+        m = grafo.number_of_edges()
+        archi = list(grafo.edges(data='length', default=1))
+        da = ordine_nodi[np.searchsorted(nodi_ordinati, np.fromiter((u for u, _, _ in archi), dtype=np.int64, count=m))]
+        a = ordine_nodi[np.searchsorted(nodi_ordinati, np.fromiter((v for _, v, _ in archi), dtype=np.int64, count=m))]
+        peso = np.fromiter((lunghezza for _, _, lunghezza in archi), dtype=float, count=m)
+        return cls._da_archi(nodi, x, y, da, a, peso, crs=grafo.graph.get('crs'), ordine=ordine_nodi)
+
+    """
+    Costruisce la versione CSR da una lista di archi (posizioni dei nodi di partenza e arrivo, lunghezza), in qualsiasi ordine.
+    Degli archi paralleli tiene il più corto.
+    """
+    @classmethod
+    def _da_archi(cls, nodi, x, y, da, a, peso, crs=None, ordine=None):
+        #ordino per (da, a, peso) e tengo il primo di ogni coppia: l'arco parallelo più corto
+        m = len(da)
+        ordine_archi = np.lexsort((peso, a, da))
+        da, a, peso = da[ordine_archi], a[ordine_archi], peso[ordine_archi]
+        primi = np.r_[True, (da[1:] != da[:-1]) | (a[1:] != a[:-1])] if m else np.zeros(0, dtype=bool)
+        da, a, peso = da[primi], a[primi], peso[primi]
+
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(da, minlength=len(nodi)))))
+        return cls(nodi, x, y, indptr, a, peso, crs=crs, ordine=ordine)
+
+    """
+    Unisce più versioni CSR dello stesso grafo (ad esempio tasselli sovrapposti, vedi tasselli.py) in una sola:
+    i nodi comuni compaiono una volta e gli archi ripetuti vengono tenuti una volta sola.
+    I nodi del risultato sono in ordine di id.
+    """
+    @classmethod
+    def unisci(cls, grafi):
+        nodi, primi = np.unique(np.concatenate([g.nodi for g in grafi]), return_index=True)
+        x = np.concatenate([g.x for g in grafi])[primi]
+        y = np.concatenate([g.y for g in grafi])[primi]
+        da = np.searchsorted(nodi, np.concatenate([g.nodi[g.sorgenti_archi()] for g in grafi]))
+        a = np.searchsorted(nodi, np.concatenate([g.nodi[g.indices] for g in grafi]))
+        peso = np.concatenate([g.lunghezza for g in grafi])
+        return cls._da_archi(nodi, x, y, da, a, peso, crs=grafi[0].crs, ordine=np.arange(len(nodi)))
+
+    """
+    Sottografo dei nodi selezionati, con tutti gli archi che entrano o escono da essi (e i nodi all'altro capo di quegli archi):
+    ogni percorso che passa solo per nodi selezionati è identico a quello sul grafo completo.
+    @param selezionati: maschera booleana allineata ai nodi
+    """
+    def sottografo(self, selezionati):
+        da = self.sorgenti_archi()
+        archi = selezionati[da] | selezionati[self.indices]
+        tenuti = selezionati.copy()
+        tenuti[da[archi]] = True
+        tenuti[self.indices[archi]] = True
+
+        posizioni = np.flatnonzero(tenuti)
+        nuova_posizione = np.full(len(self.nodi), -1, dtype=np.int64)
+        nuova_posizione[posizioni] = np.arange(len(posizioni))
+        #gli archi del CSR sono già ordinati per nodo di partenza, e la rinumerazione conserva l'ordine
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(nuova_posizione[da[archi]], minlength=len(posizioni)))))
+        return GrafoCSR(self.nodi[posizioni], self.x[posizioni], self.y[posizioni], indptr, nuova_posizione[self.indices[archi]],
+                        self.lunghezza[archi], crs=self.crs)
+
+    """
+    Posizione del nodo di partenza di ogni arco, allineata a indices e lunghezza.
+    """
+    def sorgenti_archi(self):
+        return np.repeat(np.arange(len(self.nodi), dtype=np.int64), np.diff(self.indptr))
+
+    def number_of_nodes(self):
+        return len(self.nodi)
+
+    """
+    Stima dei byte occupati dalla versione CSR: array dei nodi e degli archi, matrice di Dijkstra e indice di ricerca, più il cKDTree
+    se già costruito (coordinate e permutazione dei punti, più circa un nodo dell'albero ogni leafsize punti).
+    Gli array di uno snapshot sono mappati da disco e contano comunque: una volta letti occupano la page cache.
+    """
+    def memoria(self):
+        array = (self.nodi, self.x, self.y, self.indptr, self.indices, self.lunghezza, self._ordine, self._nodi_ordinati)
+        byte = sum(a.nbytes for a in array)
+        #csr_matrix non copia indptr/indices/lunghezza se hanno già il tipo giusto, altrimenti ne tiene una copia propria
+        byte += sum(a.nbytes for a in (self.matrice.data, self.matrice.indices, self.matrice.indptr)
+                    if a is not self.lunghezza and a is not self.indices and a is not self.indptr)
+        if self._albero is not None:
+            byte += self._albero.data.nbytes + self._albero.indices.nbytes + 64 * (self._albero.n // max(self._albero.leafsize, 1) + 1)
+        return int(byte)
+
+    """
+    Posizioni dei nodi richiesti (-1 per i nodi sconosciuti).
+    """
+    def indici(self, nodi):
+        nodi = np.asarray(nodi, dtype=np.int64)
+        if len(self._nodi_ordinati) == 0:
+            return np.full(len(nodi), -1, dtype=np.int64)
+        posizioni = np.minimum(np.searchsorted(self._nodi_ordinati, nodi), len(self._nodi_ordinati) - 1)
+        return np.where(self._nodi_ordinati[posizioni] == nodi, self._ordine[posizioni], -1)
+
+    """
+    Indice spaziale (cKDTree) delle coordinate dei nodi, costruito alla prima richiesta.
+    graphs_manager lo costruisce già al caricamento della città: sulle coordinate mappate dallo snapshot costa una frazione del caricamento.
+    """
+    @property
+    def albero(self):
+        if self._albero is None:
+            self._albero = cKDTree(np.column_stack([self.x, self.y]))
+        return self._albero
+
+    """
+    Aggancia ogni punto al nodo più vicino, in blocco.
+    @param distanza_massima: oltre questa distanza (in metri, linea d'aria) il punto non viene agganciato
+    @return: (posizioni, distanze), posizione -1 e distanza inf per i punti non agganciati
+    """
+    def aggancia(self, x, y, distanza_massima=np.inf):
+        punti = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        if len(punti) == 0 or len(self.nodi) == 0:
+            return np.full(len(punti), -1, dtype=np.int64), np.full(len(punti), np.inf)
+        #distance_upper_bound esclude i punti esattamente al limite: lo allargo di un ulp per includerli (<=, come prima)
+        distanze, posizioni = self.albero.query(punti, distance_upper_bound=np.nextafter(distanza_massima, np.inf))
+        posizioni = np.where(np.isfinite(distanze), posizioni, -1)
+        return posizioni, distanze
+
+    """
+    Dijkstra multi-sorgente (distanza dal nodo sorgente più vicino, seguendo il verso degli archi).
+    @param sorgenti: posizioni dei nodi sorgente
+    @param limite: distanza massima esplorata; i nodi oltre hanno distanza inf (come il cutoff di networkx, il limite è incluso)
+    @return: (distanze, predecessori), array allineati ai nodi; il predecessore è una posizione, negativo per sorgenti e irraggiungibili
+    """
+    def dijkstra(self, sorgenti, limite=np.inf):
+        distanze, predecessori, _ = dijkstra(self.matrice, directed=True, indices=np.asarray(sorgenti, dtype=np.int32),
+                                             return_predecessors=True, min_only=True, limit=limite)
+        return distanze, predecessori
+
+    """
+    Salva lo snapshot binario nella cartella indicata (sovrascrivendo quello esistente).
+    La cartella viene scritta accanto e rinominata alla fine, così un lettore non trova mai uno snapshot scritto a metà.
+    @param sorgente: GraphML da cui deriva il grafo; dimensione e data di modifica servono a riconoscere uno snapshot superato
+    """
+    def salva(self, cartella, sorgente=None):
+        temporanea = f"{cartella}.tmp"
+        shutil.rmtree(temporanea, ignore_errors=True)
+        os.makedirs(temporanea)
+
+        array = {'nodi': self.nodi, 'x': self.x, 'y': self.y, 'indptr': self.indptr, 'indices': self.indices,
+                 'lunghezza': self.lunghezza, 'ordine': self._ordine}
+        for nome in ARRAY_SNAPSHOT:
+            np.save(os.path.join(temporanea, f"{nome}.npy"), np.ascontiguousarray(array[nome]))
+
+        meta = {
+            'versione': VERSIONE_SNAPSHOT,
+            'crs': CRS.from_user_input(self.crs).to_wkt() if self.crs is not None else None,
+            'sorgente': _firma_file(sorgente) if sorgente is not None else None,
+        }
+        with open(os.path.join(temporanea, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        sostituisci_cartella(temporanea, cartella)
+
+    """
+    Carica uno snapshot binario. Gli array sono mappati in memoria in sola lettura (mmap): le pagine vengono lette da disco
+    solo quando servono e non vengono mai copiate.
+    @return: la versione CSR, o None se lo snapshot manca o ha una versione diversa
+    """
+    @classmethod
+    def carica(cls, cartella):
+        meta = _leggi_meta(cartella)
+        if meta is None or meta.get('versione') != VERSIONE_SNAPSHOT:
+            return None
+        array = {nome: np.load(os.path.join(cartella, f"{nome}.npy"), mmap_mode='r') for nome in ARRAY_SNAPSHOT}
+        return cls(array['nodi'], array['x'], array['y'], array['indptr'], array['indices'], array['lunghezza'],
+                   crs=meta.get('crs'), ordine=array['ordine'])
+
+    """
+    Percorso dal nodo sorgente al nodo in posizione 'posizione', ricostruito dai predecessori di dijkstra().
+    @return: lista di id dei nodi [sorgente, ..., nodo], stesso verso di nx.multi_source_dijkstra
+    """
+    def percorso(self, predecessori, posizione):
+        catena = []
+        while posizione >= 0:
+            catena.append(posizione)
+            posizione = predecessori[posizione]
+        return self.nodi[catena[::-1]].tolist()
+
+"""
+Percorso della cartella dello snapshot binario di una città, accanto al suo GraphML (stesso nome sicuro di generatoreGrafi e graphsManager).
+"""
+def percorso_snapshot(cartella, city_name):
+    safe_name = city_name.replace(" ", "_").replace(",", "")
+    return os.path.join(cartella, f"{safe_name}{SUFFISSO_SNAPSHOT}")
+
+"""
+Verifica che lo snapshot esista, abbia la versione corrente e derivi dal GraphML attuale (stessa dimensione e data di modifica).
+Se il GraphML non c'è, lo snapshot esistente è l'unica fonte e viene considerato valido.
+"""
+def snapshot_aggiornato(cartella, graphml_path):
+    meta = _leggi_meta(cartella)
+    if meta is None or meta.get('versione') != VERSIONE_SNAPSHOT:
+        return False
+    if not os.path.exists(graphml_path):
+        return True
+    return meta.get('sorgente') == _firma_file(graphml_path)
+
+"""
+Sostituisce la cartella con quella temporanea appena scritta: la vecchia viene spostata da parte e cancellata solo dopo il rename della nuova.
+"""
+def sostituisci_cartella(temporanea, cartella):
+    vecchia = f"{cartella}.old"
+    shutil.rmtree(vecchia, ignore_errors=True)
+    if os.path.exists(cartella):
+        os.replace(cartella, vecchia)
+    os.replace(temporanea, cartella)
+    shutil.rmtree(vecchia, ignore_errors=True)
+
+"""
+Firma dell'insieme ordinato dei nodi di un grafo: due grafi con la stessa firma hanno gli stessi nodi nello stesso ordine.
+Permette di riconoscere il grafo da cui derivano tasselli e campi delle aree verdi senza caricarlo.
+"""
+def firma_nodi(nodi):
+    return hashlib.blake2b(np.ascontiguousarray(nodi, dtype=np.int64).tobytes(), digest_size=16).hexdigest()
+
+def _leggi_meta(cartella):
+    try:
+        with open(os.path.join(cartella, "meta.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _firma_file(percorso):
+    stat = os.stat(percorso)
+    return {'dimensione': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+"""
+Versione CSR del grafo, costruita alla prima richiesta e poi riusata finché il grafo resta in memoria.
+Se il grafo è già una versione CSR (come quelli di graphs_manager) viene restituito così com'è.
+"""
+def grafo_csr(grafo):
+    if isinstance(grafo, GrafoCSR):
+        return grafo
+    with _lock_cache:
+        csr = _cache_csr.get(grafo)
+        if csr is None:
+            csr = GrafoCSR.da_grafo(grafo)
+            _cache_csr[grafo] = csr
+        return csr
@@ -19,21 +19,28 @@ Questa funzione sostituisce il semplice calcolo geometrico (buffer) quando siamo
 @param edifici: GDF degli edifici (EPSG:4326)
 @param aree_verdi: GDF delle aree verdi (EPSG:4326)
 @param grafo: grafo NetworkX della città (già proiettato in metri da graphs_manager)
+@param calcola_percorsi: se False calcola solo le distanze pedonali, senza ricostruire i percorsi (modalità "solo conformità")
+@param edifici_percorso: id degli edifici (colonna 'id', o etichette dell'indice) di cui restituire il percorso; None = tutti.
+    Le distanze vengono comunque calcolate per tutti gli edifici, i percorsi degli altri restano None.
+@param campo_verde: campo precalcolato delle distanze dalle aree verdi della città (CampoVerde), con il registro delle aree verdi e dei loro
+    nodi di accesso; None per calcolare tutto con Dijkstra
 @return: GDF degli edifici arricchito con le colonne .... (NB, se aggiungiamo i metri reali, dobbiamo aggiungerla anche per la versione geometrica per coerenza)
 """
 
-import networkx as nx
-import osmnx as ox
 from shapely.geometry import Polygon, MultiPolygon, LineString
 import json
-from shapely.geometry import mapping
 import geopandas as gpd
 import numpy as np
-import math
+from functools import lru_cache
+from pyproj import Transformer
+from .grafo_csr import grafo_csr
 
 infinity_dist = -1
 
-def calculate_pedestrian_path(edifici, aree_verdi, grafo):
+#distanza pedonale massima esplorata (in metri): 350 invece di 300 per tolleranza sulla mappatura iniziale area_verde - nodo grafo
+cutoff_dist = 350
+
+def calculate_pedestrian_path(edifici, aree_verdi, grafo, calcola_percorsi=True, edifici_percorso=None, campo_verde=None):
     
     print("Avvio analisi pedonale.")
     
@@ -60,141 +67,202 @@ def calculate_pedestrian_path(edifici, aree_verdi, grafo):
         print(f"Errore proiezione CRS: {e}")
         return copia_edifici
 
-    #prendiamo i centroidi delle aree verdi e troviamo il nodo del grafo più vicino a ognuno...#un punto ogni tot metri lungo il perimetro
+    #mappo edifici sui nodi
+    print("Mappatura edifici sul grafo.")
+    edifici_centroids = edifici_proj.geometry.centroid
+    csr = grafo_csr(grafo)
+    posizioni_edifici, _ = csr.aggancia(edifici_centroids.x, edifici_centroids.y)
+    edifici_nodes = csr.nodi[posizioni_edifici].tolist()
+
+    """
+    Se per la città esiste il campo precalcolato (vedi campo_verde.py), la distanza di ogni nodo dall'area verde più vicina e il
+    predecessore verso di essa sono già su disco: salto la mappatura delle aree verdi e Dijkstra, e a ogni edificio basta una lettura dell'array.
+    Le aree verdi del campo sono quelle dell'intera città al momento della generazione, mentre Dijkstra per richiesta parte solo dalle aree
+    verdi della richiesta: lo uso solo se tutte le aree verdi della richiesta sono nel suo registro (ricerca spaziale con abbina) e se,
+    per ogni edificio entro il cutoff, l'area più vicina secondo il campo (nodo di origine) è una di quelle della richiesta.
+    Un parco della città fuori dalla richiesta (es. tra 300 e 350 metri dal poligono) darebbe altrimenti distanze diverse da Dijkstra,
+    e un'area verde che non compare tra quelle restituite al frontend. In quei casi Dijkstra per richiesta.
+    """
+    abbinate = campo_verde.abbina(verdi_proj) if campo_verde is not None else np.full(len(verdi_proj), -1)
+    usa_campo = campo_verde is not None and bool((abbinate >= 0).all())
+    if usa_campo:
+        distanze_campo = campo_verde.distanze(edifici_nodes, cutoff=cutoff_dist, mancante=infinity_dist)
+        accessi_richiesta = np.concatenate([campo_verde.accessi(j) for j in abbinate.tolist()] + [np.empty(0, dtype=np.int64)])
+        esterne = (distanze_campo != infinity_dist) & ~np.isin(campo_verde.origini(edifici_nodes), accessi_richiesta)
+        if esterne.any():
+            print(f"{int(esterne.sum())} edifici hanno l'area verde più vicina fuori dalla richiesta: Dijkstra per richiesta.")
+            usa_campo = False
+
+    if usa_campo:
+        print("Uso il campo precalcolato delle distanze dalle aree verdi.")
+    else:
+        #prendiamo i centroidi delle aree verdi e troviamo il nodo del grafo più vicino a ognuno...#un punto ogni tot metri lungo il perimetro
+        """
+        Precedentemente, consideravamo il centroide dell'area verde come nodo di partenza/arrivo. Tuttavia, questo potrebbe non essere rappresentativo
+        della reale accessibilità pedonale, specialmente per aree verdi che hanno un percorso pedonale interno tracciato da OSM (linee rosse tratteggiate).
+        In quel caso, il nodo più vicino al centroide potrebbe essere DENTRO l'area verde, e quindi non rappresentare un punto di accesso pedonale reale.
+        Per migliorare la mappatura, campioniamo punti ogni tot metri (sampling_distance) SUL perimetro dell'area verde, che è più probabile rappresentino punti di accesso
+        pedonale reali. In questo modo, se c'è un percorso pedonale interno tracciato da OSM, i nodi più vicini saranno su quel percorso, ma non all'interno.
+        Inoltre, per non avere nodi di proiezione sulla strada troppo lontani dall'area verde, applichiamo un cutoff (max_snap_distance) alla mappatura iniziale
+        area verde - nodo grafo. Se il nodo più vicino è oltre quel cutoff, non lo consideriamo. Se per un area verde non ci sono ingressi 'comodi' di questo tipo,
+        l'area verde la consideriamo irranggiungibile.
+        """
+        #le aree riconosciute nel registro del campo hanno già i nodi di accesso calcolati offline: ricampiono solo le altre
+        print("Mappatura aree verdi sul grafo.")
+        valid_sources = set()
+        for j in abbinate[abbinate >= 0].tolist():
+            valid_sources.update(campo_verde.accessi(j).tolist())
+        if (abbinate < 0).any():
+            if campo_verde is not None:
+                print(f"{int((abbinate < 0).sum())} aree verdi non presenti nel campo precalcolato: Dijkstra per richiesta.")
+            for nodi_area in nodi_accesso_aree_verdi(verdi_proj[abbinate < 0], grafo):
+                valid_sources.update(nodi_area.tolist())
+
+        #per best-practice, elimino i nodi duplicati per ottimizzare Dijkstra. I nodi dei grafi potrebbero effettivamente ripetersi in quanto 
+        #sono dove le strade si intersecano, e più aree verdi potrebbero essere mappate sullo stesso nodo.
+        sources=list(valid_sources)
+        if not sources:
+            return copia_edifici
+
+        #calcoliamo la distanza di TUTTI i nodi del grafo verso il set di nodi verdi in un colpo solo.
+        #cutoff_dist=350: ottimizzazione ---> l'algoritmo smette di cercare oltre i 350 metri.
+        #mettiamo 350 invece di 300 per tolleranza sulla mappatura iniziale area_verde - nodo grafo
+        #Dijkstra gira sulla versione CSR del grafo (scipy.sparse.csgraph, costruita una volta per grafo) invece che su networkx:
+        #return: distanze (inf oltre il cutoff) e predecessori, array allineati ai nodi; i percorsi si ricostruiscono solo per chi serve
+        print("Calcolo percorsi minimi (Dijkstra).")
+        try:
+            distanze, predecessori = csr.dijkstra(csr.indici(sources), limite=cutoff_dist)
+        except Exception as e:
+            print(f"Errore nel calcolo dei percorsi: {e}")
+            return copia_edifici
+
+    #ciclo i nodi degli edifici. Se sono nel dizionario delle distanze calcolate, aggiungo la distanza. Altrimenti significa che è > cutoff
+    if not usa_campo:
+        distanze_edifici = distanze[csr.indici(edifici_nodes)]
+        results_distances = np.where(np.isfinite(distanze_edifici), distanze_edifici, infinity_dist).tolist()
+        #in modalità "solo conformità" (calcola_percorsi=False) servono solo le distanze: non ricostruisco i percorsi
+        def trova_percorso(nodo):
+            posizione = csr.indici([nodo])[0]
+            return csr.percorso(predecessori, posizione) if calcola_percorsi and np.isfinite(distanze[posizione]) else None
+    else:
+        results_distances = distanze_campo.tolist()
+        trova_percorso = (lambda nodo: campo_verde.percorso(nodo, cutoff=cutoff_dist)) if calcola_percorsi else (lambda nodo: None)
+
     """
-    Precedentemente, consideravamo il centroide dell'area verde come nodo di partenza/arrivo. Tuttavia, questo potrebbe non essere rappresentativo
-    della reale accessibilità pedonale, specialmente per aree verdi che hanno un percorso pedonale interno tracciato da OSM (linee rosse tratteggiate).
-    In quel caso, il nodo più vicino al centroide potrebbe essere DENTRO l'area verde, e quindi non rappresentare un punto di accesso pedonale reale.
-    Per migliorare la mappatura, campioniamo punti ogni tot metri (sampling_distance) SUL perimetro dell'area verde, che è più probabile rappresentino punti di accesso
-    pedonale reali. In questo modo, se c'è un percorso pedonale interno tracciato da OSM, i nodi più vicini saranno su quel percorso, ma non all'interno.
-    Inoltre, per non avere nodi di proiezione sulla strada troppo lontani dall'area verde, applichiamo un cutoff (max_snap_distance) alla mappatura iniziale
-    area verde - nodo grafo. Se il nodo più vicino è oltre quel cutoff, non lo consideriamo. Se per un area verde non ci sono ingressi 'comodi' di questo tipo,
-    l'area verde la consideriamo irranggiungibile.
+    Percorsi da restituire: quelli di tutti gli edifici, oppure solo quelli degli edifici richiesti (id OSM, o etichetta dell'indice
+    se manca la colonna 'id'). La ricerca Dijkstra è una sola e costa poco; il costo, e il peso della risposta, sta nel convertire
+    e serializzare i percorsi, che per gli altri edifici restano None.
     """
-    print("Mappatura aree verdi sul grafo.")
-    green_boundary_points_x = []
-    green_boundary_points_y = []
-    sampling_distance = 40
-    max_snap_distance = 35
+    if edifici_percorso is None:
+        percorsi_edifici = [trova_percorso(node) for node in edifici_nodes]
+    else:
+        richiesti = {str(e) for e in edifici_percorso}
+        etichette = edifici['id'].astype(str) if 'id' in edifici.columns else edifici.index.astype(str)
+        percorsi_edifici = [trova_percorso(node) if etichetta in richiesti else None for etichetta, node in zip(etichette, edifici_nodes)]
+
+    #converto tutti i percorsi in GeoJSON lat/lon in blocco
+    results_paths = _percorsi_geojson(grafo, percorsi_edifici, graph_crs)
+
+    #aggiungo i risultati al GDF originale
+    copia_edifici['distanza_pedonale'] = results_distances
+    copia_edifici['percorso_pedonale'] = results_paths
+
+    #statistiche per debug script
+    soddisfatti = (copia_edifici['distanza_pedonale'] <= 300).sum()
+    print(f"Risultato: {soddisfatti}/{len(copia_edifici)} edifici soddisfano la regola 300m con grafo.")
+
+    #gestiamo la compilazione dei campi in comune per la regola nel main regola300, in modo da essere uniformi con la versione standard degli edifici.
+    return copia_edifici
+
+"""
+Nodi di accesso pedonale di ogni area verde (vedi il commento in calculate_pedestrian_path): punti campionati ogni sampling_distance metri
+sul perimetro di ogni sottopoligono (il centroide per i perimetri più corti), agganciati al nodo del grafo più vicino se entro max_snap_distance.
+Usata sia dal calcolo per richiesta sia dalla generazione offline del campo delle distanze (campo_verde.py), che deve sapere a quale area
+appartiene ogni nodo per aggiornarsi quando cambiano le aree verdi.
+@param verdi_proj: GDF delle aree verdi nel CRS (metrico) del grafo
+@return: lista allineata alle righe di verdi_proj, con l'array (ordinato, senza duplicati) dei nodi di accesso di ogni area; vuoto se irraggiungibile.
+"""
+def nodi_accesso_aree_verdi(verdi_proj, grafo, sampling_distance=40, max_snap_distance=35):
+    punti_x = []
+    punti_y = []
+    area_di = []
 
     #itero sulle aree verdi
-    for geom in verdi_proj.geometry:
+    for i, geom in enumerate(verdi_proj.geometry):
+        if geom is None or geom.is_empty:
+            continue
         #uso MultiPolygon perchè alcuni parchi sono spezzati in sottopoligoni
-        if isinstance(geom, MultiPolygon):
-            polys = list(geom.geoms)
-        else:
-            polys = [geom]
-        
-        #itero sui sottopoligoni
-        for poly in polys:
+        polys = list(geom.geoms) if isinstance(geom, MultiPolygon) else [geom]
 
-            #estraggo il perimetro e ne calcolo la lunghezza
+        for poly in polys:
             boundary = poly.exterior
             if boundary is None:
                 continue
             length = boundary.length
-            
-            #se il perimetro è molto piccolo, prendo solo il centroide
-            #il caso di perimetro piccolo è raro perchè abbiamo già filtrato area>=1ettaro, ma riguarda possibili sotto-porzioni di aree verdi grandi
+
+            #se il perimetro è molto piccolo, prendo solo il centroide, altrimenti un punto ogni tot metri lungo il perimetro
             if length < sampling_distance:
                 pt = poly.centroid
-                green_boundary_points_x.append(pt.x)
-                green_boundary_points_y.append(pt.y)
-            #normalmente, campiono punti ogni tot metri lungo il perimetro
+                punti_x.append(pt.x)
+                punti_y.append(pt.y)
+                area_di.append(i)
             else:
-                distances = np.arange(0, length, sampling_distance)
-                for d in distances:
-                    #prende il punto a distanza d dal punto iniziale (mappato 0) lungo il perimetro
+                for d in np.arange(0, length, sampling_distance):
                     pt = boundary.interpolate(d)
-                    green_boundary_points_x.append(pt.x)
-                    green_boundary_points_y.append(pt.y)
-
-    #candidati nodi più vicini a quei punti di campionamento sul perimetro
-    candidate_nodes = ox.nearest_nodes(grafo, green_boundary_points_x, green_boundary_points_y)
-    
-    #verifico che il nodo trovato sia effettivamente vicino al parco.
-    valid_sources = set()
-    for i, node_id in enumerate(candidate_nodes):
-        #coordinata punto sul perimetro
-        px = green_boundary_points_x[i]
-        py = green_boundary_points_y[i]
-        
-        #coordinata nodo del grafo
-        nx_coord = grafo.nodes[node_id]['x']
-        ny_coord = grafo.nodes[node_id]['y']
-        
-        #calcolo distanza in linea d'aria (già in metri)
-        dist_reale = math.sqrt((px - nx_coord)**2 + (py - ny_coord)**2)
-        
-        if dist_reale <= max_snap_distance:
-            valid_sources.add(node_id)
-
-    #per best-practice, elimino i nodi duplicati per ottimizzare Dijkstra. I nodi dei grafi potrebbero effettivamente ripetersi in quanto 
-    #sono dove le strade si intersecano, e più aree verdi potrebbero essere mappate sullo stesso nodo.
-    sources=list(valid_sources)
-    if not sources:
-        return copia_edifici
-
-    #calcoliamo la distanza di TUTTI i nodi del grafo verso il set di nodi verdi in un colpo solo.
-    #cutoff=350: ottimizzazione ---> l'algoritmo smette di cercare oltre i 350 metri.
-    #mettiamo 350 invece di 300 per tolleranza sulla mappatura iniziale area_verde - nodo grafo
-    #return: (distances, paths) dove paths è {target_node: [source, ..., target]}, e distances è {target_node: distance}.
-    print("Calcolo percorsi minimi (Dijkstra).")
-    try:
-        distanze, percorsi = nx.multi_source_dijkstra(
-            grafo, 
-            sources, 
-            weight='length',
-            cutoff=350 
-        )
-    except Exception as e:
-        print(f"Errore nel calcolo dei percorsi: {e}")
-        return copia_edifici
-
-    #mappo edifici sui nodi
-    print("Mappatura edifici sul grafo.")
-    edifici_centroids = edifici_proj.geometry.centroid
-    edifici_nodes = ox.nearest_nodes(grafo, edifici_centroids.x, edifici_centroids.y)
-    results_distances = []
-    results_paths = []
-    
-    #ciclo i nodi degli edifici. Se sono nel dizionario delle distanze calcolate, aggiungo la distanza. Altrimenti significa che è > cutoff
-    for node in edifici_nodes:
-        dist = distanze.get(node, infinity_dist)
-        results_distances.append(dist)
+                    punti_x.append(pt.x)
+                    punti_y.append(pt.y)
+                    area_di.append(i)
 
-        #inizializzo il percorso a None
-        path_json = None
-        try:
-            if(node in percorsi):
-                lista = percorsi[node]
-                #se il percorso esiste e ha almeno un nodo area verde e un nodo edificio (il minimo), lo salvo. Altrimenti, rimane None.
-                if(len(lista) >= 2):
-                    #estraggo coordinate di tutti i nodi e ci creo delle LineString che li collegano (Shapely)
-                    coords = [(grafo.nodes[n]['x'], grafo.nodes[n]['y']) for n in lista]
-                    linea = LineString(coords)
+    if not punti_x:
+        return [np.empty(0, dtype=np.int64) for _ in range(len(verdi_proj))]
 
-                    #proietto la linea in lat/lon (crs 4326) perché il frontend userà quello (uso GDF temporaneo)
-                    linea_gdf = gpd.GeoDataFrame(geometry=[linea], crs=graph_crs)
-                    linea_proiettata = linea_gdf.to_crs("EPSG:4326").geometry.iloc[0]
+    #nodo più vicino a ogni punto, tenuto solo se entro max_snap_distance in linea d'aria (già in metri)
+    csr = grafo_csr(grafo)
+    posizioni, _ = csr.aggancia(punti_x, punti_y, distanza_massima=max_snap_distance)
+    validi = posizioni >= 0
+    candidate_nodes = csr.nodi[np.where(validi, posizioni, 0)]
 
-                    #converto in geojson string (usando mapping di shapely)
-                    path_json = json.dumps(mapping(linea_proiettata))
+    #divido i nodi validi per area verde (area_di è già in ordine crescente)
+    area_di = np.asarray(area_di)[validi]
+    candidate_nodes = candidate_nodes[validi]
+    confini = np.searchsorted(area_di, np.arange(len(verdi_proj) + 1))
+    return [np.unique(candidate_nodes[inizio:fine]) for inizio, fine in zip(confini[:-1], confini[1:])]
 
-        except Exception as e:
-            print(f"Errore nel recupero del percorso per nodo {node}: {e}")
-            
-        #salvo risultato nella lista, che sia None o meno, per coerenza con le operazioni generali agli edifici
-        results_paths.append(path_json)
+"""
+Trasformazione dal CRS del grafo a lat/lon (EPSG:4326), creata una sola volta per CRS e riusata tra le richieste.
+"""
+@lru_cache(maxsize=None)
+def _trasformatore_wgs84(crs):
+    return Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
 
+"""
+Converte in blocco i percorsi (liste di nodi del grafo) in stringhe GeoJSON LineString in lat/lon.
+Prima ogni percorso diventava una LineString in un GeoDataFrame di una riga riproiettato con to_crs, quindi una pipeline
+di proiezione per edificio. Ora le coordinate di tutti i nodi di tutti i percorsi vengono concatenate in un unico array,
+trasformate con una sola chiamata al Transformer (in cache) e divise di nuovo per percorso con gli offset.
+I percorsi mancanti o con meno di due nodi (edificio già sul nodo dell'area verde) restano None.
+@return: lista di stringhe GeoJSON (o None) allineata ai percorsi.
+"""
+def _percorsi_geojson(grafo, percorsi, graph_crs):
+    risultati = [None] * len(percorsi)
+    validi = [i for i, lista in enumerate(percorsi) if lista is not None and len(lista) >= 2]
+    if not validi:
+        return risultati
 
-    #aggiungo i risultati al GDF originale
-    copia_edifici['distanza_pedonale'] = results_distances
-    copia_edifici['percorso_pedonale'] = results_paths
+    try:
+        lunghezze = np.array([len(percorsi[i]) for i in validi])
+        nodi = [n for i in validi for n in percorsi[i]]
+        csr = grafo_csr(grafo)
+        posizioni = csr.indici(nodi)
+        x = csr.x[posizioni]
+        y = csr.y[posizioni]
+        lon, lat = _trasformatore_wgs84(str(graph_crs)).transform(x, y)
+        coordinate = np.column_stack([lon, lat])
 
-    #statistiche per debug script
-    soddisfatti = (copia_edifici['distanza_pedonale'] <= 300).sum()
-    print(f"Risultato: {soddisfatti}/{len(copia_edifici)} edifici soddisfano la regola 300m con grafo.")
+        confini = np.concatenate(([0], np.cumsum(lunghezze)))
+        for k, i in enumerate(validi):
+            risultati[i] = json.dumps({'type': 'LineString', 'coordinates': coordinate[confini[k]:confini[k + 1]].tolist()})
+    except Exception as e:
+        print(f"Errore nella conversione dei percorsi: {e}")
 
-    #gestiamo la compilazione dei campi in comune per la regola nel main regola300, in modo da essere uniformi con la versione standard degli edifici.
-    return copia_edifici
\ No newline at end of file
+    return risultati
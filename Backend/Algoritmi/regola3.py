@@ -24,6 +24,8 @@
                 e l'altezza di ogni albero (quasi mai presente in OSM); gli ultimi due si potrebbero simulare con un'altezza media,
                 ma l'algoritmo perderebbe di precisione;
             2-  buffer è impostato a 30 metri, con base scientifica (letteratura Asti);
+            3-  il calcolo è eseguito in blocco dal motore vettoriale (_calcola_alberi_visibili) con shapely 2 e numpy;
+                is_unobstructed resta come versione di riferimento per singola coppia albero-edificio (script di debug).
 """
 
 ########################################################################################################################
@@ -31,9 +33,13 @@
 # in questo momento sono commentati per ridurre i falsi positivi; sono facilmente reintegrabili.
 ########################################################################################################################
 from shapely.geometry import LineString
+import shapely
+import geopandas as gpd
 import pandas as pd
 import logging
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .cache_visibilita import calcola_firme
 
 #costante di buffer di visuale in metri
 view_buffer = 45
@@ -44,10 +50,41 @@ DEBUFFER_METRI = -0.5
 #costante di angolo massimo per il filtro angolare della vista
 MAX_ANGLE_DEG = 60
 
+#numero di coppie edificio-albero elaborate per blocco dal motore vettoriale (limita la memoria degli array di terne)
+BLOCCO_COPPIE = 20000
+
+#modalità parallela: numero di processi (1 = esecuzione seriale) e lato in metri delle tile spaziali in cui dividere gli edifici
+PROCESSI_PARALLELI = 1
+DIMENSIONE_TILE = 500
+
+#metodi di calcolo della visibilità: linee di vista per ogni coppia albero-lato, oppure poligoni di visibilità (isovista) per lato
+METODO_LINEE = "linee"
+METODO_ISOVISTA = "isovista"
+
+#risoluzione angolare (in gradi) dei raggi usati per costruire le isoviste, e numero di lati elaborati per blocco
+PASSO_ISOVISTA_DEG = 3
+BLOCCO_FACCIATE = 2000
+
+#motivi registrati dal tracciamento delle linee di vista (stessi nomi dello script di debug)
+MOTIVO_OLTRE_BUFFER = "Oltre il Buffer"
+MOTIVO_AUTO_OSTRUZIONE = "Auto-Ostruzione (Crosses)"
+MOTIVO_OSTACOLO = "Ostruita da Esterno"
+MOTIVO_LIBERA = "Libera"
+
+#numero massimo di linee di vista tenute in memoria da un tracciamento
+MAX_LINEE_TRACCIATE = 200_000
+
 """
-    Funzione che calcola il numero di alberi visibili da ogni edificio
+    Funzione che calcola il numero di alberi visibili da ogni edificio.
+    @param processi: numero di processi per la modalità parallela a tile (default PROCESSI_PARALLELI, 1 = seriale)
+    @param dimensione_tile: lato delle tile in metri per la modalità parallela (default DIMENSIONE_TILE)
+    @param cache: cache persistente di visibilità (CacheVisibilita) da consultare prima del calcolo, opzionale
+    @param metodo: METODO_LINEE (default, una linea di vista per coppia albero-lato) oppure METODO_ISOVISTA (un poligono di visibilità per lato)
+    @param limite: se impostato (modalità "solo conformità"), un edificio smette di testare alberi appena ne vede `limite`;
+        conteggi e liste di id vengono troncati a `limite`
+    @param traccia: TracciaLineeVista opzionale in cui registrare le linee di vista calcolate (solo metodo delle linee, in serie)
 """
-def run_rule_3(edifici, alberi):
+def run_rule_3(edifici, alberi, processi=None, dimensione_tile=None, cache=None, metodo=METODO_LINEE, limite=None, traccia=None):
 
     #avvio logger regola
     logger = logging.getLogger("regola3")
@@ -126,61 +163,38 @@ def run_rule_3(edifici, alberi):
         edifici['visible_trees_id'] = [[] for _ in range(len(edifici))]
         return edifici
 
-    #eseguo una copia per i risultati e inizializzo i contenitori dei risultati
+    #eseguo una copia per i risultati
     risultato_edifici = edifici_proj.copy()
-    output_counter = []
-    output_ids = []
 
     logger.info("Avvio del calcolo della linea di vista...")
 
-    """
-    Come per la regola 300 anche qui uso gli indici spaziali di geopandas
-    per velocizzare le ricerche. Questa operazione ottimizza molto il calcolo,
-    specialmente con dataset di grandi dimensioni; ci permette di passare da 
-    O(n*m*n) a O(n*m*log(n)) complessità approssimativa, dove n è il numero di edifici
-    e m il numero di alberi.
-    """
-    alberi_idx = alberi_proj.sindex
-    ostacoli_idx = edifici_proj.sindex
-
     #identifico la colonna id degli alberi (pulita nel main)
     colonna_id_albero = 'id' if 'id' in alberi_proj.columns else None
 
-    #itero su ogni edificio
-    for idx, edificio in risultato_edifici.iterrows():
-
-        #buffer di 30 metri attorno all'edificio
-        buffer = edificio.geometry.buffer(view_buffer)
-        
-        """
-        Uso l'indice per trovare gli alberi candidati all'interno del buffer
-        questa operazione è approssimativa e fornisce più risultati di quelli reali
-        ci serve in particolare per ridurre i candidati per il prossimo controllo
-        """
-        possible_indices = list(alberi_idx.intersection(buffer.bounds))
-
-        #creo una sottolista con solo quei candidati
-        trees_candidates = alberi_proj.iloc[possible_indices]
-
-        """
-        Eseguo il filtro preciso geospaziale solo sugli alberi candidati
-        la funzione within è più precisa e lenta, ma ora lavora su un sottoinsieme ridotto
-        è onerosa perchè calcola la geometria esatta e non solo i bounds
-        """
-        selected_trees = trees_candidates[trees_candidates.geometry.within(buffer)]
-
-        #lista per tenere traccia degli alberi visibili
-        id_visibili = []
-
-        #itero sugli alberi vicini richiamando la funzione apposita per la vista     
-        for _, albero in selected_trees.iterrows():
-            if is_unobstructed(albero, edificio, edifici_proj, ostacoli_idx):
-                if(colonna_id_albero):
-                    id_visibili.append(albero[colonna_id_albero])
-                
-        #aggiorno i risultati
-        output_counter.append(len(id_visibili))
-        output_ids.append(id_visibili)
+    """
+    Il calcolo non itera più edificio per edificio e albero per albero con is_unobstructed:
+    il motore vettoriale costruisce in blocco tutte le terne (edificio, albero, lato) candidate come array numpy
+    e applica gli stessi controlli (angolo, lunghezza, auto-occlusione, ostacoli) con le funzioni vettoriali di shapely 2.
+    Restituisce, per ogni edificio, le posizioni degli alberi visibili nel GDF alberi_proj.
+    Lo strato degli ostacoli debufferizzati, con il suo indice spaziale, viene costruito una sola volta per richiesta.
+    Se viene passata una cache di visibilità, le coppie edificio-albero già calcolate e invariate vengono lette da lì.
+    """
+    processi = PROCESSI_PARALLELI if processi is None else processi
+    dimensione_tile = DIMENSIONE_TILE if dimensione_tile is None else dimensione_tile
+    if metodo not in _MOTORI:
+        logger.warning(f"Metodo di calcolo '{metodo}' non riconosciuto. Uso il metodo '{METODO_LINEE}'.")
+        metodo = METODO_LINEE
+    posizioni_visibili = _calcola_alberi_visibili(edifici_proj, alberi_proj, processi, dimensione_tile, cache, metodo, limite, traccia)
+    if limite is not None:
+        posizioni_visibili = [posizioni[:limite] for posizioni in posizioni_visibili]
+
+    #converto le posizioni negli id degli alberi (senza colonna id, come in precedenza, non registro alberi visibili)
+    if colonna_id_albero:
+        id_alberi = alberi_proj[colonna_id_albero].to_numpy()
+        output_ids = [id_alberi[posizioni].tolist() for posizioni in posizioni_visibili]
+    else:
+        output_ids = [[] for _ in posizioni_visibili]
+    output_counter = [len(id_visibili) for id_visibili in output_ids]
     
     #assegno i risultati al GeoDataFrame risultato_edifici
     risultato_edifici['visible_trees_count'] = output_counter
@@ -207,10 +221,173 @@ def run_rule_3(edifici, alberi):
 alberi = gpd.read_file("./Alberi.geojson")
 print(run_rule_3(edifici, alberi))"""
 
+"""
+    Tabella compatta dei lati (facciate) degli edifici, costruita una volta per richiesta.
+    Prima coordinate del perimetro, punti medi, vettori e norme dei lati venivano ricalcolati per ogni albero,
+    pur dipendendo solo dall'edificio. La tabella li tiene in array numpy allineati:
+        - edificio: posizione dell'edificio di appartenenza;
+        - punto_medio, direzione (versore del lato), lunghezza;
+        - primo e numero: per ogni edificio, indice del primo lato nella tabella e numero di lati (i lati di un edificio sono contigui).
+    I lati di lunghezza nulla (vertici ripetuti) vengono scartati, come nella versione iterativa.
+    Per i MultiPolygon l'anello esterno non esiste e, come nella versione iterativa (che falliva su .exterior), l'edificio non ha lati.
+"""
+class TabellaFacciate:
+
+    __slots__ = ('edificio', 'punto_medio', 'direzione', 'lunghezza', 'primo', 'numero')
+
+    def __init__(self, geom_edifici):
+        anelli = shapely.get_exterior_ring(geom_edifici)
+        vertici, anello_di = shapely.get_coordinates(anelli, return_index=True)
+
+        #i lati sono le coppie di vertici consecutivi dello stesso anello
+        stesso_anello = anello_di[:-1] == anello_di[1:]
+        p1 = vertici[:-1][stesso_anello]
+        p2 = vertici[1:][stesso_anello]
+        edificio = anello_di[:-1][stesso_anello]
+        wall_vector = p2 - p1
+        lunghezza = np.hypot(wall_vector[:, 0], wall_vector[:, 1])
+
+        non_nulli = lunghezza > 0
+        self.edificio = edificio[non_nulli]
+        self.punto_medio = ((p1 + p2) / 2)[non_nulli]
+        self.lunghezza = lunghezza[non_nulli]
+        self.direzione = wall_vector[non_nulli] / self.lunghezza[:, None]
+        self.numero = np.bincount(self.edificio, minlength=len(geom_edifici))
+        self.primo = np.concatenate(([0], np.cumsum(self.numero)[:-1])).astype(np.intp)
+
+"""
+    Strato degli ostacoli per la linea di vista: gli edifici con il debuffer di DEBUFFER_METRI già applicato.
+    Prima il buffer negativo veniva ricalcolato su una copia degli ostacoli per ogni lato di ogni coppia albero-edificio,
+    quindi lo stesso edificio veniva ridotto migliaia di volte per richiesta. Qui lo calcolo una volta sola,
+    costruisco l'STRtree sulle geometrie ridotte e le preparo (shapely.prepare) per rendere più veloci i test di intersezione.
+    Le geometrie sono allineate posizionalmente al GDF di partenza; le etichette servono per escludere l'edificio di partenza.
+"""
+class OstacoliDebufferizzati:
+
+    def __init__(self, edifici_proj):
+        self.etichette = edifici_proj.index.to_numpy()
+        self.geometrie = shapely.buffer(np.asarray(edifici_proj.geometry.values), DEBUFFER_METRI)
+        shapely.prepare(self.geometrie)
+        self.albero = shapely.STRtree(self.geometrie)
+
+"""
+    Tracciamento opzionale delle linee di vista, per diagnosticare edifici lenti o con risultati sbagliati direttamente
+    sulle richieste reali, senza la copia della regola nello script di debug.
+    Il motore delle linee registra, per le coppie selezionate, ogni linea di vista che supera il filtro angolare con:
+    id di edificio e albero, angolo tra linea e lato, lunghezza, esito e motivo (MOTIVO_*), id dell'eventuale ostacolo.
+    Quando la traccia non viene passata il motore fa solo un controllo "is not None" per blocco.
+    @param campionamento: frazione (0-1) di coppie edificio-albero da tracciare, estratte a caso
+    @param edifici: id (colonna 'id') o etichette dell'indice degli edifici da tracciare; None = tutti
+    @param max_linee: numero massimo di linee tenute in memoria, oltre il quale la registrazione si ferma
+    @param seme: seme del generatore casuale del campionamento, per tracce ripetibili
+    NOTE:
+        1- le coppie degli edifici filtrati vengono sempre ricalcolate, anche se presenti nella cache di visibilità;
+            quelle estratte dal solo campionamento vengono tracciate solo se non sono già in cache;
+        2- il tracciamento forza l'esecuzione in serie e non è disponibile con il metodo isovista.
+"""
+class TracciaLineeVista:
+
+    def __init__(self, campionamento=1.0, edifici=None, max_linee=MAX_LINEE_TRACCIATE, seme=None):
+        self.campionamento = campionamento
+        self.edifici = None if edifici is None else {str(e) for e in edifici}
+        self.max_linee = max_linee
+        self.linee_registrate = 0
+        self._generatore = np.random.default_rng(seme)
+        self._blocchi = []
+        self._crs = None
+        self._id_edifici = None
+        self._id_alberi = None
+        self._ammessi = None
+
+    """
+    Collega la traccia ai GDF proiettati della richiesta: id da riportare nelle linee e filtro degli edifici per posizione.
+    """
+    def inizia(self, edifici_proj, alberi_proj):
+        self._crs = edifici_proj.crs
+        etichette = edifici_proj.index.astype(str).to_numpy()
+        self._id_edifici = edifici_proj['id'].astype(str).to_numpy() if 'id' in edifici_proj.columns else etichette
+        self._id_alberi = alberi_proj['id'].astype(str).to_numpy() if 'id' in alberi_proj.columns else alberi_proj.index.astype(str).to_numpy()
+        if self.edifici is not None:
+            ammessi = list(self.edifici)
+            self._ammessi = np.isin(self._id_edifici, ammessi) | np.isin(etichette, ammessi)
+
+    """
+    Coppie degli edifici richiesti dal filtro (tutte False senza filtro): sono quelle da non leggere dalla cache.
+    """
+    def filtrate(self, coppie_edificio):
+        if self._ammessi is None:
+            return np.zeros(len(coppie_edificio), dtype=bool)
+        return self._ammessi[coppie_edificio]
+
+    """
+    Seleziona le coppie da tracciare (filtro sugli edifici e campionamento).
+    @return: maschera booleana allineata alle coppie.
+    """
+    def seleziona(self, coppie_edificio):
+        selezione = np.ones(len(coppie_edificio), dtype=bool) if self._ammessi is None else self._ammessi[coppie_edificio]
+        if self.campionamento < 1:
+            selezione &= self._generatore.random(len(coppie_edificio)) < self.campionamento
+        if self.linee_registrate >= self.max_linee:
+            selezione[:] = False
+        return selezione
+
+    """
+    Registra un gruppo di linee di vista con lo stesso motivo (posizioni di edifici, alberi ed eventuali ostacoli nei GDF proiettati).
+    """
+    def registra(self, edifici, alberi, origini, destinazioni, angoli, motivo, ostacoli=None):
+        spazio = self.max_linee - self.linee_registrate
+        n = min(len(edifici), spazio)
+        if n <= 0:
+            return
+        self._blocchi.append({
+            'edificio_id': self._id_edifici[edifici[:n]],
+            'albero_id': self._id_alberi[alberi[:n]],
+            'origini': origini[:n],
+            'destinazioni': destinazioni[:n],
+            'angolo_deg': angoli[:n],
+            'motivo': np.full(n, motivo, dtype=object),
+            'ostacolo_id': np.full(n, None, dtype=object) if ostacoli is None else self._id_edifici[ostacoli[:n]].astype(object),
+        })
+        self.linee_registrate += n
+
+    """
+    Restituisce le linee registrate come GeoDataFrame (nel sistema metrico della regola), con le colonne dello script di debug.
+    """
+    def to_geodataframe(self):
+        colonne = ['edificio_id', 'albero_id', 'angolo_deg', 'lunghezza', 'is_ostruita', 'motivo', 'ostacolo_id']
+        if not self._blocchi:
+            return gpd.GeoDataFrame(columns=colonne, geometry=[], crs=self._crs)
+
+        origini = np.concatenate([blocco['origini'] for blocco in self._blocchi])
+        destinazioni = np.concatenate([blocco['destinazioni'] for blocco in self._blocchi])
+        motivo = np.concatenate([blocco['motivo'] for blocco in self._blocchi])
+        return gpd.GeoDataFrame({
+            'edificio_id': np.concatenate([blocco['edificio_id'] for blocco in self._blocchi]),
+            'albero_id': np.concatenate([blocco['albero_id'] for blocco in self._blocchi]),
+            'angolo_deg': np.round(np.concatenate([blocco['angolo_deg'] for blocco in self._blocchi]), 2),
+            'lunghezza': np.round(np.hypot(*(destinazioni - origini).T), 2),
+            'is_ostruita': (motivo != MOTIVO_LIBERA).astype(int),
+            'motivo': motivo,
+            'ostacolo_id': np.concatenate([blocco['ostacolo_id'] for blocco in self._blocchi]),
+        }, geometry=shapely.linestrings(np.stack([origini, destinazioni], axis=1)), crs=self._crs)
+
+    """
+    Salva le linee registrate in WGS84, come GeoParquet se il percorso termina in .parquet (richiede pyarrow), altrimenti come GeoJSON.
+    """
+    def salva(self, percorso):
+        linee = self.to_geodataframe()
+        if linee.crs is not None:
+            linee = linee.to_crs("EPSG:4326")
+        if str(percorso).endswith(".parquet"):
+            linee.to_parquet(percorso)
+        else:
+            linee.to_file(percorso, driver="GeoJSON")
+        logging.getLogger("regola3").info(f"Tracciamento regola 3: salvate {len(linee)} linee di vista in {percorso}.")
+
 """
     Funzione che verifica se la linea di vista da un albero a un edificio è bloccata
 """
-def is_unobstructed(tree, building, all_buildings_gdf, obstacles_idx):
+def is_unobstructed(tree, building, all_buildings_gdf, obstacles_idx, debuffered_obstacles=None):
 
     # trovo i punti target (i punti intermedi di ogni lato)
     try:
@@ -327,12 +504,15 @@ def is_unobstructed(tree, building, all_buildings_gdf, obstacles_idx):
             Questo infatti generava bug o blocchi inesistenti nella visuale anche per lati che dovrebbero esssere liberi.
             Il filtro angolare fatto all'inizio impedisce comunque che questo debuffer crei visuali irrealistiche attraverso i muri.
             """
-            # creo copie temporanee ridotte degli ostacoli
-            debuffed_obstacles = obstacles.copy()
-            debuffed_obstacles.geometry = debuffed_obstacles.geometry.buffer(DEBUFFER_METRI)
+            # se disponibile uso lo strato già ridotto (allineato a all_buildings_gdf), altrimenti creo copie temporanee ridotte degli ostacoli
+            if debuffered_obstacles is not None:
+                posizioni = np.asarray(possible_obstacle_idx)[possible_obstacles.index != building.name]
+                geometrie_ridotte = debuffered_obstacles.geometrie[posizioni]
+            else:
+                geometrie_ridotte = obstacles.geometry.buffer(DEBUFFER_METRI).values
 
             # intersect ritorna true se c'è intersezione con gli ostacoli
-            if not debuffed_obstacles.geometry.intersects(line_of_sight).any():
+            if not shapely.intersects(geometrie_ridotte, line_of_sight).any():
                 return True
 
         # se il ciclo finisce, nessuna linea è passata, dunque l'albero è ostruito.
@@ -340,4 +520,471 @@ def is_unobstructed(tree, building, all_buildings_gdf, obstacles_idx):
         
     except Exception as e:
         # errore generico
-        return False
\ No newline at end of file
+        return False
+
+"""
+    Genera in un'unica chiamata tutte le coppie candidate edificio-albero entro view_buffer metri.
+    Prima, per ogni edificio, si costruiva un buffer di 45 metri, si interrogava l'indice con i suoi bounds
+    e si rifiniva con within(buffer) sul sottoinsieme: un poligono e un giro Python per edificio.
+    Ora l'indice spaziale degli alberi viene interrogato con tutti gli edifici insieme con il predicato "dwithin" (distanza esatta).
+    Per gli alberi non puntiformi (filari) mantengo il criterio precedente, cioè l'intero filare dentro il buffer dell'edificio,
+    costruendo i buffer solo per le poche coppie interessate.
+    @return: (coppie_edificio, coppie_albero), array di posizioni in edifici_proj e alberi_proj ordinati per edificio.
+"""
+def _coppie_edificio_albero(edifici_proj, alberi_proj):
+
+    geom_edifici = np.asarray(edifici_proj.geometry.values)
+    geom_alberi = np.asarray(alberi_proj.geometry.values)
+
+    coppie_edificio, coppie_albero = alberi_proj.sindex.query(geom_edifici, predicate="dwithin", distance=view_buffer)
+
+    #rifinitura dei soli alberi non puntiformi
+    non_puntuali = np.flatnonzero(shapely.get_type_id(geom_alberi[coppie_albero]) != shapely.GeometryType.POINT)
+    if len(non_puntuali) > 0:
+        buffers = shapely.buffer(geom_edifici[coppie_edificio[non_puntuali]], view_buffer)
+        dentro = shapely.contains(buffers, geom_alberi[coppie_albero[non_puntuali]])
+        tieni = np.ones(len(coppie_edificio), dtype=bool)
+        tieni[non_puntuali[~dentro]] = False
+        coppie_edificio = coppie_edificio[tieni]
+        coppie_albero = coppie_albero[tieni]
+
+    return coppie_edificio, coppie_albero
+
+"""
+    Motore vettoriale della linea di vista, equivalente al doppio ciclo edifici/alberi con is_unobstructed.
+    Lavora su array invece che su singole righe dei GDF:
+        1. accoppiamento edificio-albero: un'unica query "dwithin" sull'indice spaziale degli alberi (_coppie_edificio_albero);
+        2. se presente, consultazione della cache persistente di visibilità: le coppie già note e invariate non vengono ricalcolate;
+        3. calcolo della visibilità delle coppie rimanenti (_visibilita_coppie), in serie o a tile su più processi;
+        4. scrittura dei nuovi esiti in cache e raggruppamento degli alberi visibili per edificio.
+    @param cache: istanza di CacheVisibilita (opzionale); richiede la colonna 'id' sia negli edifici che negli alberi.
+        Gli esiti salvati sono quelli del metodo delle linee di vista, quindi con il metodo isovista la cache non viene usata.
+    @param metodo: chiave di _MOTORI con la funzione di calcolo della visibilità delle coppie
+    @param limite: numero di alberi visibili oltre il quale un edificio non viene più testato (None = tutti gli alberi)
+    @param traccia: TracciaLineeVista opzionale, passata al motore delle linee
+    @return: lista (allineata posizionalmente a edifici_proj) di array con le posizioni degli alberi visibili in alberi_proj, ordinate.
+"""
+def _calcola_alberi_visibili(edifici_proj, alberi_proj, processi=1, dimensione_tile=DIMENSIONE_TILE, cache=None, metodo=METODO_LINEE, limite=None, traccia=None):
+
+    logger = logging.getLogger("regola3")
+    n_edifici = len(edifici_proj)
+    if n_edifici == 0 or alberi_proj.empty:
+        return [np.empty(0, dtype=np.intp) for _ in range(n_edifici)]
+
+    #tabella delle coppie candidate edificio-albero, come array di posizioni
+    coppie_edificio, coppie_albero = _coppie_edificio_albero(edifici_proj, alberi_proj)
+    visibile = np.zeros(len(coppie_edificio), dtype=bool)
+    da_calcolare = np.ones(len(coppie_edificio), dtype=bool)
+
+    if traccia is not None and metodo != METODO_LINEE:
+        logger.info("Tracciamento delle linee di vista non disponibile con il metodo isovista.")
+        traccia = None
+    if traccia is not None:
+        traccia.inizia(edifici_proj, alberi_proj)
+        processi = 1
+
+    if cache is not None and metodo != METODO_LINEE:
+        logger.info("Cache di visibilità non utilizzata con il metodo isovista.")
+        cache = None
+
+    #senza id stabili non posso chiavare la cache
+    if cache is not None and not ('id' in edifici_proj.columns and 'id' in alberi_proj.columns):
+        logger.info("Cache di visibilità non utilizzabile: colonna 'id' mancante negli edifici o negli alberi.")
+        cache = None
+
+    if cache is not None and len(coppie_edificio) > 0:
+        try:
+            id_edifici = edifici_proj['id'].astype(str).to_numpy()[coppie_edificio]
+            id_alberi = alberi_proj['id'].astype(str).to_numpy()[coppie_albero]
+            firme = calcola_firme(edifici_proj, alberi_proj, coppie_edificio, coppie_albero)
+            noti, esiti = cache.leggi(id_edifici, id_alberi, firme)
+            if traccia is not None:
+                noti &= ~traccia.filtrate(coppie_edificio)
+            visibile[noti] = esiti[noti]
+            da_calcolare = ~noti
+        except Exception as e:
+            logger.warning(f"Errore nella lettura della cache di visibilità: {e}. Calcolo tutte le coppie.")
+            cache = None
+
+    ostacoli = OstacoliDebufferizzati(edifici_proj) if processi <= 1 else None
+
+    """
+    Senza limite calcolo tutte le coppie rimaste in un solo passaggio. Con il limite (modalità "solo conformità") procedo a turni:
+    le coppie di ogni edificio sono ordinate per distanza (gli alberi più vicini sono i più probabilmente visibili) e a ogni turno
+    calcolo le successive, con un numero per edificio che raddoppia; gli edifici che hanno già raggiunto il limite escono dal calcolo.
+    """
+    calcolate = np.zeros(len(coppie_edificio), dtype=bool)
+    if limite is None:
+        turni = [da_calcolare]
+    else:
+        rango = _rango_per_distanza(edifici_proj, alberi_proj, coppie_edificio, coppie_albero, da_calcolare)
+        turni = []
+        inizio_turno, fine_turno = 0, limite
+        while inizio_turno <= rango.max(initial=-1):
+            turni.append((rango >= inizio_turno) & (rango < fine_turno))
+            inizio_turno, fine_turno = fine_turno, fine_turno * 2
+
+    for turno in turni:
+        selezione = turno
+        if limite is not None:
+            conteggio = np.bincount(coppie_edificio[visibile], minlength=n_edifici)
+            selezione = turno & (conteggio[coppie_edificio] < limite)
+        if not selezione.any():
+            continue
+
+        calcolo_edificio = coppie_edificio[selezione]
+        calcolo_albero = coppie_albero[selezione]
+        if processi > 1:
+            visibile[selezione] = _visibilita_coppie_parallelo(
+                edifici_proj, alberi_proj, calcolo_edificio, calcolo_albero, processi, dimensione_tile, metodo)
+        elif traccia is not None:
+            visibile[selezione] = _visibilita_coppie(edifici_proj, alberi_proj, ostacoli, calcolo_edificio, calcolo_albero, traccia)
+        else:
+            visibile[selezione] = _MOTORI[metodo](edifici_proj, alberi_proj, ostacoli, calcolo_edificio, calcolo_albero)
+        calcolate |= selezione
+
+    if cache is not None:
+        try:
+            cache.scrivi(id_edifici[calcolate], id_alberi[calcolate], firme[calcolate], visibile[calcolate])
+            statistiche = cache.statistiche()
+            logger.info(f"Cache di visibilità: hit rate {statistiche['hit_rate']:.1%} ({statistiche['hit']} hit, {statistiche['miss']} miss, {statistiche['voci']} voci).")
+        except Exception as e:
+            logger.warning(f"Errore nella scrittura della cache di visibilità: {e}")
+
+    return _raggruppa_per_edificio(n_edifici, coppie_edificio[visibile], coppie_albero[visibile])
+
+"""
+    Calcolo vettoriale della visibilità di un insieme di coppie edificio-albero.
+    Espande le coppie sui lati dell'edificio (TabellaFacciate) ottenendo le terne (edificio, albero, lato), applica
+    filtro angolare e filtro sulla lunghezza della linea di vista, poi il controllo di auto-occlusione (crosses)
+    e degli ostacoli (intersects con gli edifici debufferizzati) in blocco.
+    Un albero è visibile da un edificio se almeno uno dei lati supera tutti i controlli, come nella versione iterativa.
+    Le coppie vengono elaborate a blocchi di BLOCCO_COPPIE per non far esplodere la memoria su poligoni grandi.
+    @param ostacoli: strato OstacoliDebufferizzati degli edifici che possono ostruire la vista
+    @param traccia: TracciaLineeVista opzionale (già collegata con inizia) in cui registrare le linee di vista delle coppie selezionate
+    @return: array booleano allineato alle coppie, True se l'albero è visibile dall'edificio.
+"""
+def _visibilita_coppie(edifici_proj, alberi_proj, ostacoli, coppie_edificio, coppie_albero, traccia=None):
+
+    visibile = np.zeros(len(coppie_edificio), dtype=bool)
+    if len(coppie_edificio) == 0:
+        return visibile
+
+    geom_edifici = np.asarray(edifici_proj.geometry.values)
+    geom_alberi = np.asarray(alberi_proj.geometry.values)
+    etichette_edifici = edifici_proj.index.to_numpy()
+
+    #coordinate dei centroidi degli alberi (origine delle linee di vista)
+    centroidi_alberi = shapely.get_coordinates(shapely.centroid(geom_alberi))
+
+    #tabella dei lati costruita una volta sola e condivisa da tutti gli alberi candidati
+    facciate = TabellaFacciate(geom_edifici)
+
+    #il lato è "frontale" se l'angolo con la vista è tra 90-MAX_ANGLE_DEG e 90+MAX_ANGLE_DEG, cioè |cos| <= cos(90-MAX_ANGLE_DEG)
+    soglia_coseno = np.cos(np.radians(90 - MAX_ANGLE_DEG))
+
+    for inizio in range(0, len(coppie_edificio), BLOCCO_COPPIE):
+        blocco_edificio = coppie_edificio[inizio:inizio + BLOCCO_COPPIE]
+        blocco_albero = coppie_albero[inizio:inizio + BLOCCO_COPPIE]
+
+        #espando ogni coppia su tutti i lati del suo edificio, ottenendo le terne (coppia, lato)
+        ripetizioni = facciate.numero[blocco_edificio]
+        terna_coppia = np.repeat(np.arange(len(blocco_edificio)), ripetizioni)
+        if len(terna_coppia) == 0:
+            continue
+        scostamento = np.arange(len(terna_coppia)) - np.repeat(np.cumsum(ripetizioni) - ripetizioni, ripetizioni)
+        terna_lato = np.repeat(facciate.primo[blocco_edificio], ripetizioni) + scostamento
+
+        #vettore della vista (dal punto medio del lato al centroide dell'albero)
+        punto_medio = facciate.punto_medio[terna_lato]
+        albero = centroidi_alberi[blocco_albero[terna_coppia]]
+        view_vector = albero - punto_medio
+        norm_view = np.hypot(view_vector[:, 0], view_vector[:, 1])
+
+        #filtro angolare con un solo prodotto scalare contro la direzione unitaria del lato, e filtro sulla lunghezza della linea di vista
+        proiezione = np.einsum('ij,ij->i', facciate.direzione[terna_lato], view_vector)
+        validi = (norm_view > 0) & (norm_view <= view_buffer) & (np.abs(proiezione) <= soglia_coseno * norm_view)
+
+        #tracciamento: angolo di ogni linea con il lato (come nello script di debug) e linee frontali ma oltre il buffer
+        if traccia is not None:
+            tracciata = traccia.seleziona(blocco_edificio)[terna_coppia]
+            angolo = np.degrees(np.arccos(np.clip(proiezione / np.where(norm_view > 0, norm_view, 1), -1, 1)))
+            oltre = tracciata & (norm_view > view_buffer) & (np.abs(proiezione) <= soglia_coseno * norm_view)
+            traccia.registra(blocco_edificio[terna_coppia[oltre]], blocco_albero[terna_coppia[oltre]],
+                             albero[oltre], punto_medio[oltre], angolo[oltre], MOTIVO_OLTRE_BUFFER)
+            tracciata = tracciata[validi]
+            angolo = angolo[validi]
+
+        terna_coppia = terna_coppia[validi]
+        if len(terna_coppia) == 0:
+            continue
+        albero = albero[validi]
+        punto_medio = punto_medio[validi]
+        lunghezza = norm_view[validi]
+        terna_edificio = blocco_edificio[terna_coppia]
+
+        """
+        Auto-occlusione: la linea dall'albero a un punto staccato di 0.1m dal muro non deve attraversare l'edificio stesso
+        (stesso controllo di is_unobstructed, vedi commento relativo).
+        """
+        distanza_check = np.maximum(0, lunghezza - 0.1)
+        punto_vicino = albero + (punto_medio - albero) * (distanza_check / lunghezza)[:, None]
+        linee_check = shapely.linestrings(np.stack([albero, punto_vicino], axis=1))
+        validi = ~shapely.crosses(linee_check, geom_edifici[terna_edificio])
+
+        if traccia is not None:
+            auto = tracciata & ~validi
+            traccia.registra(terna_edificio[auto], blocco_albero[terna_coppia[auto]],
+                             albero[auto], punto_medio[auto], angolo[auto], MOTIVO_AUTO_OSTRUZIONE)
+            tracciata = tracciata[validi]
+            angolo = angolo[validi]
+
+        terna_coppia = terna_coppia[validi]
+        if len(terna_coppia) == 0:
+            continue
+        terna_edificio = terna_edificio[validi]
+        linee_vista = shapely.linestrings(np.stack([albero[validi], punto_medio[validi]], axis=1))
+
+        """
+        Ostacoli: interrogo l'indice dello strato debufferizzato (costruito una sola volta) con tutte le linee di vista insieme,
+        escludo l'edificio di partenza (confronto sull'etichetta dell'indice come nella versione iterativa)
+        e verifico l'intersezione con le geometrie preparate degli ostacoli.
+        """
+        linea, ostacolo = ostacoli.albero.query(linee_vista)
+        altri = ostacoli.etichette[ostacolo] != etichette_edifici[terna_edificio[linea]]
+        linea = linea[altri]
+        ostacolo = ostacolo[altri]
+        bloccata = np.zeros(len(linee_vista), dtype=bool)
+        colpito = shapely.intersects(ostacoli.geometrie[ostacolo], linee_vista[linea])
+        bloccata[linea[colpito]] = True
+
+        if traccia is not None:
+            #per le linee ostruite riporto il primo ostacolo trovato
+            primo_ostacolo = np.full(len(linee_vista), -1, dtype=np.intp)
+            primo_ostacolo[linea[colpito][::-1]] = ostacolo[colpito][::-1]
+            estremi = shapely.get_coordinates(linee_vista).reshape(-1, 2, 2)
+            for esito, motivo in ((bloccata, MOTIVO_OSTACOLO), (~bloccata, MOTIVO_LIBERA)):
+                scelte = tracciata & esito
+                traccia.registra(terna_edificio[scelte], blocco_albero[terna_coppia[scelte]], estremi[scelte, 0], estremi[scelte, 1],
+                                 angolo[scelte], motivo, primo_ostacolo[scelte] if motivo == MOTIVO_OSTACOLO else None)
+
+        #una coppia è visibile se almeno uno dei suoi lati ha la linea di vista libera
+        visibile[inizio + terna_coppia[~bloccata]] = True
+
+    return visibile
+
+"""
+    Rango di ogni coppia da calcolare tra le coppie dello stesso edificio, ordinate per distanza edificio-albero crescente.
+    Le coppie escluse dal calcolo ricevono rango -1.
+"""
+def _rango_per_distanza(edifici_proj, alberi_proj, coppie_edificio, coppie_albero, da_calcolare):
+    rango = np.full(len(coppie_edificio), -1, dtype=np.intp)
+    indici = np.flatnonzero(da_calcolare)
+    if len(indici) == 0:
+        return rango
+    distanze = shapely.distance(
+        np.asarray(edifici_proj.geometry.values)[coppie_edificio[indici]],
+        np.asarray(alberi_proj.geometry.values)[coppie_albero[indici]]
+    )
+    ordine = indici[np.lexsort((distanze, coppie_edificio[indici]))]
+    edificio_ordinato = coppie_edificio[ordine]
+    primo_del_gruppo = np.searchsorted(edificio_ordinato, edificio_ordinato)
+    rango[ordine] = np.arange(len(ordine)) - primo_del_gruppo
+    return rango
+
+"""
+    Ordina le coppie visibili per edificio e poi per albero, e le divide per edificio.
+    @return: lista di n_edifici array con le posizioni degli alberi visibili.
+"""
+def _raggruppa_per_edificio(n_edifici, visibili_edificio, visibili_albero):
+    ordine = np.lexsort((visibili_albero, visibili_edificio))
+    visibili_edificio = visibili_edificio[ordine]
+    visibili_albero = visibili_albero[ordine]
+    confini = np.searchsorted(visibili_edificio, np.arange(n_edifici + 1))
+    return [visibili_albero[confini[i]:confini[i + 1]] for i in range(n_edifici)]
+
+"""
+    Modalità parallela della regola 3 per poligoni grandi.
+    Gli edifici vengono divisi in tile quadrate di lato dimensione_tile in base al centroide; ogni tile riceve, oltre ai propri edifici,
+    un alone di view_buffer metri attorno ai loro bounds con gli alberi e gli edifici ostacolo che vi ricadono.
+    L'alone è sufficiente perché ogni albero candidato dista al massimo view_buffer metri dall'edificio, quindi anche le linee di vista
+    (e gli ostacoli che le intersecano) restano al suo interno: il risultato coincide esattamente con quello seriale.
+    Le tile, con le rispettive coppie da calcolare, vengono elaborate in un ProcessPoolExecutor e i risultati riportati alle coppie originali.
+    @return: stessa struttura di _visibilita_coppie.
+"""
+def _visibilita_coppie_parallelo(edifici_proj, alberi_proj, coppie_edificio, coppie_albero, processi, dimensione_tile, metodo=METODO_LINEE):
+
+    logger = logging.getLogger("regola3")
+    visibile = np.zeros(len(coppie_edificio), dtype=bool)
+
+    geom_edifici = np.asarray(edifici_proj.geometry.values)
+    bounds_edifici = shapely.bounds(geom_edifici)
+
+    #assegno ogni edificio alla tile che contiene il suo centroide
+    centroidi = shapely.get_coordinates(shapely.centroid(geom_edifici))
+    chiavi_tile = np.floor(centroidi / dimensione_tile).astype(np.int64)
+    _, tile_di = np.unique(chiavi_tile, axis=0, return_inverse=True)
+    tile_di = tile_di.ravel()
+    n_tile = tile_di.max() + 1
+
+    #con una sola tile non ha senso pagare l'avvio dei processi
+    if n_tile == 1:
+        return _MOTORI[metodo](edifici_proj, alberi_proj, OstacoliDebufferizzati(edifici_proj), coppie_edificio, coppie_albero)
+
+    logger.info(f"Regola 3 in modalità parallela: {n_tile} tile su {processi} processi.")
+
+    #posizione di ogni edificio all'interno della propria tile
+    posizione_locale = np.empty(len(geom_edifici), dtype=np.intp)
+    tile_coppia = tile_di[coppie_edificio]
+
+    lavori = []
+    for tile in range(n_tile):
+        indici_coppie = np.flatnonzero(tile_coppia == tile)
+        if len(indici_coppie) == 0:
+            continue
+        pos_edifici = np.flatnonzero(tile_di == tile)
+        posizione_locale[pos_edifici] = np.arange(len(pos_edifici))
+
+        #alone: bounds degli edifici della tile estesi di view_buffer metri
+        minx, miny = bounds_edifici[pos_edifici, :2].min(axis=0) - view_buffer
+        maxx, maxy = bounds_edifici[pos_edifici, 2:].max(axis=0) + view_buffer
+        alone = shapely.box(minx, miny, maxx, maxy)
+        pos_alberi = np.sort(alberi_proj.sindex.query(alone))
+        pos_ostacoli = np.sort(edifici_proj.sindex.query(alone))
+
+        lavori.append((
+            indici_coppie,
+            gpd.GeoDataFrame(geometry=edifici_proj.geometry.iloc[pos_edifici]),
+            gpd.GeoDataFrame(geometry=alberi_proj.geometry.iloc[pos_alberi]),
+            gpd.GeoDataFrame(geometry=edifici_proj.geometry.iloc[pos_ostacoli]),
+            posizione_locale[coppie_edificio[indici_coppie]],
+            np.searchsorted(pos_alberi, coppie_albero[indici_coppie]),
+            metodo,
+        ))
+
+    with ProcessPoolExecutor(max_workers=processi) as executor:
+        futures = [executor.submit(_elabora_tile, *lavoro[1:]) for lavoro in lavori]
+        for lavoro, future in zip(lavori, futures):
+            visibile[lavoro[0]] = future.result()
+
+    return visibile
+
+"""
+    Elaborazione di una singola tile nel processo worker: costruisce lo strato ostacoli della tile ed esegue il motore vettoriale
+    sulle coppie (in posizioni locali alla tile) da calcolare.
+"""
+def _elabora_tile(edifici_tile, alberi_tile, ostacoli_tile, coppie_edificio, coppie_albero, metodo):
+    return _MOTORI[metodo](edifici_tile, alberi_tile, OstacoliDebufferizzati(ostacoli_tile), coppie_edificio, coppie_albero)
+
+"""
+    Metodo alternativo della regola 3 basato sulle isoviste (poligoni di visibilità).
+    Il metodo delle linee di vista costruisce una linea e interroga gli ostacoli per ogni terna albero-lato, quindi scala come
+    alberi x lati x ostacoli. Qui invece, per ogni lato che ha almeno un albero candidato davanti a sé:
+        1. si lanciano raggi ogni PASSO_ISOVISTA_DEG gradi dal punto medio del lato, nel cono di ±MAX_ANGLE_DEG attorno alla normale
+            esterna e lunghi view_buffer metri (lo stesso vincolo del filtro angolare e della lunghezza della linea di vista);
+        2. ogni raggio si ferma al primo ostacolo: gli altri edifici debufferizzati oppure l'edificio stesso (a partire da 0.1m dal muro,
+            come nel controllo di auto-occlusione); le estremità dei raggi formano l'isovista del lato;
+        3. tutti gli alberi candidati vengono testati in blocco con un unico point-in-polygon vettoriale (shapely.intersects_xy).
+    Il risultato è un'approssimazione del metodo delle linee (dipende dalla risoluzione angolare dei raggi): conviene con molti alberi
+    per lato, ad esempio nei viali alberati o con i dati YOLO densi.
+    @return: stessa struttura di _visibilita_coppie.
+"""
+def _visibilita_coppie_isovista(edifici_proj, alberi_proj, ostacoli, coppie_edificio, coppie_albero):
+
+    visibile = np.zeros(len(coppie_edificio), dtype=bool)
+    if len(coppie_edificio) == 0:
+        return visibile
+
+    geom_edifici = np.asarray(edifici_proj.geometry.values)
+    etichette_edifici = edifici_proj.index.to_numpy()
+    centroidi_alberi = shapely.get_coordinates(shapely.centroid(np.asarray(alberi_proj.geometry.values)))
+    facciate = TabellaFacciate(geom_edifici)
+
+    """
+    Normale esterna di ogni lato: per un anello antiorario l'interno dell'edificio è a sinistra della direzione del lato,
+    quindi l'esterno è a destra (dy, -dx). Il lato interno del cono porterebbe sempre attraverso l'edificio (auto-occlusione).
+    """
+    antiorario = shapely.is_ccw(shapely.get_exterior_ring(geom_edifici))[facciate.edificio]
+    verso = np.where(antiorario, 1.0, -1.0)[:, None]
+    normale = np.column_stack([facciate.direzione[:, 1], -facciate.direzione[:, 0]]) * verso
+
+    #terne (coppia, lato) e filtro sul cono esterno: angolo con la normale <= MAX_ANGLE_DEG e distanza <= view_buffer
+    ripetizioni = facciate.numero[coppie_edificio]
+    terna_coppia = np.repeat(np.arange(len(coppie_edificio)), ripetizioni)
+    if len(terna_coppia) == 0:
+        return visibile
+    scostamento = np.arange(len(terna_coppia)) - np.repeat(np.cumsum(ripetizioni) - ripetizioni, ripetizioni)
+    terna_lato = np.repeat(facciate.primo[coppie_edificio], ripetizioni) + scostamento
+
+    albero = centroidi_alberi[coppie_albero[terna_coppia]]
+    view_vector = albero - facciate.punto_medio[terna_lato]
+    norm_view = np.hypot(view_vector[:, 0], view_vector[:, 1])
+    frontale = np.einsum('ij,ij->i', normale[terna_lato], view_vector) >= np.cos(np.radians(MAX_ANGLE_DEG)) * norm_view
+    validi = (norm_view > 0) & (norm_view <= view_buffer) & frontale
+    terna_coppia = terna_coppia[validi]
+    terna_lato = terna_lato[validi]
+    albero = albero[validi]
+
+    #costruisco le isoviste solo per i lati con almeno un albero candidato nel cono
+    lati_utili, terna_isovista = np.unique(terna_lato, return_inverse=True)
+    isoviste = np.empty(len(lati_utili), dtype=object)
+    for inizio in range(0, len(lati_utili), BLOCCO_FACCIATE):
+        blocco = lati_utili[inizio:inizio + BLOCCO_FACCIATE]
+        isoviste[inizio:inizio + len(blocco)] = _costruisci_isoviste(
+            facciate.punto_medio[blocco], normale[blocco], facciate.edificio[blocco], geom_edifici, etichette_edifici, ostacoli)
+
+    #point-in-polygon vettoriale di tutti gli alberi candidati contro l'isovista del rispettivo lato
+    dentro = shapely.intersects_xy(isoviste[terna_isovista], albero[:, 0], albero[:, 1])
+    visibile[terna_coppia[dentro]] = True
+
+    return visibile
+
+"""
+    Costruisce le isoviste di un blocco di lati con il lancio di raggi (vedi _visibilita_coppie_isovista).
+    @return: array di poligoni shapely, uno per lato.
+"""
+def _costruisci_isoviste(punti_medi, normali, edificio_di, geom_edifici, etichette_edifici, ostacoli):
+
+    n_lati = len(punti_medi)
+    angoli = np.radians(np.arange(-MAX_ANGLE_DEG, MAX_ANGLE_DEG + PASSO_ISOVISTA_DEG / 2, PASSO_ISOVISTA_DEG))
+    n_raggi = len(angoli)
+
+    #direzioni dei raggi (n_lati x n_raggi), ruotando la normale esterna di ogni angolo del cono
+    theta = np.arctan2(normali[:, 1], normali[:, 0])[:, None] + angoli[None, :]
+    direzioni = np.stack([np.cos(theta), np.sin(theta)], axis=-1).reshape(-1, 2)
+    origini = np.repeat(punti_medi, n_raggi, axis=0)
+    raggio_edificio = np.repeat(edificio_di, n_raggi)
+    portata = np.full(len(origini), float(view_buffer))
+
+    raggi = shapely.linestrings(np.stack([origini, origini + direzioni * view_buffer], axis=1))
+
+    #primo impatto con gli altri edifici debufferizzati (escluso l'edificio di partenza)
+    raggio, ostacolo = ostacoli.albero.query(raggi, predicate="intersects")
+    altri = ostacoli.etichette[ostacolo] != etichette_edifici[raggio_edificio[raggio]]
+    raggio = raggio[altri]
+    ostacolo = ostacolo[altri]
+    if len(raggio) > 0:
+        impatti = shapely.intersection(raggi[raggio], ostacoli.geometrie[ostacolo])
+        distanze = shapely.distance(shapely.points(origini[raggio]), impatti)
+        np.minimum.at(portata, raggio, distanze)
+
+    #auto-occlusione: il raggio, a partire da 0.1m dal muro, non deve rientrare nell'edificio stesso (edifici concavi)
+    partenze = origini + direzioni * 0.1
+    raggi_esterni = shapely.linestrings(np.stack([partenze, origini + direzioni * view_buffer], axis=1))
+    edificio_raggio = geom_edifici[raggio_edificio]
+    rientra = np.flatnonzero(shapely.intersects(edificio_raggio, raggi_esterni))
+    if len(rientra) > 0:
+        impatti = shapely.intersection(raggi_esterni[rientra], edificio_raggio[rientra])
+        distanze = 0.1 + shapely.distance(shapely.points(partenze[rientra]), impatti)
+        np.minimum.at(portata, rientra, distanze)
+
+    #le estremità dei raggi, precedute e seguite dal punto medio del lato, formano il poligono (stellato rispetto al punto medio)
+    estremi = (origini + direzioni * portata[:, None]).reshape(n_lati, n_raggi, 2)
+    anelli = np.concatenate([punti_medi[:, None, :], estremi, punti_medi[:, None, :]], axis=1)
+    return shapely.polygons(anelli)
+
+#funzioni di calcolo della visibilità delle coppie per ogni metodo
+_MOTORI = {
+    METODO_LINEE: _visibilita_coppie,
+    METODO_ISOVISTA: _visibilita_coppie_isovista,
+}
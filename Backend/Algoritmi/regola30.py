@@ -42,7 +42,9 @@ import geopandas as gpd
 from shapely.ops import unary_union
 import pandas as pd
 import logging
+import math
 import numpy as np
+import shapely
 
 #logger globale
 logger = logging.getLogger("regola30")
@@ -51,17 +53,45 @@ logger.addHandler(logging.NullHandler())
 #costante che rappresenta il raggio in metri da considerare per ogni albero puntiforme
 TREE_RADIUS = 2  # metri
 
+#metodi di calcolo dell'area arborea: vettoriale (cerchi e poligoni ritagliati) oppure raster (bitmap dell'area di studio)
+METODO_VETTORIALE = "vettoriale"
+METODO_RASTER = "raster"
+
+#lato dei pixel in metri del metodo raster e numero massimo di pixel per striscia (limita la memoria su aree grandi)
+RISOLUZIONE_RASTER = 0.5
+MAX_PIXEL_STRISCIA = 4_000_000
+
+#griglia di copertura (heatmap): lato delle celle in metri (di default e minimo), numero massimo di celle, sottodivisioni per lato
+#usate per rasterizzare boschi e area di studio (al più), e formati del risultato (array compatto oppure celle GeoJSON)
+LATO_CELLA_GRIGLIA = 50
+LATO_CELLA_MINIMO = 10
+MAX_CELLE_GRIGLIA = 250_000
+SUDDIVISIONI_CELLA = 10
+FORMATO_ARRAY = "array"
+FORMATO_GEOJSON = "geojson"
+
 """
     Funzione che calcola la percentuale di copertura arborea per una data area.
+    @param metodo: METODO_VETTORIALE (default, area dei cerchi degli alberi + poligoni ritagliati) oppure METODO_RASTER
+        (chiome e boschi rasterizzati in una bitmap dell'area di studio, senza doppi conteggi delle chiome sovrapposte)
+    @param risoluzione: lato in metri dei pixel per il metodo raster (default RISOLUZIONE_RASTER)
+    @param dettagli: se True restituisce un dizionario con percentuale, metodo, area arborea, area di studio e, per il metodo raster:
+            - 'limite_discretizzazione': limite analitico in punti percentuali dell'errore dovuto ai pixel (pixel coperti sul bordo
+                della copertura per l'area del pixel, vedi calculate_trees_area_raster);
+            - 'errore_percentuale': scarto reale in punti percentuali dal metodo vettoriale (riferimento in 'riferimento_errore'),
+                che comprende la discretizzazione e le chiome sovrapposte, contate più volte dal vettoriale e una sola dal raster;
+                per ottenerlo viene eseguito anche il metodo vettoriale, quindi solo con dettagli;
+        tutti None per il metodo vettoriale. Altrimenti solo la percentuale, come in precedenza
+    La griglia di copertura per la heatmap non fa parte di questa funzione: il server la chiede a calcola_griglia_copertura.
 """
-def run_rule_30(edifici, alberi, polygon_gdf):
+def run_rule_30(edifici, alberi, polygon_gdf, metodo=METODO_VETTORIALE, risoluzione=RISOLUZIONE_RASTER, dettagli=False):
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("regola30")
 
     #controllo input
     if edifici.empty or alberi.empty or polygon_gdf.empty:
         logger.warning("Dati insufficienti per il calcolo. Assicurati che i GeoDataFrame non siano vuoti.")
-        return 0.0
+        return _risultato(0.0, metodo, dettagli)
 
     try:
         #proiezione in sistema metrico degli input
@@ -78,10 +108,22 @@ def run_rule_30(edifici, alberi, polygon_gdf):
         area_totale = polygon_proj.geometry.area.sum()
         if area_totale == 0:
             logger.warning("L'area totale della zona di studio è 0.")
-            return 0.0
+            return _risultato(0.0, metodo, dettagli)
 
         #calcolo dell'area totale coperta dagli alberi
-        trees_total_area = calculate_trees_area(alberi_proj, polygon_proj)
+        errore_area = None
+        area_bordo = None
+        if metodo == METODO_RASTER:
+            #limite di discretizzazione e scarto reale dal metodo vettoriale (un secondo calcolo completo) solo se richiesti i dettagli
+            if dettagli:
+                trees_total_area, area_bordo = calculate_trees_area_raster(alberi_proj, polygon_proj, risoluzione, bordo=True)
+                errore_area = trees_total_area - calculate_trees_area(alberi_proj, polygon_proj)
+                logger.info(f"Copertura raster ({risoluzione} m): {trees_total_area:.0f} m2, discretizzazione entro {area_bordo:.0f} m2, "
+                            f"scarto {errore_area:+.0f} m2 dal metodo vettoriale.")
+            else:
+                trees_total_area = calculate_trees_area_raster(alberi_proj, polygon_proj, risoluzione)
+        else:
+            trees_total_area = calculate_trees_area(alberi_proj, polygon_proj)
 
         #calcolo dell'area totale di foreste e boschi
 
@@ -93,9 +135,30 @@ def run_rule_30(edifici, alberi, polygon_gdf):
 
     except Exception as e:
         logger.error(f"Errore nel calcolo della copertura arborea: {e}")
-        return 0.0
+        return _risultato(0.0, metodo, dettagli)
+
+    if not dettagli:
+        return percentage
 
-    return percentage
+    return _risultato(percentage, metodo, dettagli, trees_total_area, area_totale,
+                      None if errore_area is None else errore_area / area_totale * 100,
+                      None if area_bordo is None else area_bordo / area_totale * 100)
+
+"""
+    Risultato di run_rule_30: la sola percentuale, oppure il dizionario dei dettagli se richiesto.
+"""
+def _risultato(percentuale, metodo, dettagli, area_alberi=0.0, area_totale=0.0, errore_percentuale=None, limite_discretizzazione=None):
+    if not dettagli:
+        return percentuale
+    return {
+        'percentuale': percentuale,
+        'metodo': metodo,
+        'area_alberi': area_alberi,
+        'area_totale': area_totale,
+        'limite_discretizzazione': limite_discretizzazione,
+        'errore_percentuale': errore_percentuale,
+        'riferimento_errore': None if errore_percentuale is None else METODO_VETTORIALE,
+    }
 
 #Esempio di utilizzo singolo dell'algoritmo
 """edifici = gpd.read_file("./INPUT/Edifici.geojson")
@@ -105,44 +168,301 @@ print(run_rule_30(edifici, alberi))"""
 """
     Funzione ausiliaria per calcolare l'area totale coperta dagli alberi interni al poligono di studio.
     Esegue un ritaglio dei dati degli alberi in base alla tipologia di appartenenza geometrica:
-        gli alberi, considerati punti inizialmente, vengono considerati anche se sono parzialmente all'interno del poligono di studio;
+        gli alberi, considerati punti inizialmente, vengono considerati se sono all'interno del poligono di studio;
         i poligoni (boschi, foreste) vengono considerati rispetto all'effettiva loro parte che ricade all'interno del poligono di studio (clip).
+    Prima il ritaglio (gpd.clip) veniva eseguito su tutti gli alberi, e i punti venivano poi testati di nuovo con within sull'intera tabella.
+    Ora l'indice spaziale degli alberi divide gli elementi in tre gruppi con un solo passaggio:
+        - esterni: non intersecano l'area di studio e vengono scartati senza test geometrici (query sull'indice);
+        - interni: completamente contenuti (test contains sulla geometria preparata dell'area), non serve ritagliarli;
+        - di bordo: attraversano il confine, solo questi vengono ritagliati (intersection).
+    Conta soprattutto per la query degli alberi gonfiata di 45 metri, che porta dentro grandi relazioni boschive.
     Restituisce l'area totale coperta dagli alberi (in metri quadrati).
 """
 def calculate_trees_area(alberi, area):
 
     try:
 
-        #ritaglia i GDF degli alberi; i punti sono automaticamente inclusi, mentre i poligoni vengono ritagliati
-        alberi_in_area = gpd.clip(alberi, area)
+        #unione dell'area di studio, preparata per i test di contenimento ripetuti
+        area_studio = shapely.union_all(np.asarray(area.geometry.values))
+        shapely.prepare(area_studio)
+
+        #elementi che intersecano l'area di studio (gli esterni restano fuori dalla query) e, tra questi, quelli interamente contenuti
+        geometrie = np.asarray(alberi.geometry.values)[alberi.sindex.query(area_studio, predicate="intersects")]
+        interni = shapely.contains(area_studio, geometrie)
+        tipi = shapely.get_type_id(geometrie)
+        poligonali = (tipi == 3) | (tipi == 6)
 
-        #gestione e calcolo poligoni (boschi, foreste) ---
-        alberi_polygons = alberi_in_area[alberi_in_area.geom_type.isin(['Polygon', 'MultiPolygon'])]
-        area_from_polygons = alberi_polygons.geometry.area.sum()
+        #gestione e calcolo poligoni (boschi, foreste): area piena per gli interni, area del ritaglio solo per quelli di bordo
+        area_from_polygons = shapely.area(geometrie[poligonali & interni]).sum()
+        di_bordo = geometrie[poligonali & ~interni]
+        if len(di_bordo) > 0:
+            area_from_polygons += shapely.area(shapely.intersection(di_bordo, area_studio)).sum()
 
-        #estraggo alberi contrassegnati come punti
-        alberi_points = alberi[alberi.geom_type == 'Point']
-        
-        #se non ci sono alberi puntiformi, ritorno l'area calcolata dai poligoni
-        if alberi_points.empty:
+        #alberi contrassegnati come punti: contano solo quelli dentro l'area di studio (un punto sul bordo non è contenuto, come con within)
+        if not (tipi == 0).any():
             logger.info("Nessun albero puntiforme trovato nel dataset.")
             return area_from_polygons
+        alberi_points_in_area = np.count_nonzero((tipi == 0) & interni)
 
-        #seleziono solo gli alberi puntiformi dentro l'area di studio
-        alberi_points_in_area = alberi_points[
-            alberi_points.geometry.within(area.unary_union)
-        ]
-        
         area_from_points = 0.0
-        if not alberi_points_in_area.empty:
+        if alberi_points_in_area > 0:
             #calcolo l'area di un singolo cerchio (pi * r^2)
             area_per_tree = np.pi * (TREE_RADIUS * TREE_RADIUS)
             #moltiplico per il numero di alberi
-            area_from_points = len(alberi_points_in_area) * area_per_tree
+            area_from_points = alberi_points_in_area * area_per_tree
             
         #ritorno finale prodotto dalla somma dell'area coperta dagli alberi puntiformi e quelli poligonali
         return area_from_polygons + area_from_points
 
     except Exception as e:
         logger.error(f"Errore nel calcolo del numeratore (area arborea): {e}")
-        return 0.0
\ No newline at end of file
+        return 0.0
+
+"""
+    Metodo raster per l'area coperta dagli alberi interna al poligono di studio.
+    Il metodo vettoriale somma pi*r^2 per ogni albero puntiforme, quindi conta più volte le chiome sovrapposte (filari, parchi densi),
+    e ritaglia con gpd.clip tutti i poligoni, costoso per i grandi boschi multipoligono.
+    Qui l'area di studio viene divisa in pixel di lato risoluzione; chiome (cerchi di raggio TREE_RADIUS) e boschi vengono
+    rasterizzati per righe di scansione (scanline) direttamente in numpy, e l'area è il numero di pixel coperti e interni
+    all'area di studio per l'area del pixel. La bitmap viene elaborata a strisce di al più MAX_PIXEL_STRISCIA pixel,
+    così la memoria resta limitata anche su poligoni grandi come una città.
+    Un pixel è coperto se il suo centro cade in una chioma o in un bosco: rispetto all'unione esatta delle chiome e dei boschi
+    l'errore viene solo dai pixel attraversati da un bordo. Come limite si contano i pixel coperti con almeno un vicino (4-connessi)
+    non coperto, per l'area del pixel; vale per chiome e boschi più larghi di un pixel, e i bordi delle strisce contano come bordo.
+    Lo scarto dal metodo vettoriale viene calcolato da run_rule_30.
+    @param bordo: se True restituisce anche il limite dell'errore di discretizzazione
+    @return: area stimata in metri quadrati, oppure (area, limite dell'errore in metri quadrati) con bordo
+"""
+def calculate_trees_area_raster(alberi, area, risoluzione=RISOLUZIONE_RASTER, bordo=False):
+
+    geom_area = np.asarray(area.geometry.values)
+    xmin, ymin, xmax, ymax = area.total_bounds
+    n_colonne = max(1, math.ceil((xmax - xmin) / risoluzione))
+    n_righe = max(1, math.ceil((ymax - ymin) / risoluzione))
+
+    #alberi candidati: solo quelli il cui bounding box tocca l'area di studio (allargata del raggio della chioma)
+    finestra = shapely.box(xmin - TREE_RADIUS, ymin - TREE_RADIUS, xmax + TREE_RADIUS, ymax + TREE_RADIUS)
+    geom_alberi = np.asarray(alberi.geometry.values)[alberi.sindex.query(finestra)]
+    tipi = shapely.get_type_id(geom_alberi)
+    centri = shapely.get_coordinates(geom_alberi[tipi == 0])
+    boschi = geom_alberi[(tipi == 3) | (tipi == 6)]
+
+    spigoli_area = _spigoli_poligoni(geom_area)
+    spigoli_boschi = _spigoli_poligoni(boschi)
+
+    pixel_coperti = 0
+    pixel_bordo = 0
+    righe_per_striscia = max(1, MAX_PIXEL_STRISCIA // n_colonne)
+    for prima_riga in range(0, n_righe, righe_per_striscia):
+        righe = min(righe_per_striscia, n_righe - prima_riga)
+        griglia = (xmin, ymin, risoluzione, prima_riga, righe, n_colonne)
+
+        studio = _riempi_campi(_campi_poligoni(*spigoli_area, griglia), griglia)
+        chiome = _riempi_campi(_unisci_campi(
+            _campi_poligoni(*spigoli_boschi, griglia),
+            _campi_cerchi(centri, TREE_RADIUS, griglia)
+        ), griglia)
+        coperti = studio & chiome
+        pixel_coperti += int(np.count_nonzero(coperti))
+        if bordo:
+            interni = np.pad(coperti, 1)
+            interni = interni[:-2, 1:-1] & interni[2:, 1:-1] & interni[1:-1, :-2] & interni[1:-1, 2:]
+            pixel_bordo += int(np.count_nonzero(coperti & ~interni))
+
+    area_pixel = risoluzione * risoluzione
+    if bordo:
+        return pixel_coperti * area_pixel, pixel_bordo * area_pixel
+    return pixel_coperti * area_pixel
+
+"""
+    Griglia di copertura arborea (heatmap) sull'area di studio, senza ritagliare geometricamente ogni cella.
+    Le celle quadrate di lato lato_cella partono dall'angolo in basso a sinistra del poligono di studio (in EPSG:32632):
+        - gli alberi puntiformi interni all'area, come nel metodo vettoriale, contribuiscono pi*r^2 alla propria cella
+            con un unico binning vettoriale (np.bincount sull'indice di cella);
+        - boschi e area di studio vengono rasterizzati a SUDDIVISIONI_CELLA pixel per lato di cella con lo stesso motore a strisce
+            del metodo raster, e sommati per cella: si ottengono l'area boscata e l'area di studio effettiva di ogni cella
+            (le celle sul bordo del poligono sono solo in parte dentro l'area).
+    La copertura di una cella è (area alberi + area boschi) / area di studio della cella, limitata a 100; le celle fuori dall'area non hanno valore.
+    Le sottodivisioni per lato scendono sotto SUDDIVISIONI_CELLA quando una riga di celle non starebbe in una striscia di
+    MAX_PIXEL_STRISCIA pixel, così la memoria resta limitata anche su poligoni molto larghi.
+    @param formato: FORMATO_ARRAY restituisce un dizionario compatto (crs, origine, lato_cella, righe, colonne e la lista dei valori
+        riga per riga, dal basso verso l'alto, con None fuori dall'area); FORMATO_GEOJSON restituisce la stringa GeoJSON (EPSG:4326)
+        delle sole celle interne all'area, con la proprietà 'copertura'
+    @raise ValueError: parametri fuori dai limiti (vedi controlla_griglia_copertura)
+"""
+def calcola_griglia_copertura(alberi, polygon_gdf, lato_cella=LATO_CELLA_GRIGLIA, formato=FORMATO_ARRAY):
+
+    righe, colonne = controlla_griglia_copertura(polygon_gdf, lato_cella, formato)
+
+    alberi_proj = alberi.to_crs("EPSG:32632")
+    area = polygon_gdf.to_crs("EPSG:32632")
+    geom_area = np.asarray(area.geometry.values)
+    xmin, ymin, xmax, ymax = area.total_bounds
+
+    geom_alberi = np.asarray(alberi_proj.geometry.values)[alberi_proj.sindex.query(shapely.box(xmin, ymin, xmax, ymax))]
+    tipi = shapely.get_type_id(geom_alberi)
+
+    #alberi puntiformi interni all'area di studio, contati nella propria cella
+    unione_area = shapely.union_all(geom_area)
+    shapely.prepare(unione_area)
+    centri = shapely.get_coordinates(geom_alberi[tipi == 0])
+    centri = centri[shapely.contains_xy(unione_area, centri[:, 0], centri[:, 1])]
+    cella_x = np.clip(((centri[:, 0] - xmin) // lato_cella).astype(np.int64), 0, colonne - 1)
+    cella_y = np.clip(((centri[:, 1] - ymin) // lato_cella).astype(np.int64), 0, righe - 1)
+    area_alberi = np.bincount(cella_y * colonne + cella_x, minlength=righe * colonne).reshape(righe, colonne) * np.pi * TREE_RADIUS ** 2
+
+    #boschi e area di studio rasterizzati a sottocelle, a strisce di righe intere di celle
+    spigoli_area = _spigoli_poligoni(geom_area)
+    spigoli_boschi = _spigoli_poligoni(geom_alberi[(tipi == 3) | (tipi == 6)])
+    suddivisioni = max(1, min(SUDDIVISIONI_CELLA, math.isqrt(MAX_PIXEL_STRISCIA // colonne)))
+    risoluzione = lato_cella / suddivisioni
+    area_pixel = risoluzione * risoluzione
+    area_studio = np.zeros((righe, colonne))
+    area_boschi = np.zeros((righe, colonne))
+    celle_per_striscia = max(1, MAX_PIXEL_STRISCIA // (colonne * suddivisioni * suddivisioni))
+    for prima_cella in range(0, righe, celle_per_striscia):
+        celle = min(celle_per_striscia, righe - prima_cella)
+        griglia = (xmin, ymin, risoluzione, prima_cella * suddivisioni, celle * suddivisioni, colonne * suddivisioni)
+        forma_celle = (celle, suddivisioni, colonne, suddivisioni)
+
+        studio = _riempi_campi(_campi_poligoni(*spigoli_area, griglia), griglia)
+        boschi = _riempi_campi(_campi_poligoni(*spigoli_boschi, griglia), griglia) & studio
+        area_studio[prima_cella:prima_cella + celle] = studio.reshape(forma_celle).sum(axis=(1, 3)) * area_pixel
+        area_boschi[prima_cella:prima_cella + celle] = boschi.reshape(forma_celle).sum(axis=(1, 3)) * area_pixel
+
+    dentro = area_studio > 0
+    copertura = np.full((righe, colonne), np.nan)
+    copertura[dentro] = np.minimum((area_alberi[dentro] + area_boschi[dentro]) / area_studio[dentro] * 100, 100.0)
+
+    if formato == FORMATO_ARRAY:
+        return {
+            'crs': "EPSG:32632",
+            'origine': [float(xmin), float(ymin)],
+            'lato_cella': lato_cella,
+            'righe': righe,
+            'colonne': colonne,
+            'copertura': [None if np.isnan(valore) else round(float(valore), 2) for valore in copertura.ravel()],
+        }
+
+    riga, colonna = np.nonzero(dentro)
+    celle = shapely.box(xmin + colonna * lato_cella, ymin + riga * lato_cella,
+                        xmin + (colonna + 1) * lato_cella, ymin + (riga + 1) * lato_cella)
+    return gpd.GeoDataFrame({
+        'riga': riga,
+        'colonna': colonna,
+        'copertura': np.round(copertura[dentro], 2),
+    }, geometry=celle, crs="EPSG:32632").to_crs("EPSG:4326").to_json()
+
+"""
+    Controlla i parametri della griglia di copertura prima del calcolo: il lato arriva dal client, e celle troppo piccole
+    su un poligono grande porterebbero a milioni di celle (e di byte per cella negli accumulatori).
+    @return: (righe, colonne) della griglia
+    @raise ValueError: lato non numerico o sotto LATO_CELLA_MINIMO, formato non riconosciuto, oppure più di MAX_CELLE_GRIGLIA celle
+"""
+def controlla_griglia_copertura(polygon_gdf, lato_cella, formato=FORMATO_ARRAY):
+    if formato not in (FORMATO_ARRAY, FORMATO_GEOJSON):
+        raise ValueError(f"Formato della griglia non riconosciuto: {formato}")
+    if not (math.isfinite(lato_cella) and lato_cella >= LATO_CELLA_MINIMO):
+        raise ValueError(f"Lato delle celle non valido: {lato_cella} (minimo {LATO_CELLA_MINIMO} metri)")
+
+    xmin, ymin, xmax, ymax = polygon_gdf.to_crs("EPSG:32632").total_bounds
+    colonne = max(1, math.ceil((xmax - xmin) / lato_cella))
+    righe = max(1, math.ceil((ymax - ymin) / lato_cella))
+    if righe * colonne > MAX_CELLE_GRIGLIA:
+        raise ValueError(f"Griglia troppo fitta: {righe * colonne} celle (massimo {MAX_CELLE_GRIGLIA}), aumentare il lato delle celle")
+    return righe, colonne
+
+"""
+    Spigoli dei poligoni (anelli esterni e buchi) come array di estremi, con l'indice della parte poligonale di appartenenza.
+    Gli spigoli orizzontali non intersecano mai le righe di scansione e vengono scartati.
+"""
+def _spigoli_poligoni(geometrie):
+    parti = shapely.get_parts(geometrie)
+    parti = parti[shapely.get_type_id(parti) == 3]
+    anelli, parte_di = shapely.get_rings(parti, return_index=True)
+    vertici, anello_di = shapely.get_coordinates(anelli, return_index=True)
+
+    stesso_anello = anello_di[:-1] == anello_di[1:]
+    p1 = vertici[:-1][stesso_anello]
+    p2 = vertici[1:][stesso_anello]
+    gruppo = parte_di[anello_di[:-1][stesso_anello]]
+
+    non_orizzontali = p1[:, 1] != p2[:, 1]
+    return p1[non_orizzontali], p2[non_orizzontali], gruppo[non_orizzontali]
+
+"""
+    Righe della striscia (in coordinate locali) i cui centri cadono in [y_da, y_a), come intervallo [riga_da, riga_a).
+"""
+def _righe_intervallo(y_da, y_a, griglia):
+    x0, y0, risoluzione, prima_riga, righe, _ = griglia
+    riga_da = np.ceil((y_da - y0) / risoluzione - 0.5).astype(np.int64) - prima_riga
+    riga_a = np.ceil((y_a - y0) / risoluzione - 0.5).astype(np.int64) - prima_riga
+    return np.clip(riga_da, 0, righe), np.clip(riga_a, 0, righe)
+
+"""
+    Espande ogni intervallo [riga_da, riga_a) nelle sue righe.
+    @return: (indice dell'elemento, riga) per ogni coppia elemento-riga.
+"""
+def _espandi_righe(riga_da, riga_a):
+    numero = riga_a - riga_da
+    elemento = np.repeat(np.arange(len(numero)), numero)
+    scostamento = np.arange(len(elemento)) - np.repeat(np.cumsum(numero) - numero, numero)
+    return elemento, riga_da[elemento] + scostamento
+
+"""
+    Campi (tratti orizzontali) coperti dai poligoni nelle righe della striscia, con la regola pari-dispari per ogni parte:
+    le intersezioni degli spigoli con la riga, ordinate per x, si alternano tra ingresso e uscita (i buchi si annullano da soli).
+    @return: (riga, x iniziale, x finale) per ogni campo.
+"""
+def _campi_poligoni(p1, p2, gruppo, griglia):
+    x0, y0, risoluzione, prima_riga, _, _ = griglia
+    riga_da, riga_a = _righe_intervallo(np.minimum(p1[:, 1], p2[:, 1]), np.maximum(p1[:, 1], p2[:, 1]), griglia)
+    spigolo, riga = _espandi_righe(riga_da, riga_a)
+
+    y = y0 + (riga + prima_riga + 0.5) * risoluzione
+    a, b = p1[spigolo], p2[spigolo]
+    x = a[:, 0] + (y - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+
+    ordine = np.lexsort((x, gruppo[spigolo], riga))
+    riga, x, gruppo_ordinato = riga[ordine], x[ordine], gruppo[spigolo][ordine]
+
+    #posizione di ogni intersezione all'interno della propria coppia (riga, parte): pari = ingresso, dispari = uscita
+    nuovo_gruppo = np.ones(len(riga), dtype=bool)
+    nuovo_gruppo[1:] = (riga[1:] != riga[:-1]) | (gruppo_ordinato[1:] != gruppo_ordinato[:-1])
+    inizio_gruppo = np.maximum.accumulate(np.where(nuovo_gruppo, np.arange(len(riga)), 0))
+    ingressi = np.flatnonzero((np.arange(len(riga)) - inizio_gruppo) % 2 == 0)
+    ingressi = ingressi[ingressi + 1 < len(riga)]
+    return riga[ingressi], x[ingressi], x[ingressi + 1]
+
+"""
+    Campi coperti dai cerchi (chiome) di raggio dato nelle righe della striscia.
+"""
+def _campi_cerchi(centri, raggio, griglia):
+    x0, y0, risoluzione, prima_riga, _, _ = griglia
+    riga_da, riga_a = _righe_intervallo(centri[:, 1] - raggio, centri[:, 1] + raggio, griglia)
+    cerchio, riga = _espandi_righe(riga_da, riga_a)
+
+    dy = y0 + (riga + prima_riga + 0.5) * risoluzione - centri[cerchio, 1]
+    semi_corda = np.sqrt(np.maximum(raggio * raggio - dy * dy, 0))
+    return riga, centri[cerchio, 0] - semi_corda, centri[cerchio, 0] + semi_corda
+
+"""
+    Concatena più insiemi di campi (riga, x iniziale, x finale).
+"""
+def _unisci_campi(*insiemi):
+    return tuple(np.concatenate(valori) for valori in zip(*insiemi))
+
+"""
+    Riempie la bitmap della striscia con l'unione dei campi: ogni campo copre i pixel con il centro in [x iniziale, x finale).
+    Invece di scrivere i pixel uno per uno, somma +1/-1 agli estremi di ogni campo e fa la somma cumulativa lungo le righe.
+"""
+def _riempi_campi(campi, griglia):
+    x0, _, risoluzione, _, righe, colonne = griglia
+    riga, x_da, x_a = campi
+    colonna_da = np.clip(np.ceil((x_da - x0) / risoluzione - 0.5), 0, colonne).astype(np.int64)
+    colonna_a = np.clip(np.ceil((x_a - x0) / risoluzione - 0.5), 0, colonne).astype(np.int64)
+
+    larghezza = colonne + 1
+    differenze = np.bincount(riga * larghezza + colonna_da, minlength=righe * larghezza)
+    differenze -= np.bincount(riga * larghezza + colonna_a, minlength=righe * larghezza)
+    return np.cumsum(differenze.reshape(righe, larghezza)[:, :colonne], axis=1) > 0
@@ -16,14 +16,15 @@
     Algoritmo per il calcolo della Regola 300:
         Il programma verifica, per ogni edificio, se è presente un'area verde pubblica nel raggio di 300 metri.
         Il calcolo si basa su una "unione spaziale" tra gli edifici e le aree verdi.
-            1. Creazione del buffer: per ogni edificio, viene creato un'area di 300 metri (un "buffer"). Questo buffer rappresenta la zona di ricerca.
-            2. Unione spaziale (Spatial Join): i buffer degli edifici vengono uniti alle geometrie delle aree verdi.
-                Un edificio supera il test se il suo buffer interseca almeno un'area verde.
-            3. Attribuzione del punteggio: ogni edificio che interseca un'area verde riceve un punteggio di 1, mentre gli altri ricevono 0.
+            1. Zona di ricerca: per ogni edificio si cercano le aree verdi entro 300 metri dal suo perimetro
+                (equivalente a un buffer di 300 metri, ma senza costruirlo: query 'dwithin' sull'indice spaziale delle aree verdi).
+            2. Unione spaziale (Spatial Join): le coppie edificio-area verde trovate danno gli id delle aree verdi vicine
+                e la distanza in linea d'aria dalla più vicina.
+            3. Attribuzione del punteggio: ogni edificio con almeno un'area verde entro 300 metri riceve un punteggio di 1, mentre gli altri ricevono 0.
 
         NOTE:
             1) E' stato implementato un filtro per considerare solo le aree verdi con superficie maggiore di una soglia minima;
-            2) il buffer di 300 metri parte in automatico dal perimetro dell'edificio grazie a geopandas;
+            2) la distanza di 300 metri è misurata dal perimetro dell'edificio, come faceva il buffer di geopandas;
             3) considerato che farlo senza Leaflet ha un costo computazionale importante, e non c'è conflitto se li teniamo separati, optiamo per avere
                 una divisione tra il backend che valuta la regola (linea d'aria) e il frontend che mostra la realtà (percorso), chiaramente maggiore del primo;
                 siccome è stato deciso di avere un precalcolo massiccio nel backend, con salvataggio in un DB, l'aggiunta del percorso pedonale con OSMXML/Graphhopper
@@ -35,12 +36,31 @@
 import pandas as pd
 import geopandas as gpd
 import logging
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from .graphs_calculator import calculate_pedestrian_path, infinity_dist
 
 #definisco il logger globale
 logger = logging.getLogger("regola300")
 
-def run_rule_300(edifici, aree_verdi, city_name, grafo):
+#distanza massima in metri (linea d'aria) tra edificio e area verde
+DISTANZA_MASSIMA = 300
+
+#consolidamento delle aree verdi: superficie minima in metri quadri dei cluster (1 ettaro, come SOGLIA_MINIMA del server)
+#e tolleranza in metri della semplificazione dei contorni
+SOGLIA_AREA_CLUSTER = 10000
+TOLLERANZA_SEMPLIFICAZIONE = 2
+
+"""
+    Funzione principale della regola 300.
+    @param solo_conformita: modalità "solo conformità": calcola solo score_300 e la distanza pedonale,
+        senza raccogliere gli id delle aree verdi e senza ricostruire i percorsi pedonali
+    @param edifici_percorso: id degli edifici di cui ricostruire il percorso pedonale (None = tutti), vedi calculate_pedestrian_path
+    @param campo_verde: campo precalcolato delle distanze dalle aree verdi della città (vedi campo_verde.py), o None per usare Dijkstra
+"""
+def run_rule_300(edifici, aree_verdi, city_name, grafo, solo_conformita=False, edifici_percorso=None, campo_verde=None):
 
     # controllo input (in caso di errore, restituisco edifici con score 0 e lista vuota)
     if edifici.empty or aree_verdi.empty:
@@ -55,7 +75,7 @@ def run_rule_300(edifici, aree_verdi, city_name, grafo):
     infinity_dist viene casterizzato a float per coerenza, perchè i risultati con grafi reali saranno in metri e con decimali
     """
     logger.info("Calcolo regola 300 con metodo geometrico.")
-    edifici_processati = calculate_buffer_method(edifici, aree_verdi)
+    edifici_processati = calculate_buffer_method(edifici, aree_verdi, raccogli_id=not solo_conformita)
     edifici_processati['distanza_pedonale'] = float(infinity_dist)
     edifici_processati['percorso_pedonale'] = None
 
@@ -79,7 +99,8 @@ def run_rule_300(edifici, aree_verdi, city_name, grafo):
             if not ids_da_calcolare.empty:
                 candidati_finali = edifici_processati.loc[ids_da_calcolare].copy()
                 #uso la funzione update di pandas per aggiornare solo la colonna 'distanza_pedonale', mantenendo intatti gli altri campi e gli indici
-                edifici_grafo = calculate_pedestrian_path(candidati_finali, aree_verdi, grafo)
+                edifici_grafo = calculate_pedestrian_path(candidati_finali, aree_verdi, grafo, calcola_percorsi=not solo_conformita,
+                                                          edifici_percorso=edifici_percorso, campo_verde=campo_verde)
                 #check di sicurezza sui percorsi
                 if 'percorso_pedonale' not in edifici_processati.columns:
                     edifici_processati['percorso_pedonale'] = None
@@ -111,7 +132,17 @@ def run_rule_300(edifici, aree_verdi, city_name, grafo):
 
     return edifici_processati
 
-def calculate_buffer_method(edifici, aree_verdi):
+"""
+    Metodo geometrico (linea d'aria) della regola 300.
+    Prima veniva costruito un buffer di 300 metri (un poligono con decine di vertici) attorno a ogni edificio, poi unito alle aree verdi
+    con gpd.sjoin(predicate='intersects'): su qualche migliaio di edifici i buffer dominavano memoria e tempo del join.
+    Ora l'indice spaziale delle aree verdi viene interrogato direttamente con le impronte degli edifici e il predicato 'dwithin'
+    (distanza <= DISTANZA_MASSIMA), che equivale all'intersezione con il buffer esatto. Dalle stesse coppie edificio-area verde
+    si ricava senza costi aggiuntivi la distanza in linea d'aria dall'area verde più vicina (colonna distanza_linea_aria,
+    infinity_dist se non ce n'è nessuna entro DISTANZA_MASSIMA).
+    @param raccogli_id: se False (modalità "solo conformità") non costruisce le liste green_areas_id
+"""
+def calculate_buffer_method(edifici, aree_verdi, raccogli_id=True):
 
     #proietto i CRS in EPSG:32632 per calcoli metrici
     try:
@@ -122,50 +153,45 @@ def calculate_buffer_method(edifici, aree_verdi):
         edifici_proj = edifici.to_crs("EPSG:32632")
         aree_verdi_proj = aree_verdi.to_crs("EPSG:32632")
 
-        """
-            Creo un buffer di 300 metri intorno ad ogni edificio:
-                - creo una copia del GeoDataFrame degli edifici per non modificare l'originale;
-                - aggiungo una colonna 'original_index' per tenere traccia dell'indice originale degli edifici;
-                - creo il buffer di 300 metri sulla colonna 'geometry' ---> sostituisce il campo geometria con geometry + buffer
-        """
-        edifici_buffer = edifici_proj.copy()
-        edifici_buffer['geometry'] = edifici_buffer.geometry.buffer(300)
-        edifici_buffer['original_index'] = edifici_buffer.index
+        #coppie (posizione edificio, posizione area verde) entro DISTANZA_MASSIMA, con la loro distanza esatta
+        geom_edifici = np.asarray(edifici_proj.geometry.values)
+        geom_verdi = np.asarray(aree_verdi_proj.geometry.values)
+        coppie_edificio, coppie_verde = aree_verdi_proj.sindex.query(geom_edifici, predicate="dwithin", distance=DISTANZA_MASSIMA)
+        distanze = shapely.distance(geom_edifici[coppie_edificio], geom_verdi[coppie_verde])
 
-        #unione spaziale tra i buffer degli edifici e le aree verdi (inner è join base, predicate 'intersects' controlla l'intersezione)
-        join_result = gpd.sjoin(edifici_buffer, aree_verdi_proj, how="inner", predicate='intersects')
+        #distanza minima per edificio: gli edifici con almeno una coppia soddisfano la regola
+        distanza_minima = np.full(len(edifici), np.inf)
+        np.minimum.at(distanza_minima, coppie_edificio, distanze)
+        soddisfatti = np.isfinite(distanza_minima)
 
-        #creo copia per il risultato finale, inizializzo colonna punteggio a 0 e inizializzo la colonna degli ID come liste vuote
+        #creo copia per il risultato finale, con punteggio, distanza in linea d'aria e colonna degli ID come liste vuote
         risultato_finale = edifici.copy()
-        risultato_finale['score_300'] = 0
+        risultato_finale['score_300'] = soddisfatti.astype(int)
+        risultato_finale['distanza_linea_aria'] = np.where(soddisfatti, distanza_minima, float(infinity_dist))
         risultato_finale['green_areas_id'] = [[] for _ in range(len(risultato_finale))]
 
-        #se ci sono intersezioni, si assegna loro il punteggio senza ripetere gli indici originali
-        if not join_result.empty:
-
-            #flag SI/NO all'intersezione
-            soddisfatti_index = join_result['original_index'].unique()
-            risultato_finale.loc[soddisfatti_index, 'score_300'] = 1
+        #in modalità "solo conformità" basta il flag, non servono gli id delle aree verdi
+        if not raccogli_id or len(coppie_edificio) == 0:
+            return risultato_finale
 
-            """
-            Eseguo un'aggregazione degli ID. Raggruppo per edificio (original_index) e metto gli ID delle aree verdi ('id') in una lista.
-            NB: 'id_right' è il nome standard che sjoin dà all'indice/id del secondo dataframe se c'è conflitto (dato che è convensione OSM usare @id
-            per cui sia edifici che aree verdi avrebbero lo stesso tipo di id, e sjoin le rinominerebbe).
-            Nel primo if, gestiamo il caso in cui ci sia conflitto e l'id delle aree verdi sia rimasto semplicemente '@id' dopo il cambio del server.
-            """            
-            colonna_target = 'id_right'
-            
-            #per ogni edificio, creo lista degli id trovati
-            if colonna_target in join_result.columns:
-                temp = join_result.groupby('original_index')[colonna_target].apply(list)
-                #assegno liste con gli id alla colonna del dataframe finale (.loc permette di assegnare solo agli indici con score_300=1)
-                risultato_finale.loc[temp.index, 'green_areas_id'] = temp
-            else:
-                #TODO: rimuovere questo else quando si sarà sicuri che non ci siano conflitti di id
-                logger.error(f"Colonna {colonna_target} non trovata. Colonne presenti: {join_result.columns.tolist()}")
+        """
+        Aggrego gli ID delle aree verdi per edificio, in una lista ordinata come nelle righe delle aree verdi.
+        Come con lo sjoin precedente (dove l'id delle aree verdi diventava 'id_right'), gli id vengono raccolti solo se
+        sia gli edifici che le aree verdi hanno la colonna 'id' (convenzione OSM dopo la rinomina di '@id' nel server).
+        """
+        if 'id' in edifici.columns and 'id' in aree_verdi.columns:
+            id_verdi = aree_verdi['id'].to_numpy()
+            ordine = np.lexsort((coppie_verde, coppie_edificio))
+            coppie_edificio, coppie_verde = coppie_edificio[ordine], coppie_verde[ordine]
+            confini = np.searchsorted(coppie_edificio, np.arange(len(edifici) + 1))
+            risultato_finale['green_areas_id'] = [id_verdi[coppie_verde[confini[i]:confini[i + 1]]].tolist() for i in range(len(edifici))]
+        else:
+            #TODO: rimuovere questo else quando si sarà sicuri che non ci siano conflitti di id
+            logger.error(f"Colonna id non trovata negli edifici o nelle aree verdi. Colonne presenti: {aree_verdi.columns.tolist()}")
 
     except Exception as e:
-        edifici = _return_default(edifici)
+        logger.error(f"Errore nel metodo geometrico della regola 300: {e}")
+        return _return_default(edifici)
     
     return risultato_finale
 
@@ -173,6 +199,7 @@ def _return_default(edifici):
     res = edifici.copy()
     res['score_300'] = 0
     res['green_areas_id'] = pd.Series([[] for _ in range(len(res))], index=res.index)
+    res['distanza_linea_aria'] = float(infinity_dist)
     res['distanza_pedonale'] = float(infinity_dist)
     return res
 
@@ -215,6 +242,76 @@ def remove_direct_access(edifici_candidati, aree_verdi, crs):
 
 
 
+"""
+Consolida le aree verdi prima della regola 300.
+La query delle aree verdi restituisce spesso parchi, giardini e prati adiacenti o uno dentro l'altro: filtrati uno per uno con la soglia di area,
+i pezzi piccoli di un parco grande venivano scartati, e ogni edificio veniva unito a tutti i pezzi, gonfiando green_areas_id e il join.
+Qui le aree che si toccano o si sovrappongono vengono fuse in un unico cluster accessibile:
+    1. le coppie di aree che si intersecano (query sull'indice spaziale) formano un grafo, le cui componenti connesse sono i cluster;
+    2. la geometria del cluster è l'unione delle geometrie dei membri, semplificata con una tolleranza metrica (topologia preservata);
+    3. la soglia di area viene applicata al cluster intero (area prima della semplificazione), non ai singoli pezzi.
+Ogni cluster mantiene gli attributi del membro più grande e la lista degli id OSM dei membri (colonna 'membri');
+l'id è quello del membro se il cluster ne ha uno solo, altrimenti 'cluster/' seguito dal primo id dei membri in ordine.
+@param soglia: area minima in metri quadri di un cluster
+@param tolleranza: tolleranza in metri della semplificazione dei contorni
+@return: GDF dei cluster, nello stesso CRS dell'input.
+"""
+def consolida_aree_verdi(aree_verdi, soglia=SOGLIA_AREA_CLUSTER, tolleranza=TOLLERANZA_SEMPLIFICAZIONE):
+
+    if aree_verdi.empty:
+        return aree_verdi
+
+    crs_originale = aree_verdi.crs or "EPSG:4326"
+    verdi = aree_verdi.set_crs(crs_originale) if aree_verdi.crs is None else aree_verdi
+    verdi = verdi.to_crs("EPSG:32632")
+
+    #rendo valide le geometrie per l'unione; make_valid può produrre GeometryCollection con linee o punti, di cui tengo solo i poligoni
+    geometrie = shapely.make_valid(np.asarray(verdi.geometry.values))
+    for i in np.flatnonzero(shapely.get_type_id(geometrie) == 7):
+        parti = shapely.get_parts(geometrie[i])
+        geometrie[i] = shapely.union_all(parti[shapely.get_type_id(parti) == 3])
+    poligonali = np.isin(shapely.get_type_id(geometrie), [3, 6]) & ~shapely.is_empty(geometrie)
+    verdi = verdi[poligonali]
+    geometrie = geometrie[poligonali]
+    if len(verdi) == 0:
+        return aree_verdi.iloc[0:0]
+
+    #componenti connesse del grafo delle aree che si toccano o si sovrappongono
+    n = len(geometrie)
+    sinistra, destra = shapely.STRtree(geometrie).query(geometrie, predicate="intersects")
+    adiacenza = coo_matrix((np.ones(len(sinistra), dtype=np.int8), (sinistra, destra)), shape=(n, n))
+    _, cluster_di = connected_components(adiacenza, directed=False)
+
+    #unione dei membri di ogni cluster e area totale
+    aree = shapely.area(geometrie)
+    ordine = np.lexsort((-aree, cluster_di))
+    cluster_ordinato = cluster_di[ordine]
+    confini = np.flatnonzero(np.r_[True, cluster_ordinato[1:] != cluster_ordinato[:-1], True])
+    ids = verdi['id'].astype(str).to_numpy() if 'id' in verdi.columns else verdi.index.astype(str).to_numpy()
+
+    righe, unioni, membri, id_cluster = [], [], [], []
+    for inizio, fine in zip(confini[:-1], confini[1:]):
+        posizioni = ordine[inizio:fine]
+        unione = geometrie[posizioni[0]] if len(posizioni) == 1 else shapely.union_all(geometrie[posizioni])
+        if shapely.area(unione) < soglia:
+            continue
+        id_membri = sorted(ids[posizioni].tolist())
+        righe.append(posizioni[0])
+        unioni.append(unione)
+        membri.append(id_membri)
+        id_cluster.append(id_membri[0] if len(id_membri) == 1 else f"cluster/{id_membri[0]}")
+
+    #attributi del membro più grande (il primo di ogni gruppo, ordinato per area decrescente)
+    cluster = verdi.iloc[righe].copy()
+    cluster['id'] = id_cluster
+    cluster['membri'] = membri
+    cluster['area_m2'] = shapely.area(np.asarray(unioni, dtype=object))
+    cluster = cluster.set_geometry(shapely.simplify(np.asarray(unioni, dtype=object), tolleranza, preserve_topology=True), crs="EPSG:32632")
+    cluster = cluster.reset_index(drop=True)
+
+    logger.info(f"Aree verdi consolidate: {len(aree_verdi)} elementi in {len(cluster)} cluster sopra i {soglia} m2.")
+    return cluster.to_crs(crs_originale)
+
 #Esempio di utilizzo singolo dell'algoritmo
 """edifici = gpd.read_file("./INPUT/Edifici.geojson")
 areeverdi = gpd.read_file("./INPUT/Areeverdi.geojson")
@@ -0,0 +1,151 @@
+# Copyright 2026 [Martin Pedron Giuseppe]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Partizione in tasselli del grafo pedonale di una città, per caricare solo la zona di una richiesta.
+        La regola 300 non esplora mai oltre cutoff_dist (350 m) dagli edifici, quindi per un poligono di pochi isolati basta la parte
+        di grafo attorno al poligono, non l'intera città. generatoreGrafi.py divide la versione CSR del grafo in una griglia di
+        tasselli quadrati di LATO_TASSELLO metri (nel CRS metrico del grafo); ogni tassello contiene i nodi del suo quadrato allargato
+        di SOVRAPPOSIZIONE_TASSELLO metri per lato, con tutti gli archi che entrano o escono da essi (GrafoCSR.sottografo).
+        I tasselli sono salvati come snapshot binari (stesso formato di grafo_csr.py) nella cartella <città>_tasselli, con un
+        indice (indice.json) che descrive la griglia.
+
+        Per una richiesta, graphs_manager allarga il rettangolo del poligono del margine di instradamento e sceglie i tasselli:
+            - se il rettangolo sta tutto in un tassello allargato (il caso comune grazie alla sovrapposizione), quel tassello basta;
+            - altrimenti unisce i tasselli il cui quadrato interseca il rettangolo, che insieme contengono tutti i suoi nodi.
+        In entrambi i casi ogni nodo del rettangolo è presente con tutti i suoi archi, quindi i percorsi che restano nel rettangolo
+        (tutti quelli entro il cutoff dagli edifici del poligono) sono identici a quelli sul grafo completo.
+
+        NOTE:
+            1- l'indice salva la firma dei nodi del grafo completo (firma_nodi): il campo delle aree verdi, calcolato sul grafo completo,
+                si verifica con quella senza caricare il grafo;
+            2- come per lo snapshot, l'indice ricorda dimensione e data di modifica del GraphML da cui deriva, per riconoscere
+                tasselli superati.
+"""
+
+#importazioni
+import os
+import json
+import shutil
+import numpy as np
+from pyproj import CRS
+from .grafo_csr import GrafoCSR, firma_nodi, sostituisci_cartella, _firma_file
+
+#cartella dei tasselli accanto al GraphML, versione del formato e griglia di default (metri)
+SUFFISSO_TASSELLI = "_tasselli"
+VERSIONE_TASSELLI = 1
+LATO_TASSELLO = 2000
+SOVRAPPOSIZIONE_TASSELLO = 500
+
+"""
+Percorso della cartella dei tasselli di una città, accanto al suo GraphML (stesso nome sicuro di generatoreGrafi e graphsManager).
+"""
+def percorso_tasselli(cartella, city_name):
+    safe_name = city_name.replace(" ", "_").replace(",", "")
+    return os.path.join(cartella, f"{safe_name}{SUFFISSO_TASSELLI}")
+
+"""
+Divide il grafo in tasselli e li salva, con l'indice, nella cartella indicata (sovrascrivendo quella esistente).
+I tasselli senza nodi non vengono salvati.
+@param csr: versione CSR del grafo completo, nel CRS metrico
+@param sorgente: GraphML da cui deriva il grafo
+@return: numero di tasselli salvati
+"""
+def salva_tasselli(csr, cartella, sorgente=None, lato=LATO_TASSELLO, sovrapposizione=SOVRAPPOSIZIONE_TASSELLO):
+    temporanea = f"{cartella}.tmp"
+    shutil.rmtree(temporanea, ignore_errors=True)
+    os.makedirs(temporanea)
+
+    x, y = np.asarray(csr.x), np.asarray(csr.y)
+    x0, y0 = (float(np.floor(x.min())), float(np.floor(y.min()))) if len(x) else (0.0, 0.0)
+    colonne = int((x.max() - x0) // lato) + 1 if len(x) else 0
+    righe = int((y.max() - y0) // lato) + 1 if len(y) else 0
+
+    tasselli = []
+    for i in range(colonne):
+        for j in range(righe):
+            selezionati = ((x >= x0 + i * lato - sovrapposizione) & (x <= x0 + (i + 1) * lato + sovrapposizione) &
+                           (y >= y0 + j * lato - sovrapposizione) & (y <= y0 + (j + 1) * lato + sovrapposizione))
+            if not selezionati.any():
+                continue
+            nome = f"{i}_{j}"
+            tassello = csr.sottografo(selezionati)
+            tassello.salva(os.path.join(temporanea, nome))
+            tasselli.append({'nome': nome, 'i': i, 'j': j, 'nodi': int(len(tassello.nodi))})
+
+    indice = {
+        'versione': VERSIONE_TASSELLI,
+        'crs': CRS.from_user_input(csr.crs).to_wkt() if csr.crs is not None else None,
+        'origine': [x0, y0],
+        'lato': lato,
+        'sovrapposizione': sovrapposizione,
+        'firma_nodi': firma_nodi(csr.nodi),
+        'sorgente': _firma_file(sorgente) if sorgente is not None else None,
+        'tasselli': tasselli,
+    }
+    with open(os.path.join(temporanea, "indice.json"), "w") as f:
+        json.dump(indice, f)
+
+    sostituisci_cartella(temporanea, cartella)
+    return len(tasselli)
+
+"""
+Legge l'indice dei tasselli, se esiste, ha la versione corrente e deriva dal GraphML attuale (se il GraphML non c'è, è l'unica fonte).
+@return: dizionario dell'indice, o None
+"""
+def carica_indice_tasselli(cartella, graphml_path):
+    try:
+        with open(os.path.join(cartella, "indice.json")) as f:
+            indice = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if indice.get('versione') != VERSIONE_TASSELLI:
+        return None
+    if os.path.exists(graphml_path) and indice.get('sorgente') != _firma_file(graphml_path):
+        return None
+    return indice
+
+"""
+Sceglie i tasselli che contengono tutti i nodi del rettangolo indicato (nel CRS del grafo), vedi il commento iniziale.
+@return: tupla ordinata dei nomi dei tasselli, vuota se il rettangolo è fuori dal grafo
+"""
+def tasselli_per_area(indice, minx, miny, maxx, maxy):
+    if not indice['tasselli']:
+        return ()
+    x0, y0 = indice['origine']
+    lato, sovrapposizione = indice['lato'], indice['sovrapposizione']
+    nomi = np.array([t['nome'] for t in indice['tasselli']])
+    inizio_x = x0 + lato * np.array([t['i'] for t in indice['tasselli']], dtype=float)
+    inizio_y = y0 + lato * np.array([t['j'] for t in indice['tasselli']], dtype=float)
+
+    #un solo tassello allargato che contiene tutto il rettangolo: scelgo quello col centro più vicino al centro del rettangolo
+    contiene = ((inizio_x - sovrapposizione <= minx) & (maxx <= inizio_x + lato + sovrapposizione) &
+                (inizio_y - sovrapposizione <= miny) & (maxy <= inizio_y + lato + sovrapposizione))
+    if contiene.any():
+        distanza = np.hypot(inizio_x + lato / 2 - (minx + maxx) / 2, inizio_y + lato / 2 - (miny + maxy) / 2)
+        return (str(nomi[np.flatnonzero(contiene)[np.argmin(distanza[contiene])]]),)
+
+    #altrimenti tutti i tasselli il cui quadrato interseca il rettangolo
+    interseca = (inizio_x <= maxx) & (minx <= inizio_x + lato) & (inizio_y <= maxy) & (miny <= inizio_y + lato)
+    return tuple(sorted(nomi[interseca].tolist()))
+
+"""
+Carica i tasselli indicati e, se più di uno, li unisce in un solo grafo (GrafoCSR.unisci).
+@return: versione CSR della zona, o None se un tassello manca
+"""
+def carica_tasselli(cartella, nomi):
+    grafi = [GrafoCSR.carica(os.path.join(cartella, nome)) for nome in nomi]
+    if not grafi or any(g is None for g in grafi):
+        return None
+    return grafi[0] if len(grafi) == 1 else GrafoCSR.unisci(grafi)
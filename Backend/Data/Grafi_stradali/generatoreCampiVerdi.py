@@ -0,0 +1,105 @@
+# Copyright 2026 [Martin Pedron Giuseppe]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Script per la generazione offline dei campi "distanza dall'area verde più vicina" dei grafi pedonali (regola 300).
+Per ogni città di city_boundaries.json che ha già il suo GraphML (generato da generatoreGrafi.py), scarica da OpenStreetMap
+le aree verdi dentro i confini (stessi tag della query del server), le consolida con la stessa soglia minima del server
+e calcola per ogni nodo del grafo la distanza pedonale dall'area verde più vicina e il predecessore sul percorso.
+Il campo viene salvato in <città>_campo_verde.npz accanto al GraphML e caricato da graphsManager; lo stesso file contiene il registro
+delle aree verdi qualificate (id, id OSM dei membri, geometria e nodi di accesso), con cui a ogni richiesta le aree verdi della zona
+vengono riconosciute senza ricampionarne il perimetro.
+Rieseguendo lo script, il campo esistente viene aggiornato in modo incrementale: solo le aree verdi nuove o modificate
+vengono rimappate sul grafo, e solo i nodi influenzati dalle aree cambiate vengono ricalcolati (vedi Algoritmi/campo_verde.py).
+Va eseguito da questa cartella, come generatoreGrafi.py.
+"""
+
+import os
+import sys
+import osmnx as ox
+import geopandas as gpd
+
+#rendo importabile il pacchetto Algoritmi del backend
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from Algoritmi.campo_verde import CampoVerde, costruisci_campo_verde, percorso_campo_verde
+from Algoritmi.regola300 import consolida_aree_verdi
+
+#I/O
+inputFile = "./../city_boundaries.json"
+outputFolder = "./"
+
+#stessa soglia minima (m^2) e stessi tag delle aree verdi usati dal server
+SOGLIA_MINIMA = 10000
+TAG_AREE_VERDI = {'leisure': ['park', 'garden'], 'landuse': 'grass'}
+
+"""
+Scarica le aree verdi dentro il confine della città e le consolida come fa il server.
+Gli id sono l'id OSM numerico, come quelli che il server ottiene da Overpass tramite osm2geojson, così i membri dei cluster coincidono.
+"""
+def scarica_aree_verdi(geometry):
+    features = ox.features_from_polygon(geometry, tags=TAG_AREE_VERDI)
+    features = features[features.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])]
+    aree_verdi = gpd.GeoDataFrame(
+        {'id': [str(osm_id) for _, osm_id in features.index]},
+        geometry=features.geometry.values,
+        crs=features.crs
+    )
+    return consolida_aree_verdi(aree_verdi, soglia=SOGLIA_MINIMA)
+
+#main function: calcola (o aggiorna) il campo delle aree verdi per ogni città con un grafo
+def genera_campi():
+
+    #leggo confini nel file di input
+    try:
+        cities_gdf = gpd.read_file(inputFile)
+    except Exception as e:
+        print(f"Errore apertura file: {e}")
+        return
+
+    for idx, row in cities_gdf.iterrows():
+        city_name = row.get('city_name', f"City_{idx}")
+        geometry = row.geometry
+        if not geometry.is_valid:
+            geometry = geometry.buffer(0)
+
+        safe_name = city_name.replace(" ", "_").replace(",", "")
+        graph_path = os.path.join(outputFolder, f"{safe_name}.graphml")
+        campo_path = percorso_campo_verde(outputFolder, city_name)
+
+        print(f"Elaborazione: {city_name}")
+        if not os.path.exists(graph_path):
+            print(f"Grafo non trovato ({graph_path}): eseguire prima generatoreGrafi.py.")
+            continue
+
+        try:
+            #stesso caricamento di graphsManager: il campo deve avere i nodi del grafo usato dal server
+            G_proj = ox.project_graph(ox.load_graphml(graph_path))
+
+            print("Download aree verdi da OSM (attendere)")
+            aree_verdi = scarica_aree_verdi(geometry)
+
+            precedente = CampoVerde.carica(campo_path)
+            print("Aggiornamento incrementale del campo esistente." if precedente is not None else "Calcolo completo del campo.")
+            campo = costruisci_campo_verde(G_proj, aree_verdi, precedente=precedente)
+
+            print(f"Salvataggio in {os.path.basename(campo_path)}")
+            campo.salva(campo_path)
+
+        except Exception as e:
+            print(f"ERRORE elaborando {city_name}: {e}")
+            raise e
+
+#MAIN
+if __name__ == "__main__":
+    genera_campi()
@@ -15,10 +15,21 @@
 """
 Script per il download e la pulizia dei grafi stradali pedonali da OpenStreetMap tramite OSMnx,
 utilizzando i confini delle città definiti nel file geojson city_boundaries.json.
-I grafi vengono salvati in formato GraphML nella cartella di output specificata.
+I grafi vengono salvati in formato GraphML nella cartella di output specificata, insieme a uno snapshot binario già proiettato
+(cartella <città>_csr con gli array della versione CSR, vedi Backend/Algoritmi/grafo_csr.py) che graphsManager carica al posto del GraphML,
+e alla sua divisione in tasselli sovrapposti (cartella <città>_tasselli, vedi Backend/Algoritmi/tasselli.py), con cui graphsManager carica
+solo la zona attorno al poligono di una richiesta.
 Ogni volta che si vuole aggiungere una città, basta aggiungerla al file city_boundaries.json con i dati corretti
 e rieseguire questo script. Porre attenzione al sistema di coordinate (CRS) usato nei confini (deve essere EPSG:4326).
-Le città già presenti non verranno riscaricate.
+Le città vengono elaborate in parallelo in un pool di processi (opzione --processi).
+Accanto a ogni GraphML viene salvata la firma della sua generazione (<città>.firma.json): hash del confine, dei parametri della pipeline
+e dei dati OSM scaricati. Una città già presente non viene riscaricata se il confine e la pipeline non sono cambiati; con --aggiorna
+viene riscaricata, ma il GraphML viene riscritto solo se i dati OSM sono cambiati, così snapshot, tasselli e campi delle aree verdi
+restano validi. I GraphML generati prima della firma non vengono toccati (cancellarli per rigenerarli).
+Snapshot e tasselli vengono (ri)generati se mancano o se il GraphML è cambiato.
+Gli id dei nodi sono hash stabili a 64 bit delle coordinate: rigenerando una città con gli stessi dati si ottengono gli stessi id.
+Dopo aver generato i grafi, eseguire generatoreCampiVerdi.py per calcolare (o aggiornare) il registro delle aree verdi con i loro
+nodi di accesso e il campo delle distanze dalle aree verdi usati dalla regola 300.
 """
 
 
@@ -26,13 +37,39 @@ import osmnx as ox
 import networkx as nx
 import geopandas as gpd
 import os
+import sys
+import json
+import hashlib
+import argparse
 import numpy as np
-from shapely.geometry import LineString
+import shapely
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+#rendo importabile il pacchetto Algoritmi del backend (per snapshot binario e tasselli)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from Algoritmi.grafo_csr import GrafoCSR, percorso_snapshot, snapshot_aggiornato
+from Algoritmi.tasselli import percorso_tasselli, carica_indice_tasselli, salva_tasselli
 
 #I/O
 inputFile = "./../city_boundaries.json"
 outputFolder = "./"
 
+#parametri della pipeline: entrano nella firma, cambiandoli le città vengono rigenerate
+NETWORK_TYPE = 'walk'
+MAX_DISTANCE = 20
+VERSIONE_GENERAZIONE = 2
+
+#processi di default del pool: pochi, perché ogni processo scarica da Overpass e tiene in RAM un grafo
+PROCESSI = min(4, os.cpu_count() or 1)
+
+"""
+Hash stabile a 64 bit (intero positivo) di una stringa.
+hash() di Python è randomizzato a ogni processo (PYTHONHASHSEED), quindi due esecuzioni davano id diversi agli stessi nodi;
+blake2b dà lo stesso valore in ogni processo ed esecuzione.
+"""
+def hash_stabile(testo):
+    return int.from_bytes(hashlib.blake2b(testo.encode(), digest_size=8).digest(), "little") & 0x7FFFFFFFFFFFFFFF
+
 """
 Genera un ID intero univoco basato sulle coordinate.
 Arrotonda a 7 cifre per coerenza con gli id originali del grafo, crea una stringa unica e ne calcola l'hash, restituendo un intero positivo.
@@ -41,7 +78,7 @@ per tanto non è possibile aggiungerne senza incappare in errori typografici o d
 """
 def get_node_id_from_coords(x, y):
     val_str = f"{x:.7f}_{y:.7f}"
-    return abs(hash(val_str))
+    return hash_stabile(val_str)
 
 """
     I grafi scaricabili da OSMnx spesso contengono dati sporchi o inutili.
@@ -59,66 +96,218 @@ I nodi del grafo stradale/pedonale di OSMnx possono essere molto distanti tra lo
 Questo rende l'individuazione dello 'nearest node' molto impreciso, con errori di decine di metri. Spezzare gli archi lunghi in segmenti più corti migliora
 drasticamente la precisione, riducendo l'errore a pochi metri.
 La funzione aggiunge nodi intermedi ogni 'max_distance' metri lungo gli archi più lunghi di questa soglia.
+Le geometrie sono elaborate in blocco con le funzioni vettoriali di shapely (lunghezze e interpolazione di tutti i punti intermedi in
+una chiamata), invece di un interpolate per punto; al grafo si aggiungono poi nodi e archi con add_nodes_from/add_edges_from.
 """
 def densify_graph(G, max_distance=20):
 
     G_dense = G.copy()
-    
-    #itero su una lista statica degli archi perché modificheremo il grafo
-    for u, v, data in list(G_dense.edges(data=True)):
-
-        #inizializzo parametri
-        length = 0.0
-        line = None
-        
-        #se esiste la geometria, la uso per calcolare la lunghezza. Altrimenti, assumo linea dritta tra i nodi (sulle prime 4 città è capitato per Genova).
-        if 'geometry' in data:
-            line = data['geometry']
-            length = line.length
-        else:
-            #calcolo lunghezza se non c'è geometria esplicita (linea dritta)
-            p_u = G_dense.nodes[u]
-            p_v = G_dense.nodes[v]
-            line = LineString([(p_u['x'], p_u['y']), (p_v['x'], p_v['y'])])
-            length = data.get('length', line.length)
-
-        #se l'arco è più lungo della soglia, lo spezziamo
-        if length > max_distance:
-            G_dense.remove_edge(u, v)
-            
-            #calcolo il numero di segmenti da aggiungere
-            num_segments = int(np.ceil(length / max_distance))
-            
-            #genero punti intermedi lungo la linea
-            points = [line.interpolate(i/float(num_segments), normalized=True) 
-                      for i in range(1, num_segments)]
-            
-            prev_node = u
-            for point in points:
-                    #genero id univoco basato sulle coordinate hashate
-                    new_node_id = get_node_id_from_coords(point.x, point.y)
-                    
-                    G_dense.add_node(new_node_id, x=point.x, y=point.y)
-                    
-                    new_edge_data = data.copy()
-                    if 'geometry' in new_edge_data:
-                        del new_edge_data['geometry']
-                    new_edge_data['length'] = length / num_segments
-                    
-                    G_dense.add_edge(prev_node, new_node_id, **new_edge_data)
-                    prev_node = new_node_id
-            
-            #collego l'ultimo nodo al nodo finale v
-            new_edge_data = data.copy()
-            if 'geometry' in new_edge_data:
-                del new_edge_data['geometry']
-            new_edge_data['length'] = length / num_segments
-            G_dense.add_edge(prev_node, v, **new_edge_data)
+    archi = list(G_dense.edges(keys=True, data=True))
+    if not archi:
+        return G_dense
+
+    #se esiste la geometria, la uso per calcolare la lunghezza. Altrimenti, assumo linea dritta tra i nodi (sulle prime 4 città è capitato per Genova).
+    linee = np.array([data.get('geometry') for _, _, _, data in archi], dtype=object)
+    senza_geometria = np.flatnonzero([linea is None for linea in linee])
+    if len(senza_geometria):
+        estremi = np.array([[(G_dense.nodes[archi[i][0]]['x'], G_dense.nodes[archi[i][0]]['y']),
+                             (G_dense.nodes[archi[i][1]]['x'], G_dense.nodes[archi[i][1]]['y'])] for i in senza_geometria], dtype=float)
+        linee[senza_geometria] = shapely.linestrings(estremi)
+    lunghezze = shapely.length(linee)
+    #senza geometria vale la 'length' dell'arco, se presente
+    for i in senza_geometria:
+        lunghezze[i] = archi[i][3].get('length', lunghezze[i])
+
+    #solo gli archi più lunghi della soglia vengono spezzati
+    lunghi = np.flatnonzero(lunghezze > max_distance)
+    if not len(lunghi):
+        return G_dense
+    num_segments = np.ceil(lunghezze[lunghi] / max_distance).astype(np.int64)
+
+    #punti intermedi di tutti gli archi lunghi in un colpo solo: per ogni arco le frazioni 1/n ... (n-1)/n della linea
+    intermedi = num_segments - 1
+    arco_di = np.repeat(np.arange(len(lunghi)), intermedi)
+    passo = np.arange(intermedi.sum()) - np.repeat(np.cumsum(intermedi) - intermedi, intermedi) + 1
+    points = shapely.line_interpolate_point(linee[lunghi][arco_di], passo / num_segments[arco_di], normalized=True)
+    punti_x, punti_y = shapely.get_x(points), shapely.get_y(points)
+
+    #genero id univoco basato sulle coordinate hashate
+    new_node_ids = [get_node_id_from_coords(x, y) for x, y in zip(punti_x.tolist(), punti_y.tolist())]
+
+    G_dense.remove_edges_from([archi[i][:3] for i in lunghi])
+    G_dense.add_nodes_from((n, {'x': x, 'y': y}) for n, x, y in zip(new_node_ids, punti_x.tolist(), punti_y.tolist()))
+
+    #catena u -> intermedi -> v per ogni arco lungo, con gli attributi originali (senza geometria) e la lunghezza divisa per segmento
+    nuovi_archi = []
+    confini = np.concatenate(([0], np.cumsum(intermedi)))
+    for k, i in enumerate(lunghi.tolist()):
+        u, v, _, data = archi[i]
+        new_edge_data = data.copy()
+        if 'geometry' in new_edge_data:
+            del new_edge_data['geometry']
+        new_edge_data['length'] = float(lunghezze[i] / num_segments[k])
+
+        catena = [u] + new_node_ids[confini[k]:confini[k + 1]] + [v]
+        nuovi_archi.extend((a, b, dict(new_edge_data)) for a, b in zip(catena[:-1], catena[1:]))
+    G_dense.add_edges_from(nuovi_archi)
 
     return G_dense
 
-#main function: scarica i grafi pedonali per ogni città, li pulisce e li salva in formato GraphML
-def download_graphs():
+"""
+Scrive lo snapshot binario della città dal GraphML salvato, con lo stesso caricamento di graphsManager (load_graphml + project_graph),
+così nodi, ordine e CRS coincidono con quelli usati dal server e dai campi delle aree verdi; poi lo divide in tasselli.
+Ognuno dei due viene scritto solo se manca o non corrisponde al GraphML.
+"""
+def salva_snapshot(file_path, snapshot_path, tasselli_path):
+    csr = GrafoCSR.carica(snapshot_path) if snapshot_aggiornato(snapshot_path, file_path) else None
+    if csr is None:
+        print(f"Salvataggio snapshot binario in {os.path.basename(snapshot_path)}")
+        G_proj = ox.project_graph(ox.load_graphml(file_path))
+        csr = GrafoCSR.da_grafo(G_proj)
+        csr.salva(snapshot_path, sorgente=file_path)
+
+    if carica_indice_tasselli(tasselli_path, file_path) is None:
+        print(f"Salvataggio tasselli in {os.path.basename(tasselli_path)}")
+        numero = salva_tasselli(csr, tasselli_path, sorgente=file_path)
+        print(f"{numero} tasselli salvati.")
+
+"""
+Firma del confine della città e dei parametri della pipeline: se cambia, il grafo va rigenerato.
+Le coordinate sono arrotondate a 7 decimali, così la stessa geometria riletta dal GeoJSON dà sempre la stessa firma.
+"""
+def firma_confine(geometry):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(shapely.to_wkb(shapely.set_precision(geometry, 1e-7)))
+    h.update(json.dumps({'network_type': NETWORK_TYPE, 'max_distance': MAX_DISTANCE, 'versione': VERSIONE_GENERAZIONE}).encode())
+    return h.hexdigest()
+
+"""
+Firma dei dati OSM scaricati (grafo grezzo, prima di qualsiasi elaborazione): nodi con coordinate e archi con lunghezza e way OSM.
+Gli id del grafo grezzo sono quelli OSM, stabili tra un download e l'altro.
+"""
+def firma_sorgente(G):
+    h = hashlib.blake2b(digest_size=16)
+    nodi = sorted((int(n), round(float(d['x']), 7), round(float(d['y']), 7)) for n, d in G.nodes(data=True))
+    archi = sorted((int(u), int(v), int(k), round(float(d.get('length', 0)), 3), str(d.get('osmid')))
+                   for u, v, k, d in G.edges(keys=True, data=True))
+    h.update(repr(nodi).encode())
+    h.update(repr(archi).encode())
+    return h.hexdigest()
+
+def _leggi_firma(percorso):
+    try:
+        with open(percorso) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _scrivi_firma(percorso, firma):
+    temporaneo = f"{percorso}.tmp"
+    with open(temporaneo, "w") as f:
+        json.dump(firma, f)
+    os.replace(temporaneo, percorso)
+
+"""
+Elabora una città: download, densificazione, id stabili, pulizia e salvataggio di GraphML, firma, snapshot e tasselli.
+Eseguita in un processo del pool, quindi riceve solo dati serializzabili e scrive solo i file della sua città.
+@param aggiorna: se True riscarica anche le città con confine invariato, e riscrive il GraphML solo se i dati OSM sono cambiati
+"""
+def genera_citta(city_name, geometry, aggiorna=False):
+
+    #nome di salvataggio sicuro
+    safe_name = city_name.replace(" ", "_").replace(",", "")
+    file_path = os.path.join(outputFolder, f"{safe_name}.graphml")
+    firma_path = os.path.join(outputFolder, f"{safe_name}.firma.json")
+    snapshot_path = percorso_snapshot(outputFolder, city_name)
+    tasselli_path = percorso_tasselli(outputFolder, city_name)
+
+    print(f"[{city_name}] Elaborazione")
+    firma_precedente = _leggi_firma(firma_path)
+    confine = firma_confine(geometry)
+
+    #se esiste già, salto (aggiornando snapshot e tasselli se mancano o non corrispondono al GraphML):
+    #GraphML senza firma (generati prima) sempre, gli altri se confine e pipeline sono invariati
+    if os.path.exists(file_path):
+        if firma_precedente is None:
+            print(f"[{city_name}] File già esistente, senza firma. Non ricalcolo.")
+            salva_snapshot(file_path, snapshot_path, tasselli_path)
+            return
+        if firma_precedente.get('confine') == confine and not aggiorna:
+            print(f"[{city_name}] Confine e pipeline invariati. Non ricalcolo.")
+            salva_snapshot(file_path, snapshot_path, tasselli_path)
+            return
+
+    #download grafo pedonale. La flag simplify riduce i nodi inutili
+    print(f"[{city_name}] Download grafo pedonale da OSM (attendere)")
+    G = ox.graph_from_polygon(geometry, network_type=NETWORK_TYPE, simplify=True)
+
+    #stessi dati OSM con lo stesso confine: il GraphML sarebbe identico, non lo riscrivo
+    firma = {'confine': confine, 'sorgente': firma_sorgente(G)}
+    if os.path.exists(file_path) and firma_precedente == firma:
+        print(f"[{city_name}] Dati OSM invariati. Non ricalcolo.")
+        salva_snapshot(file_path, snapshot_path, tasselli_path)
+        return
+
+    #proiezione in sistema metrico
+    G_proj = ox.project_graph(G)
+
+    #aggiungo nodi sui rettilinei
+    G_dense = densify_graph(G_proj, max_distance=MAX_DISTANCE)
+
+    #riproietto indietro crs
+    G_final = ox.project_graph(G_dense, to_crs="EPSG:4326")
+
+    #ricalcolo l'id hash per TUTTI i nodi (anche quelli originali del grafo)
+    #così siamo sicuri al 100% che siano tutti interi dello stesso tipo
+    mapping = {}
+    for n, data in G_final.nodes(data=True):
+        try:
+            x = float(data['x'])
+            y = float(data['y'])
+            new_id = get_node_id_from_coords(x, y)
+            mapping[n] = int(new_id)
+        except Exception as e:
+            print(f"[{city_name}] Errore convertendo nodo {n}: {e}")
+            #se proprio fallisce uso un hash (stabile) dell'id
+            mapping[n] = hash_stabile(str(n))
+
+    #rinomino tutti i nodi nel grafo con i nuovi id puliti
+    G_final = nx.relabel_nodes(G_final, mapping)
+
+    """
+    BUG FIX IMPORTANTE: data sanifications.
+    Durante le operazioni di proiezione (ox.project_graph) e densificazione, gli attributi originari dei nodi (come 'street_count')
+    subiscono spesso un casting implicito da Integer a Float (es. 3 -> 3.0) a causa della gestione dei valori mancanti (NaN) nei nuovi nodi
+    creati o delle operazioni vettoriali di Pandas/NumPy.
+    Quando il grafo viene salvato in graphml, questi valori vengono serializzati come stringhe (es. "3.0").
+    Al momento del ricaricamento nel backend, OSMnx tenta di convertire queste stringhe in int, ma Python solleva un ValueError per stringhe 
+    contenenti decimali (int("3.0") -> Crash).
+    Il seguente blocco normalizza forzatamente questi attributi, riportandoli a interi puri o rimuovendoli se corrotti.
+    """
+    for n, data in G_final.nodes(data=True):
+        if 'street_count' in data:
+            try:
+                data['street_count'] = int(float(data['street_count']))
+            except:
+                del data['street_count']
+
+        #normalizzo coordinate
+        if 'x' in data: data['x'] = float(data['x'])
+        if 'y' in data: data['y'] = float(data['y'])
+
+    #pulisco dati con funzione ausiliaria predefinita: rimuove pezzi di grafo non connessi e/o vicoli ciechi isolati
+    G_clean = get_largest_component_safe(G_final)
+
+    #salvo in file, poi la firma: se il processo si interrompe prima, alla prossima esecuzione la città viene rigenerata
+    print(f"[{city_name}] Salvataggio in {safe_name}.graphml")
+    ox.save_graphml(G_clean, file_path)
+    _scrivi_firma(firma_path, firma)
+
+    #snapshot binario proiettato e tasselli per il caricamento veloce nel backend
+    salva_snapshot(file_path, snapshot_path, tasselli_path)
+
+#main function: scarica i grafi pedonali per ogni città, li pulisce e li salva in formato GraphML, una città per processo del pool
+def download_graphs(processi=PROCESSI, aggiorna=False):
     
     #assunta cartella output già esistente
 
@@ -129,7 +318,8 @@ def download_graphs():
         print(f"Errore apertura file: {e}")
         return
 
-    #ciclo le città presenti
+    #raccolgo le città presenti
+    citta = []
     for idx, row in cities_gdf.iterrows():
         city_name = row.get('city_name', f"City_{idx}")
         geometry = row.geometry
@@ -138,85 +328,28 @@ def download_graphs():
         if not geometry.is_valid:
             print(f"Geometria invalida per {city_name}. Provo fix automatico.")
             geometry = geometry.buffer(0)
-        
-        #nome di salvataggio sicuro
-        safe_name = city_name.replace(" ", "_").replace(",", "")
-        file_path = os.path.join(outputFolder, f"{safe_name}.graphml")
-        
-        print(f"Elaborazione: {city_name}")
-        
-        #se esiste già per X città, salto
-        if os.path.exists(file_path):
-            print(f"File già esistente. Non ricalcolo.")
-            continue
-            
-        try:
-            
-            #download grafo pedonale. La flag simplify riduce i nodi inutili
-            print("Download grafo pedonale da OSM (attendere)")
-            G = ox.graph_from_polygon(geometry, network_type='walk', simplify=True)
-
-            #proiezione in sistema metrico
-            G_proj = ox.project_graph(G)
-            
-            #aggiungo nodi sui rettilinei
-            G_dense = densify_graph(G_proj, max_distance=20)
-            
-            #riproietto indietro crs
-            G_final = ox.project_graph(G_dense, to_crs="EPSG:4326")
-
-            #ricalcolo l'id hash per TUTTI i nodi (anche quelli originali del grafo)
-            #così siamo sicuri al 100% che siano tutti interi dello stesso tipo
-            mapping = {}
-            for n, data in G_final.nodes(data=True):
-                try:
-                    x = float(data['x'])
-                    y = float(data['y'])
-                    new_id = get_node_id_from_coords(x, y)
-                    mapping[n] = int(new_id)
-                except Exception as e:
-                    print(f"Errore convertendo nodo {n}: {e}")
-                    #se proprio fallisce uso un hash
-                    mapping[n] = abs(hash(str(n)))
-            
-            #rinomino tutti i nodi nel grafo con i nuovi id puliti
-            G_final = nx.relabel_nodes(G_final, mapping)
-
-            """
-            BUG FIX IMPORTANTE: data sanifications.
-            Durante le operazioni di proiezione (ox.project_graph) e densificazione, gli attributi originari dei nodi (come 'street_count')
-            subiscono spesso un casting implicito da Integer a Float (es. 3 -> 3.0) a causa della gestione dei valori mancanti (NaN) nei nuovi nodi
-            creati o delle operazioni vettoriali di Pandas/NumPy.
-            Quando il grafo viene salvato in graphml, questi valori vengono serializzati come stringhe (es. "3.0").
-            Al momento del ricaricamento nel backend, OSMnx tenta di convertire queste stringhe in int, ma Python solleva un ValueError per stringhe 
-            contenenti decimali (int("3.0") -> Crash).
-            Il seguente blocco normalizza forzatamente questi attributi, riportandoli a interi puri o rimuovendoli se corrotti.
-            """
-            for n, data in G_final.nodes(data=True):
-                if 'street_count' in data:
-                    try:
-                        data['street_count'] = int(float(data['street_count']))
-                    except:
-                        del data['street_count']
-                
-                #normalizzo coordinate
-                if 'x' in data: data['x'] = float(data['x'])
-                if 'y' in data: data['y'] = float(data['y'])
-            
-            #pulisco dati con funzione ausiliaria predefinita: rimuove pezzi di grafo non connessi e/o vicoli ciechi isolati
-            G_clean = get_largest_component_safe(G_final)
-            
-            #salvo in file
-            print(f"Salvataggio in {safe_name}.graphml")
-            ox.save_graphml(G_clean, file_path)
-            
-        except Exception as e:
-            print(f"ERRORE elaborando {city_name}: {e}")
-            raise e 
+        citta.append((city_name, geometry))
+
+    #un errore su una città non ferma le altre: li riporto tutti alla fine e rilancio il primo
+    errori = []
+    with ProcessPoolExecutor(max_workers=max(1, min(processi, len(citta)))) as pool:
+        futuri = {pool.submit(genera_citta, city_name, geometry, aggiorna): city_name for city_name, geometry in citta}
+        for futuro in as_completed(futuri):
+            try:
+                futuro.result()
+            except Exception as e:
+                print(f"ERRORE elaborando {futuri[futuro]}: {e}")
+                errori.append(e)
+    if errori:
+        raise errori[0]
 
 #MAIN
 if __name__ == "__main__":
-    download_graphs()
+    parser = argparse.ArgumentParser(description="Generazione dei grafi pedonali delle città di city_boundaries.json")
+    parser.add_argument("--processi", type=int, default=PROCESSI, help="città elaborate in parallelo")
+    parser.add_argument("--aggiorna", action="store_true", help="riscarica anche le città con confine invariato")
+    argomenti = parser.parse_args()
+    download_graphs(processi=argomenti.processi, aggiorna=argomenti.aggiorna)
 
 """
 COPIA E INCOLLA LA PARTE QUI SOTTO PER VEDERE I GRAFI USATI SU OVERPASS TURBO
@@ -15,22 +15,40 @@
 """
 Script per la gestione dei grafi stradali delle città.
 Fornisce funzionalità per:
-- caricamento e caching dei grafi stradali da file GraphML;
+- caricamento e caching dei grafi stradali nella loro versione compatta CSR per Dijkstra (Algoritmi/grafo_csr.py), dallo snapshot binario
+  o in mancanza dal GraphML, insieme all'indice spaziale dei nodi (cKDTree) per l'aggancio di edifici e aree verdi, costruito al caricamento;
 - rilevamento della città in base al poligono di input arrivato dal frontend;
+- caricamento e caching del campo precalcolato delle distanze dalle aree verdi (generatoreCampiVerdi.py), se presente;
+- se la città è divisa in tasselli (Algoritmi/tasselli.py), caricamento della sola zona della richiesta: il poligono allargato del margine
+  di instradamento, invece dell'intera città;
 La funzione principale è lo spatial join, in modalità "intersects", per determinare se il poligono utente interseca la figura di una città in almeno un punto.
 La versione "within" non è adatta perché richiede che il poligono utente sia completamente contenuto all'interno del confine della città.
 Ci penserà poi Rule300 a gestire i casi in cui un area verde è fuori dal grafo cittadino.
 """
 
 import os
+import time
+import threading
+from collections import OrderedDict
 import geopandas as gpd
 import osmnx as ox
 from shapely.geometry import shape
+from Algoritmi.campo_verde import CampoVerde, percorso_campo_verde
+from Algoritmi.grafo_csr import GrafoCSR, firma_nodi, percorso_snapshot, snapshot_aggiornato
+from Algoritmi.tasselli import percorso_tasselli, carica_indice_tasselli, tasselli_per_area, carica_tasselli
+from Algoritmi.graphs_calculator import cutoff_dist
 
 #configurazione percorsi relativi
 file_boundaries = "./Data/city_boundaries.json"
 GRAPHS_DIR = "./Data/Grafi_stradali"
 
+#budget di memoria (byte) della cache dei grafi, configurabile con la variabile d'ambiente BUDGET_MEMORIA_GRAFI (default 4 GiB)
+BUDGET_MEMORIA_GRAFI = int(os.environ.get("BUDGET_MEMORIA_GRAFI", 4 * 1024 ** 3))
+
+#margine (metri) attorno al poligono della richiesta per la scelta dei tasselli: il cutoff della regola 300, più il doppio della distanza
+#massima di aggancio dei perimetri delle aree verdi (35 m), così anche i nodi di accesso delle aree verdi sono quelli del grafo completo
+MARGINE_TASSELLI = cutoff_dist + 2 * 35
+
 class graphsManager:
     _instance = None
     
@@ -49,7 +67,19 @@ class graphsManager:
             return
         
         self._cities_boundaries = self._load_boundaries()
-        self._loaded_graphs = {}    #cache grafi in RAM
+        #cache LRU in RAM, dalla voce usata meno di recente. Chiavi: nome città (grafo completo), (città, tasselli) per la zona di una
+        #richiesta, ('campo', città) per il campo delle distanze dalle aree verdi (None se la città non ne ha uno valido)
+        self._loaded_graphs = OrderedDict()
+        self._memoria = {}                      #byte stimati per voce
+        self._indici_tasselli = {}              #indice dei tasselli per città (None se la città non è divisa in tasselli)
+        self._budget_memoria = BUDGET_MEMORIA_GRAFI
+        self._statistiche = {'hit': 0, 'miss': 0, 'caricamenti': 0, 'secondi_caricamento': 0.0, 'evizioni': 0}
+        self._lock_cache = threading.RLock()    #stato delle cache, per i worker con più thread
+        #lock per voce in caricamento: chiave -> [lock, richieste che lo usano]. Due richieste sulla stessa voce non la caricano due volte,
+        #voci diverse si caricano in parallelo; il lock viene rimosso quando nessuna richiesta lo usa più, quindi restano solo quelli in uso
+        self._lock_voci = {}
+        self._precaricamento = None #stato del precaricamento all'avvio (None se non richiesto, vedi precarica)
+        self._lock_precaricamento = threading.Lock()
         self._initialized = True
 
     """
@@ -103,39 +133,270 @@ class graphsManager:
 
     """
     Restituisce il grafo della città richiesta, caricandolo da disco se non già in RAM.
+    Se la città è divisa in tasselli e viene passato il poligono della richiesta, restituisce solo la zona che copre il poligono allargato
+    di MARGINE_TASSELLI (vedi Algoritmi/tasselli.py): i percorsi entro il cutoff sono gli stessi del grafo completo.
+    La cache è LRU con budget di memoria: ogni voce occupa la stima in byte del suo grafo (o campo), e quando il totale
+    supera il budget vengono scaricate le voci usate meno di recente (mai quella appena richiesta, anche se da sola lo supera).
+    Il caricamento avviene fuori dal lock della cache, con un lock per voce: richieste su città diverse non si bloccano a vicenda.
     @param city_name: nome della città di cui si vuole il grafo
-    @return: grafo osmnx della città, o None se non trovato
+    @param poligono: poligono shapely della richiesta (EPSG:4326), o None per il grafo completo
+    @return: grafo della città o della zona (GrafoCSR), o None se non trovato
+    """
+    def get_graph(self, city_name, poligono=None):
+        indice = self._indice_tasselli(city_name) if poligono is not None else None
+        tasselli = self._tasselli_richiesta(indice, poligono) if indice is not None else ()
+        if tasselli:
+            cartella = percorso_tasselli(GRAPHS_DIR, city_name)
+            return self._da_cache((city_name, tasselli), lambda: self._carica_zona(cartella, tasselli))
+        return self._da_cache(city_name, lambda: self._carica_grafo(city_name))
+
     """
-    def get_graph(self, city_name):
+    Restituisce la voce della cache, caricandola con la funzione indicata se manca.
+    @param tieni_assente: se True anche un risultato None resta in cache (ad esempio una città senza campo), altrimenti si riprova alla richiesta successiva
+    """
+    def _da_cache(self, chiave, carica, tieni_assente=False):
         #se già caricata, la ritorno
-        if city_name in self._loaded_graphs:
-            return self._loaded_graphs[city_name]
+        with self._lock_cache:
+            if chiave in self._loaded_graphs:
+                self._loaded_graphs.move_to_end(chiave)
+                self._statistiche['hit'] += 1
+                return self._loaded_graphs[chiave]
+            self._statistiche['miss'] += 1
+            voce = self._lock_voci.setdefault(chiave, [threading.Lock(), 0])
+            voce[1] += 1
+
+        try:
+            with voce[0]:
+                #nel frattempo un'altra richiesta può averla già caricata
+                with self._lock_cache:
+                    if chiave in self._loaded_graphs:
+                        self._loaded_graphs.move_to_end(chiave)
+                        return self._loaded_graphs[chiave]
+
+                inizio = time.perf_counter()
+                valore = carica()
+                if valore is None and not tieni_assente:
+                    return None
 
+                with self._lock_cache:
+                    self._statistiche['caricamenti'] += 1
+                    self._statistiche['secondi_caricamento'] += time.perf_counter() - inizio
+                    self._loaded_graphs[chiave] = valore
+                    self._memoria[chiave] = valore.memoria() if valore is not None else 0
+                    self._rispetta_budget()
+                return valore
+        finally:
+            with self._lock_cache:
+                voce[1] -= 1
+                if voce[1] == 0:
+                    del self._lock_voci[chiave]
+
+    """
+    Indice dei tasselli della città, letto una volta sola (None se la città non ha tasselli aggiornati rispetto al GraphML).
+    """
+    def _indice_tasselli(self, city_name):
+        with self._lock_cache:
+            if city_name in self._indici_tasselli:
+                return self._indici_tasselli[city_name]
+
+        safe_name = city_name.replace(" ", "_").replace(",", "")
+        indice = carica_indice_tasselli(percorso_tasselli(GRAPHS_DIR, city_name), os.path.join(GRAPHS_DIR, f"{safe_name}.graphml"))
+        with self._lock_cache:
+            self._indici_tasselli[city_name] = indice
+        return indice
+
+    """
+    Tasselli che coprono il poligono della richiesta allargato di MARGINE_TASSELLI, nel CRS del grafo.
+    @return: tupla dei nomi dei tasselli, vuota se il poligono è fuori dai tasselli o non proiettabile (si usa il grafo completo)
+    """
+    def _tasselli_richiesta(self, indice, poligono):
+        try:
+            minx, miny, maxx, maxy = gpd.GeoSeries([poligono], crs="EPSG:4326").to_crs(indice['crs']).total_bounds
+        except Exception as e:
+            print(f"Errore proiezione poligono per i tasselli: {e}")
+            return ()
+        return tasselli_per_area(indice, minx - MARGINE_TASSELLI, miny - MARGINE_TASSELLI,
+                                 maxx + MARGINE_TASSELLI, maxy + MARGINE_TASSELLI)
+
+    """
+    Carica (e unisce) i tasselli di una zona, con il suo indice spaziale dei nodi.
+    """
+    def _carica_zona(self, cartella, tasselli):
+        print(f"Caricamento tasselli {', '.join(tasselli)} da {cartella}.")
+        try:
+            csr = carica_tasselli(cartella, tasselli)
+            if csr is None:
+                print("Tasselli non trovati.")
+                return None
+            csr.albero
+            return csr
+        except Exception as e:
+            print(f"Errore caricamento tasselli: {e}")
+            return None
+
+    """
+    Carica da disco il grafo di una città.
+    Se esiste uno snapshot binario aggiornato (cartella <città>_csr, vedi Algoritmi/grafo_csr.py) carico quello, già proiettato e ridotto;
+    altrimenti leggo il GraphML e lo proietto, poi salvo lo snapshot per i caricamenti successivi (errore non bloccante).
+    In RAM resta solo la versione CSR: è quella che la regola 300 usa per Dijkstra e per l'aggancio dei punti, e ne espone il CRS
+    con lo stesso attributo graph dei grafi networkx.
+    @return: GrafoCSR della città, o None se non trovato o in errore
+    """
+    def _carica_grafo(self, city_name):
         #costruisco percorso relativo per file specifico graphml
         safe_name = city_name.replace(" ", "_").replace(",", "")
         file_path = os.path.join(GRAPHS_DIR, f"{safe_name}.graphml")
+        snapshot_path = percorso_snapshot(GRAPHS_DIR, city_name)
+        usa_snapshot = snapshot_aggiornato(snapshot_path, file_path)
 
-        if not os.path.exists(file_path):
+        if not usa_snapshot and not os.path.exists(file_path):
             print(f"Grafo non trovato: {file_path}")
             return None
 
         #carico da disco
         print(f"Caricamento grafo {city_name} da disco.")
         try:
-            G = ox.load_graphml(file_path)
-            
-            #proietto subito in metri per calcoli corretti
-            G_proj = ox.project_graph(G)
-            
-            #mi salvo che è stata caricata
-            self._loaded_graphs[city_name] = G_proj
+            if usa_snapshot:
+                #snapshot binario: versione CSR già proiettata, array mappati da disco
+                csr = GrafoCSR.carica(snapshot_path)
+            else:
+                G = ox.load_graphml(file_path)
+
+                #proietto subito in metri per calcoli corretti
+                G_proj = ox.project_graph(G)
+                csr = GrafoCSR.da_grafo(G_proj)
+                try:
+                    csr.salva(snapshot_path, sorgente=file_path)
+                except Exception as e:
+                    print(f"Impossibile salvare lo snapshot del grafo: {e}")
+
+            #preparo subito l'indice spaziale dei nodi (cKDTree sulle coordinate già in memoria), così la prima richiesta non ne paga il costo
+            csr.albero
             print(f"Grafo {city_name} caricato correttamente.")
-            
-            return G_proj
-            
+
+            return csr
+
         except Exception as e:
             print(f"Errore caricamento grafo: {e}")
             return None
 
+    """
+    Scarica le voci usate meno di recente finché la memoria stimata non rientra nel budget.
+    La voce usata più di recente resta sempre in cache. Da chiamare con _lock_cache acquisito.
+    """
+    def _rispetta_budget(self):
+        while len(self._loaded_graphs) > 1 and sum(self._memoria.values()) > self._budget_memoria:
+            chiave, _ = self._loaded_graphs.popitem(last=False)
+            liberati = self._memoria.pop(chiave, 0)
+            self._statistiche['evizioni'] += 1
+            print(f"Voce {chiave} scaricata dalla cache ({liberati / 1024 ** 2:.1f} MB).")
+
+    """
+    Contatori e occupazione della cache dei grafi.
+    @return: dizionario con hit, miss, caricamenti, secondi_caricamento, evizioni, byte stimati occupati, budget e voci in cache
+        (dalla meno recente)
+    """
+    def statistiche_cache(self):
+        with self._lock_cache:
+            statistiche = dict(self._statistiche)
+            statistiche['secondi_caricamento'] = round(statistiche['secondi_caricamento'], 3)
+            statistiche['memoria'] = sum(self._memoria.values())
+            statistiche['budget_memoria'] = self._budget_memoria
+            statistiche['voci'] = [str(chiave) for chiave in self._loaded_graphs]
+        return statistiche
+
+    """
+    Restituisce il campo precalcolato delle distanze dalle aree verdi della città, caricandolo da disco se non già in RAM.
+    Il campo è valido solo se calcolato sullo stesso grafo: altrimenti (o se manca) la regola 300 torna a Dijkstra per richiesta.
+    Se la città è divisa in tasselli, il confronto usa la firma dei nodi salvata nell'indice, senza caricare il grafo completo:
+    i nodi di ogni zona sono nodi del grafo completo, quindi il campo vale anche per le zone.
+    @param city_name: nome della città
+    Indice e grafo si risolvono prima di entrare nel caricamento del campo, così il caricamento di una voce non ne richiede un'altra.
+    @return: CampoVerde della città, o None se non disponibile
+    """
+    def get_campo_verde(self, city_name):
+        indice = self._indice_tasselli(city_name)
+        grafo = self.get_graph(city_name) if indice is None else None
+        return self._da_cache(('campo', city_name), lambda: self._carica_campo(city_name, indice, grafo), tieni_assente=True)
+
+    def _carica_campo(self, city_name, indice, grafo):
+        if indice is None and grafo is None:
+            return None
+
+        file_path = percorso_campo_verde(GRAPHS_DIR, city_name)
+        try:
+            campo = CampoVerde.carica(file_path)
+            if campo is None:
+                print(f"Campo aree verdi non trovato: {file_path}. Uso Dijkstra per richiesta.")
+            elif not (campo.compatibile(grafo) if indice is None else firma_nodi(campo.nodi) == indice['firma_nodi']):
+                print(f"Campo aree verdi di {city_name} non allineato al grafo: va rigenerato. Uso Dijkstra per richiesta.")
+                campo = None
+            else:
+                print(f"Campo aree verdi di {city_name} caricato correttamente.")
+        except Exception as e:
+            print(f"Errore caricamento campo aree verdi: {e}")
+            campo = None
+        return campo
+
+    """
+    Precarica grafi, indici dei nodi e campi delle aree verdi di tutte le città dei confini, così nessuna richiesta ne paga il caricamento.
+    Delle città divise in tasselli precarica solo l'indice e il campo: le zone dipendono dal poligono e si caricano alla richiesta.
+    Pensata per essere chiamata all'importazione del server: con gunicorn --preload viene eseguita una volta sola nel processo master
+    e i worker, creati con fork, ereditano le strutture già in RAM. Gli array degli snapshot sono mappati da disco in sola lettura
+    (pagine condivise dalla page cache), e quelli costruiti in memoria non vengono più scritti dopo il caricamento, quindi restano
+    condivisi copy-on-write tra i worker invece di essere duplicati.
+    Errori sulle singole città non sono bloccanti: la città viene segnata come mancante e ricaricata su richiesta come prima.
+    Le città restano soggette al budget della cache: se insieme lo superano, le prime caricate vengono scaricate (vedi get_graph).
+    @param in_background: se True il caricamento avviene in un thread separato (server senza --preload), e lo stato resta "non pronto" fino alla fine
+    @return: stato del precaricamento (vedi stato_precaricamento)
+    """
+    def precarica(self, in_background=False):
+        with self._lock_precaricamento:
+            if self._precaricamento is not None:
+                return dict(self._precaricamento)
+            citta = [] if self._cities_boundaries.empty else list(self._cities_boundaries['city_name'])
+            self._precaricamento = {'pronto': False, 'citta': citta, 'caricate': [], 'mancanti': [], 'secondi': None}
+
+        if in_background:
+            threading.Thread(target=self._esegui_precaricamento, args=(citta,), name="precarica_grafi", daemon=True).start()
+        else:
+            self._esegui_precaricamento(citta)
+        return self.stato_precaricamento()
+
+    def _esegui_precaricamento(self, citta):
+        inizio = time.perf_counter()
+        for city_name in citta:
+            try:
+                #città divisa in tasselli: le zone si caricano per richiesta, precarico solo l'indice e il campo
+                if self._indice_tasselli(city_name) is not None:
+                    caricata = True
+                else:
+                    caricata = self.get_graph(city_name) is not None
+                if caricata:
+                    self.get_campo_verde(city_name)
+            except Exception as e:
+                print(f"Errore precaricamento {city_name}: {e}")
+                caricata = False
+            with self._lock_precaricamento:
+                self._precaricamento['caricate' if caricata else 'mancanti'].append(city_name)
+
+        with self._lock_precaricamento:
+            self._precaricamento['secondi'] = round(time.perf_counter() - inizio, 3)
+            self._precaricamento['pronto'] = True
+        print(f"Precaricamento completato in {self._precaricamento['secondi']} s: {len(self._precaricamento['caricate'])} grafi su {len(citta)}.")
+
+    """
+    Stato del precaricamento, per l'endpoint di readiness del server.
+    @return: dizionario con pronto, citta, caricate, mancanti e secondi; se il precaricamento non è stato richiesto
+        il server è comunque pronto (i grafi si caricano alla prima richiesta), e precaricamento vale False
+    """
+    def stato_precaricamento(self):
+        with self._lock_precaricamento:
+            if self._precaricamento is None:
+                return {'pronto': True, 'precaricamento': False}
+            stato = {chiave: (list(valore) if isinstance(valore, list) else valore) for chiave, valore in self._precaricamento.items()}
+        stato['precaricamento'] = True
+        return stato
+
 #istanza globale
 graphs_manager = graphsManager()
\ No newline at end of file
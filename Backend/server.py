@@ -20,7 +20,14 @@ from osm2geojson import json2geojson
 import geopandas as gpd
 import pandas as pd
 from Algoritmi.analizzatore_centrale import run_full_analysis
+from Algoritmi.regola30 import calcola_griglia_copertura, controlla_griglia_copertura, FORMATO_ARRAY
+from Algoritmi.regola300 import consolida_aree_verdi
+from Algoritmi.regola3 import TracciaLineeVista
 import logging
+import os
+import gc
+import uuid
+from datetime import datetime
 from shapely.geometry import Polygon
 from graphsManager import graphs_manager
 
@@ -45,10 +52,51 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# precaricamento dei grafi all'avvio, scelto con la variabile d'ambiente PRECARICA_GRAFI:
+#   - "1": sincrono all'importazione del modulo; con gunicorn --preload avviene una volta sola nel master e i worker
+#     condividono copy-on-write grafi e campi già caricati (vedi graphsManager.precarica);
+#   - "background": in un thread separato, per server senza --preload (es. sviluppo), /api/ready risponde 503 finché non finisce;
+#   - "0" o assente: nessun precaricamento, ogni grafo si carica alla prima richiesta sulla sua città.
+PRECARICA_GRAFI = os.environ.get("PRECARICA_GRAFI", "0").strip().lower()
+if PRECARICA_GRAFI == "background":
+    graphs_manager.precarica(in_background=True)
+elif PRECARICA_GRAFI not in ("", "0"):
+    graphs_manager.precarica()
+    #sposto gli oggetti caricati fuori dalle generazioni del garbage collector: le sue scansioni nei worker toccherebbero
+    #i contatori di riferimento e copierebbero le pagine condivise
+    gc.freeze()
+
+# tracciamento delle linee di vista della regola 3 sulle richieste reali, per diagnosticare edifici lenti o con risultati sbagliati
+# (vedi regola3.TracciaLineeVista), scelto con la variabile d'ambiente TRACCIA_REGOLA3:
+#   - "0" o assente: nessun tracciamento, e le richieste non possono attivarlo;
+#   - "1": ogni richiesta traccia una frazione TRACCIA_REGOLA3_CAMPIONAMENTO (default 0.01) delle coppie edificio-albero; una richiesta
+#     con il campo 'traccia_edifici' (lista di id OSM) traccia invece tutte le coppie di quegli edifici.
+#   Le linee di ogni richiesta finiscono in un file della cartella TRACCIA_REGOLA3_CARTELLA (GeoJSON, o GeoParquet con
+#   TRACCIA_REGOLA3_FORMATO=parquet), il cui nome è riportato nella risposta ('traccia_regola3'). Il tracciamento forza la regola 3 in serie.
+TRACCIA_REGOLA3 = os.environ.get("TRACCIA_REGOLA3", "0").strip().lower() not in ("", "0")
+TRACCIA_REGOLA3_CAMPIONAMENTO = float(os.environ.get("TRACCIA_REGOLA3_CAMPIONAMENTO", 0.01))
+TRACCIA_REGOLA3_CARTELLA = os.environ.get("TRACCIA_REGOLA3_CARTELLA", "./Data/Tracce_regola3")
+TRACCIA_REGOLA3_FORMATO = "parquet" if os.environ.get("TRACCIA_REGOLA3_FORMATO", "").strip().lower() == "parquet" else "geojson"
+
 ##############################################################################
 ############################Funzioni di supporto##############################
 ##############################################################################
 
+"""
+Traccia della regola 3 per la richiesta, se il tracciamento è abilitato (TRACCIA_REGOLA3), con il file in cui salvarla.
+@return: (TracciaLineeVista, percorso del file), oppure (None, None)
+"""
+def crea_traccia_regola3(dati_ricevuti):
+    if not TRACCIA_REGOLA3:
+        return None, None
+    edifici_traccia = dati_ricevuti.get('traccia_edifici')
+    if edifici_traccia:
+        traccia = TracciaLineeVista(edifici=edifici_traccia)
+    else:
+        traccia = TracciaLineeVista(campionamento=TRACCIA_REGOLA3_CAMPIONAMENTO)
+    nome_file = f"regola3_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}.{TRACCIA_REGOLA3_FORMATO}"
+    return traccia, os.path.join(TRACCIA_REGOLA3_CARTELLA, nome_file)
+
 # funzione per costruire la query a Overpass API in base al tipo di dato richiesto
 """
 la libreria python OSMnx è molto utile per lavorare con dati OSM, in particolare per un'analisi e visualizzazione avanzata,
@@ -234,11 +282,18 @@ def unpack_gdf_features(geojson_data, crs="EPSG:4326"):
 ############################MAIN###############################
 ###############################################################
 
+# Endpoint di readiness: 200 quando il precaricamento dei grafi è completo (o non richiesto), 503 mentre è in corso.
+# Riporta anche i contatori della cache dei grafi del worker che risponde (hit, miss, tempi di caricamento, evizioni, memoria)
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    stato = graphs_manager.stato_precaricamento()
+    stato['cache_grafi'] = graphs_manager.statistiche_cache()
+    return jsonify(stato), 200 if stato['pronto'] else 503
+
 # Endpoint per l'API
 @app.route('/api/greenRatingAlgorithm', methods=['POST'])
 
 # TODO: forse ha senso esporre le sotto funzioni per il calcolo di solo alcune regole?
-# TODO: manca la heatMap: da aggiungere qui o nel client?
 # TODO: aggiungere autenticazione API key per sicurezza?
 # TODO: aggiungere limitazioni di rate limiting per evitare abusi?
 # TODO: aggiungere sistema crs dinamico per rendere l'applicazione globale (il sistema metrico è lo stesso per tutti?)
@@ -248,6 +303,19 @@ def greenRatingAlgorithm():
         #ricezione dei dati da client
         dati_ricevuti = request.get_json()
         polygon = dati_ricevuti.get('polygon')
+
+        #modalità "solo conformità": conteggi della regola 3 troncati a 3 e niente percorsi/id per la regola 300 (mappe su larga scala)
+        solo_conformita = bool(dati_ricevuti.get('solo_conformita', False))
+
+        #griglia di copertura arborea per la heatmap (opzionale): lato delle celle in metri e formato (array compatto o GeoJSON)
+        lato_griglia = dati_ricevuti.get('griglia_copertura')
+        formato_griglia = dati_ricevuti.get('formato_griglia', FORMATO_ARRAY)
+
+        #percorsi pedonali solo per alcuni edifici (lista di id OSM), ad esempio quelli selezionati sulla mappa; di default tutti
+        edifici_percorso = dati_ricevuti.get('percorsi_edifici')
+
+        #tracciamento delle linee di vista della regola 3 (solo se abilitato lato server, vedi TRACCIA_REGOLA3)
+        traccia, file_traccia = crea_traccia_regola3(dati_ricevuti)
         
         #query per Overpass API
         if(polygon):
@@ -278,6 +346,14 @@ def greenRatingAlgorithm():
                 app.logger.error(f"Errore creazione GDF poligono di input: {e}")
                 return jsonify({'errore': 'Poligono di input non valido.'}), 400
 
+            #parametri della griglia di copertura controllati subito, prima delle query: valori fuori dai limiti sono un errore del client
+            if lato_griglia:
+                try:
+                    lato_griglia = float(lato_griglia)
+                    controlla_griglia_copertura(polygon_gdf, lato_griglia, formato_griglia)
+                except (TypeError, ValueError) as e:
+                    return jsonify({'errore': f'Griglia di copertura non valida: {e}'}), 400
+
             #aumento il poligono in base alla regola
             buffered_polygon_300 = increasePolygon(polygon_gdf, 300)
             buffered_polygon_3 = increasePolygon(polygon_gdf, 3)
@@ -293,7 +369,9 @@ def greenRatingAlgorithm():
             #lascio None come default se non trovato; runFullAnalysis gestisce il None per usare OSM puro
             #graphsManager è un singleton, quindi lo creo una volta sola durante l'importazione e lo riuso (l'instanza è graphs_manager)
             city_name = graphs_manager.get_city_from_polygon(input_polygon_shapely)
-            grafo = graphs_manager.get_graph(city_name) if city_name else None
+            #se la città è divisa in tasselli, carico solo la zona attorno al poligono (vedi Algoritmi/tasselli.py)
+            grafo = graphs_manager.get_graph(city_name, poligono=input_polygon_shapely) if city_name else None
+            campo_verde = graphs_manager.get_campo_verde(city_name) if grafo is not None else None
 
             #chiamo la funzione getTrees, che sulla base della città carica gli alberi YOLO, altrimenti esegue la query Overpass
             alberi = getTrees(city_name, buffered_polygon_3)
@@ -344,23 +422,40 @@ def greenRatingAlgorithm():
                 aree_verdi = aree_verdi.rename(columns={'@id': 'id'})
 
             """
-            Proiettiamo le aree verdi nel sistema metrico e scartiamo quelle troppo piccole ai fini del calcolo.
+            Consolidiamo le aree verdi e scartiamo quelle troppo piccole ai fini del calcolo.
             Inizialmente questa operazione era fatta all'interno della regola 300, ma spostandola qui evitiamo di passare dati inutili alla regola,
             riducendo il carico computazionale.
             Inoltre, eseguendo qui questa parte, evitiamo di mandare al frontend aree verdi che non sono state usate dal calcolo.
-            Attenzione: questa parte normalmente genererebbe un warning da parte di Pandas senza la copia esplicita (.copy()),
-            in quanto si sta tentando di modificare un DataFrame filtrato. L'uso di .copy() previene questo warning creando una copia indipendente.
+            Parchi, giardini e prati che si toccano o si sovrappongono vengono fusi in un unico cluster (con la lista degli id OSM dei membri),
+            e la soglia minima viene applicata al cluster: regola 300 e grafo pedonale lavorano su meno geometrie, più semplici.
             """
             if not aree_verdi.empty:
-                aree_verdi_metriche = aree_verdi.to_crs("EPSG:32632")
-                mask_grandi = aree_verdi_metriche.geometry.area >= SOGLIA_MINIMA
-                aree_verdi = aree_verdi[mask_grandi].copy()
+                aree_verdi = consolida_aree_verdi(aree_verdi, soglia=SOGLIA_MINIMA)
 
         except Exception as e:
             return jsonify({'errore': f'Errore nella pulizia dei dati: {e}'}), 500
 
         # esecuzione degli algoritmi
-        result, errori = run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo)
+        result, errori = run_full_analysis(edifici, alberi, aree_verdi, polygon_gdf, city_name, grafo, solo_conformita=solo_conformita,
+                                           edifici_percorso=edifici_percorso, campo_verde=campo_verde, traccia=traccia)
+
+        # salvataggio della traccia della regola 3 (errore non bloccante)
+        traccia_salvata = None
+        if traccia is not None:
+            try:
+                os.makedirs(TRACCIA_REGOLA3_CARTELLA, exist_ok=True)
+                traccia.salva(file_traccia)
+                traccia_salvata = os.path.basename(file_traccia)
+            except Exception as e:
+                app.logger.warning(f"Impossibile salvare la traccia della regola 3: {e}")
+
+        # griglia di copertura della regola 30 per la heatmap del frontend (errore non bloccante)
+        griglia_copertura = None
+        if lato_griglia and not alberi.empty:
+            try:
+                griglia_copertura = calcola_griglia_copertura(alberi, polygon_gdf, lato_griglia, formato_griglia)
+            except Exception as e:
+                app.logger.warning(f"Impossibile calcolare la griglia di copertura: {e}")
 
         # definiamo un GeoJSON vuoto standard da usare come fallback
         empty_geojson_fallback = '{"type": "FeatureCollection", "features": []}'
@@ -390,9 +485,12 @@ def greenRatingAlgorithm():
         risultato = {
             'EsecuzionePositiva': flag,
             'messaggio': messaggio,
+            'solo_conformita': solo_conformita,
             'alberi': alberi_geojson,
             'aree_verdi': aree_verdi_geojson,
-            'risultati': risultati_geojson
+            'risultati': risultati_geojson,
+            'griglia_copertura': griglia_copertura,
+            'traccia_regola3': traccia_salvata
         }
 
         return jsonify(risultato), 200
@@ -0,0 +1,359 @@
+"""
+    Benchmark offline degli algoritmi 3-30-300.
+        Genera quartieri sintetici di dimensione configurabile (griglia di isolati con edifici, filari di alberi lungo le strade,
+        parchi e un bosco) insieme a un grafo stradale sintetico, e misura separatamente run_rule_3, run_rule_30, run_rule_300
+        e run_full_analysis. Oltre ai quartieri sintetici usa gli alberi reali di alberiOSMverona.geojson, su una finestra
+        di edifici e strade sintetici, e un quartiere con alberi fitti (filari ogni PASSO_FILARE_DENSO metri).
+        La regola 3 viene misurata anche con il metodo isovista (regola_3_isovista); per ogni scenario il confronto_isovista
+        riporta la frazione delle coppie edificio-albero visibili col metodo delle linee che l'isovista ritrova (richiamo)
+        e quelle che trova in più, così l'approssimazione viene seguita tra versioni come i tempi.
+        Per ogni funzione salva tempo (wall time, migliore e mediana su più ripetizioni) e picco di memoria (tracemalloc),
+        e scrive tutto in un file JSON, da confrontare tra versioni diverse del codice per individuare le regressioni.
+
+        NOTE:
+            1- la memoria viene misurata in un'esecuzione a parte, perché tracemalloc rallenta molto il codice e falserebbe i tempi;
+            2- run_full_analysis usa la cache di visibilità della regola 3: per misurare sempre il caso "a freddo" ogni esecuzione
+                riceve una cache nuova in una cartella temporanea;
+            3- non serve la rete: grafo, edifici e aree verdi sono generati in memoria.
+
+        Esempio: python benchmark_regole.py --isolati 5 10 20 --ripetizioni 3 --output benchmark.json
+"""
+
+#importazioni
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import platform
+import logging
+import tempfile
+import subprocess
+import statistics
+import tracemalloc
+import contextlib
+from datetime import datetime
+
+import numpy as np
+import geopandas as gpd
+import networkx as nx
+from shapely.geometry import box, Point, LineString
+from shapely import affinity
+
+#rendo importabile il pacchetto Algoritmi del backend
+CARTELLA_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+CARTELLA_BACKEND = os.path.join(CARTELLA_SCRIPT, "..", "Backend")
+sys.path.insert(0, CARTELLA_BACKEND)
+
+from Algoritmi import analizzatore_centrale
+from Algoritmi.regola3 import run_rule_3, METODO_ISOVISTA
+from Algoritmi.regola30 import run_rule_30
+from Algoritmi.regola300 import run_rule_300
+from Algoritmi.cache_visibilita import CacheVisibilita
+
+#fixture reale degli alberi di Verona
+FILE_ALBERI_VERONA = os.path.join(CARTELLA_SCRIPT, "alberiOSMverona.geojson")
+
+#origine dei quartieri sintetici (Verona, in EPSG:32632) e geometria della griglia in metri
+ORIGINE = (655000.0, 5034000.0)
+LATO_ISOLATO = 80
+LARGHEZZA_STRADA = 20
+EDIFICI_PER_LATO = 3
+PASSO_FILARE = 8
+PASSO_FILARE_DENSO = 2
+
+#un isolato ogni FREQUENZA_PARCHI viene sostituito da un parco
+FREQUENZA_PARCHI = 7
+
+#soglia minima delle aree verdi, come nel server (1 ettaro); i parchi sintetici si estendono oltre le strade dell'isolato per superarla
+SOGLIA_MINIMA = 10000
+
+"""
+    Genera un quartiere sintetico di isolati x isolati.
+    Ogni isolato contiene una griglia di edifici (alcuni ruotati), le strade hanno filari di alberi
+    puntiformi e qualche filare lineare (tree_row); un isolato ogni FREQUENZA_PARCHI è un parco alberato, e un angolo del quartiere
+    è coperto da un bosco (landuse=forest) che entra nel calcolo della regola 30.
+    @return: (edifici, alberi, aree_verdi, polygon_gdf, grafo), i GDF in EPSG:4326 come quelli prodotti dal server,
+        il grafo proiettato in EPSG:32632 come quello restituito da graphs_manager.
+"""
+def genera_quartiere(isolati, seme=0, passo_filare=PASSO_FILARE):
+    generatore = np.random.default_rng(seme)
+    x0, y0 = ORIGINE
+    passo = LATO_ISOLATO + LARGHEZZA_STRADA
+
+    edifici, alberi, natural, aree_verdi = [], [], [], []
+    for i in range(isolati):
+        for j in range(isolati):
+            bx = x0 + i * passo + LARGHEZZA_STRADA / 2
+            by = y0 + j * passo + LARGHEZZA_STRADA / 2
+
+            #parco alberato al posto dell'isolato
+            if (i * isolati + j) % FREQUENZA_PARCHI == 3:
+                aree_verdi.append(box(bx, by, bx + LATO_ISOLATO, by + LATO_ISOLATO).buffer(LARGHEZZA_STRADA / 2 + 30, join_style=2))
+                for _ in range(40):
+                    alberi.append(Point(bx + generatore.uniform(0, LATO_ISOLATO), by + generatore.uniform(0, LATO_ISOLATO)))
+                    natural.append('tree')
+                continue
+
+            #griglia di edifici dell'isolato
+            lato_lotto = LATO_ISOLATO / EDIFICI_PER_LATO
+            for a in range(EDIFICI_PER_LATO):
+                for b in range(EDIFICI_PER_LATO):
+                    lx, ly = bx + a * lato_lotto + 3, by + b * lato_lotto + 3
+                    larghezza, profondita = generatore.uniform(10, lato_lotto - 6, size=2)
+                    edificio = box(lx, ly, lx + larghezza, ly + profondita)
+                    if generatore.random() < 0.2:
+                        edificio = affinity.rotate(edificio, generatore.uniform(0, 90))
+                    edifici.append(edificio)
+
+            #filari di alberi lungo i due lati stradali dell'isolato (sud e ovest)
+            for d in np.arange(passo_filare / 2, LATO_ISOLATO, passo_filare):
+                if generatore.random() < 0.7:
+                    alberi.append(Point(bx + d, by - 4 + generatore.normal(0, 0.5)))
+                    natural.append('tree')
+                if generatore.random() < 0.7:
+                    alberi.append(Point(bx - 4 + generatore.normal(0, 0.5), by + d))
+                    natural.append('tree')
+
+            #qualche filare mappato come linea
+            if generatore.random() < 0.1:
+                alberi.append(LineString([(bx, by + LATO_ISOLATO + 4), (bx + LATO_ISOLATO, by + LATO_ISOLATO + 4)]))
+                natural.append('tree_row')
+
+    #bosco nell'angolo del quartiere
+    lato_bosco = max(passo, isolati * passo / 4)
+    alberi.append(box(x0 - lato_bosco / 2, y0 - lato_bosco / 2, x0 + lato_bosco / 2, y0 + lato_bosco / 2))
+    natural.append(None)
+    aree_verdi.append(alberi[-1])
+
+    gdf_edifici = gpd.GeoDataFrame({
+        'id': [f"way/{n}" for n in range(len(edifici))],
+        'building': 'yes',
+    }, geometry=edifici, crs="EPSG:32632")
+
+    gdf_alberi = gpd.GeoDataFrame({
+        'id': [f"node/{n}" for n in range(len(alberi))],
+        'natural': natural,
+        'landuse': [None] * (len(alberi) - 1) + ['forest'],
+    }, geometry=alberi, crs="EPSG:32632")
+
+    gdf_aree_verdi = gpd.GeoDataFrame({
+        'id': [f"way/{1_000_000 + n}" for n in range(len(aree_verdi))],
+        'leisure': ['park'] * (len(aree_verdi) - 1) + [None],
+    }, geometry=aree_verdi, crs="EPSG:32632")
+    gdf_aree_verdi = gdf_aree_verdi[gdf_aree_verdi.geometry.area >= SOGLIA_MINIMA]
+
+    lato = isolati * passo
+    poligono = gpd.GeoDataFrame(geometry=[box(x0, y0, x0 + lato, y0 + lato)], crs="EPSG:32632")
+    grafo = genera_grafo(x0 - 400, y0 - 400, lato + 800, passo)
+
+    return (gdf_edifici.to_crs("EPSG:4326"), gdf_alberi.to_crs("EPSG:4326"),
+            gdf_aree_verdi.to_crs("EPSG:4326"), poligono.to_crs("EPSG:4326"), grafo)
+
+"""
+    Grafo stradale sintetico a griglia, con la stessa struttura dei grafi osmnx proiettati (MultiDiGraph con attributi x/y
+    sui nodi, 'length' sugli archi in entrambe le direzioni e crs nel dizionario del grafo).
+    Le strade sono in mezzo alle fasce stradali tra gli isolati, con un nodo ogni passo/4 metri (come dopo la densificazione).
+"""
+def genera_grafo(x_min, y_min, lato, passo):
+    grafo = nx.MultiDiGraph(crs="EPSG:32632")
+    passo_nodi = passo / 4
+    n = int(lato // passo_nodi) + 1
+    for i in range(n):
+        for j in range(n):
+            grafo.add_node(i * n + j, x=x_min + i * passo_nodi, y=y_min + j * passo_nodi)
+
+    #le strade corrono lungo le righe e colonne di nodi multiple di 4 (una ogni isolato)
+    for i in range(n):
+        for j in range(n):
+            nodo = i * n + j
+            if j % 4 == 0 and i + 1 < n:
+                grafo.add_edge(nodo, nodo + n, length=passo_nodi)
+                grafo.add_edge(nodo + n, nodo, length=passo_nodi)
+            if i % 4 == 0 and j + 1 < n:
+                grafo.add_edge(nodo, nodo + 1, length=passo_nodi)
+                grafo.add_edge(nodo + 1, nodo, length=passo_nodi)
+
+    grafo.remove_nodes_from([nodo for nodo, grado in list(grafo.degree()) if grado == 0])
+    return grafo
+
+"""
+    Scenario con gli alberi reali di alberiOSMverona.geojson: finestra di lato_metri attorno alla mediana degli alberi,
+    con gli edifici, le aree verdi e il grafo di un quartiere sintetico che copre la stessa finestra.
+    @return: stessa struttura di genera_quartiere, oppure None se il file non esiste.
+"""
+def carica_verona(lato_metri=1000, seme=0):
+    if not os.path.exists(FILE_ALBERI_VERONA):
+        return None
+
+    #come nel server, l'id OSM è '@id'
+    alberi = gpd.read_file(FILE_ALBERI_VERONA)
+    if '@id' in alberi.columns:
+        alberi = alberi.drop(columns=['id'], errors='ignore').rename(columns={'@id': 'id'})
+    alberi_proj = alberi.to_crs("EPSG:32632")
+
+    #centro la finestra sulla mediana dei punti, dove gli alberi sono più densi
+    punti = alberi_proj.geometry.representative_point()
+    cx, cy = np.median(punti.x), np.median(punti.y)
+
+    #il quartiere sintetico viene traslato sulla finestra; gli alberi vengono presi in un intorno di 45 metri come fa il server
+    isolati = max(1, int(lato_metri // (LATO_ISOLATO + LARGHEZZA_STRADA)))
+    edifici, _, aree_verdi, poligono, _ = genera_quartiere(isolati, seme)
+    dx = cx - lato_metri / 2 - ORIGINE[0]
+    dy = cy - lato_metri / 2 - ORIGINE[1]
+    edifici = edifici.to_crs("EPSG:32632")
+    edifici['geometry'] = edifici.geometry.translate(dx, dy)
+    aree_verdi = aree_verdi.to_crs("EPSG:32632")
+    aree_verdi['geometry'] = aree_verdi.geometry.translate(dx, dy)
+    poligono = poligono.to_crs("EPSG:32632")
+    poligono['geometry'] = poligono.geometry.translate(dx, dy)
+
+    finestra = poligono.geometry.iloc[0].buffer(45)
+    alberi_proj = alberi_proj[alberi_proj.intersects(finestra)]
+    grafo = genera_grafo(cx - lato_metri / 2 - 400, cy - lato_metri / 2 - 400, isolati * (LATO_ISOLATO + LARGHEZZA_STRADA) + 800,
+                         LATO_ISOLATO + LARGHEZZA_STRADA)
+
+    return (edifici.to_crs("EPSG:4326"), alberi_proj.to_crs("EPSG:4326"),
+            aree_verdi.to_crs("EPSG:4326"), poligono.to_crs("EPSG:4326"), grafo)
+
+"""
+    Esegue funzione(*argomenti) ripetizioni volte misurando il wall time, più una volta sotto tracemalloc per il picco di memoria.
+    Gli argomenti vengono ricreati a ogni esecuzione (prepara), perché le regole possono modificare i GDF in ingresso.
+    Le stampe delle regole vengono soppresse per non sporcare l'output.
+    @return: dizionario con i tempi, il migliore, la mediana e il picco di memoria in MB.
+"""
+def misura(funzione, prepara, ripetizioni):
+    tempi = []
+    for _ in range(ripetizioni):
+        argomenti = prepara()
+        with contextlib.redirect_stdout(io.StringIO()):
+            inizio = time.perf_counter()
+            funzione(*argomenti)
+            tempi.append(time.perf_counter() - inizio)
+
+    argomenti = prepara()
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            funzione(*argomenti)
+        _, picco = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'tempi_s': [round(t, 4) for t in tempi],
+        'migliore_s': round(min(tempi), 4),
+        'mediana_s': round(statistics.median(tempi), 4),
+        'picco_memoria_mb': round(picco / (1024 * 1024), 2),
+    }
+
+"""
+    Confronta gli alberi visibili della regola 3 con il metodo isovista e con quello delle linee (riferimento).
+    @return: dizionario con le coppie edificio-albero visibili dei due metodi, quelle delle linee ritrovate dall'isovista,
+        il richiamo (ritrovate / coppie delle linee) e le coppie trovate solo dall'isovista.
+"""
+def confronta_isovista(edifici, alberi):
+    coppie = lambda risultato: {(edificio, albero) for edificio, alberi_visibili in zip(risultato.index, risultato['visible_trees_id'])
+                                for albero in alberi_visibili}
+    with contextlib.redirect_stdout(io.StringIO()):
+        linee = coppie(run_rule_3(edifici.copy(), alberi.copy()))
+        isovista = coppie(run_rule_3(edifici.copy(), alberi.copy(), metodo=METODO_ISOVISTA))
+    ritrovate = len(linee & isovista)
+    return {
+        'coppie_linee': len(linee),
+        'coppie_isovista': len(isovista),
+        'ritrovate': ritrovate,
+        'richiamo': round(ritrovate / len(linee), 4) if linee else None,
+        'solo_isovista': len(isovista - linee),
+    }
+
+"""
+    Misura le quattro funzioni su uno scenario (edifici, alberi, aree_verdi, poligono, grafo), più la regola 3 col metodo isovista.
+"""
+def esegui_scenario(nome, parametri, dati, ripetizioni):
+    edifici, alberi, aree_verdi, poligono, grafo = dati
+    copie = lambda *gdf: tuple(g.copy() for g in gdf)
+
+    #cache di visibilità nuova a ogni esecuzione dell'analisi completa (vedi NOTE 2)
+    cartella_cache = tempfile.mkdtemp(prefix="benchmark_cache_")
+    def prepara_completa():
+        analizzatore_centrale.cache_visibilita = CacheVisibilita(os.path.join(cartella_cache, f"{time.time_ns()}.sqlite"))
+        return copie(edifici, alberi, aree_verdi, poligono) + ("Sintetica", grafo)
+
+    print(f"Scenario {nome}: {len(edifici)} edifici, {len(alberi)} alberi, {len(aree_verdi)} aree verdi, {grafo.number_of_nodes()} nodi.")
+    risultati = {
+        'regola_3': misura(run_rule_3, lambda: copie(edifici, alberi), ripetizioni),
+        'regola_3_isovista': misura(lambda e, a: run_rule_3(e, a, metodo=METODO_ISOVISTA), lambda: copie(edifici, alberi), ripetizioni),
+        'regola_30': misura(run_rule_30, lambda: copie(edifici, alberi, poligono), ripetizioni),
+        'regola_300': misura(run_rule_300, lambda: copie(edifici, aree_verdi) + ("Sintetica", grafo), ripetizioni),
+        'analisi_completa': misura(analizzatore_centrale.run_full_analysis, prepara_completa, ripetizioni),
+    }
+    for regola, misure in risultati.items():
+        print(f"    {regola}: {misure['mediana_s']:.3f} s (mediana), picco {misure['picco_memoria_mb']:.1f} MB")
+    confronto = confronta_isovista(edifici, alberi)
+    print(f"    isovista: {confronto['ritrovate']}/{confronto['coppie_linee']} coppie delle linee ritrovate, {confronto['solo_isovista']} in più")
+
+    return {
+        'nome': nome,
+        'parametri': parametri,
+        'edifici': len(edifici),
+        'alberi': len(alberi),
+        'aree_verdi': len(aree_verdi),
+        'nodi_grafo': grafo.number_of_nodes(),
+        'risultati': risultati,
+        'confronto_isovista': confronto,
+    }
+
+"""
+    Versione del codice misurata (commit git corrente), per confrontare i risultati tra versioni.
+"""
+def versione_codice():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=CARTELLA_SCRIPT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+#main del benchmark
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline delle regole 3-30-300 su quartieri sintetici.")
+    parser.add_argument("--isolati", type=int, nargs="+", default=[5, 10, 20], help="lato in isolati dei quartieri sintetici")
+    parser.add_argument("--ripetizioni", type=int, default=3, help="esecuzioni cronometrate per funzione")
+    parser.add_argument("--seme", type=int, default=0, help="seme del generatore dei quartieri")
+    parser.add_argument("--isolati-denso", type=int, default=10, help="lato in isolati del quartiere ad alberi fitti (0 = salta)")
+    parser.add_argument("--lato-verona", type=int, default=1000, help="lato in metri della finestra sugli alberi di Verona (0 = salta)")
+    parser.add_argument("--output", default="risultati_benchmark.json", help="file JSON dei risultati")
+    args = parser.parse_args()
+
+    #le regole impostano il livello INFO con basicConfig: lo fisso prima a WARNING per avere un output leggibile
+    logging.basicConfig(level=logging.WARNING)
+
+    scenari = []
+    for isolati in args.isolati:
+        dati = genera_quartiere(isolati, args.seme)
+        scenari.append(esegui_scenario(f"sintetico_{isolati}x{isolati}", {'isolati': isolati, 'seme': args.seme}, dati, args.ripetizioni))
+
+    if args.isolati_denso > 0:
+        dati = genera_quartiere(args.isolati_denso, args.seme, passo_filare=PASSO_FILARE_DENSO)
+        scenari.append(esegui_scenario(f"denso_{args.isolati_denso}x{args.isolati_denso}",
+                                       {'isolati': args.isolati_denso, 'seme': args.seme, 'passo_filare': PASSO_FILARE_DENSO}, dati, args.ripetizioni))
+
+    if args.lato_verona > 0:
+        dati = carica_verona(args.lato_verona, args.seme)
+        if dati is None:
+            print(f"File {FILE_ALBERI_VERONA} non trovato, salto lo scenario di Verona.")
+        else:
+            scenari.append(esegui_scenario("verona_osm", {'lato_metri': args.lato_verona, 'seme': args.seme}, dati, args.ripetizioni))
+
+    risultato = {
+        'versione': versione_codice(),
+        'data': datetime.now().isoformat(timespec="seconds"),
+        'python': platform.python_version(),
+        'piattaforma': platform.platform(),
+        'ripetizioni': args.ripetizioni,
+        'scenari': scenari,
+    }
+    with open(args.output, "w") as file:
+        json.dump(risultato, file, indent=2)
+    print(f"Risultati salvati in {args.output}")
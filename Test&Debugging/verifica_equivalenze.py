@@ -0,0 +1,177 @@
+"""
+    Verifica offline che le versioni ottimizzate degli algoritmi diano gli stessi risultati delle versioni di riferimento.
+        Sul quartiere sintetico di benchmark_regole.genera_quartiere controlla che:
+            1- la regola 3 vettoriale (run_rule_3) trovi gli stessi alberi visibili del doppio ciclo edifici/alberi con is_unobstructed;
+            2- la regola 3 a tile su più processi dia lo stesso risultato dell'esecuzione seriale;
+            3- Dijkstra sulla versione CSR del grafo dia le stesse distanze di nx.multi_source_dijkstra;
+            4- il campo precalcolato delle distanze dalle aree verdi dia le stesse distanze e gli stessi percorsi di Dijkstra per richiesta,
+                sia con tutte le aree verdi sia con solo una parte (ricaduta su Dijkstra);
+            5- la zona di grafo caricata dai tasselli dia le stesse distanze e gli stessi percorsi del grafo completo.
+        Ogni controllo fallito interrompe lo script con un AssertionError. Non serve la rete, e i file (snapshot, tasselli, campo)
+        vengono scritti in una cartella temporanea.
+
+        Esempio: python verifica_equivalenze.py --isolati 6
+"""
+
+#importazioni
+import os
+import io
+import json
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+import networkx as nx
+import geopandas as gpd
+from shapely.geometry import box, shape
+
+from benchmark_regole import genera_quartiere, ORIGINE, LATO_ISOLATO, LARGHEZZA_STRADA
+
+import graphsManager
+from Algoritmi.regola3 import run_rule_3, is_unobstructed, view_buffer
+from Algoritmi.regola300 import consolida_aree_verdi
+from Algoritmi.graphs_calculator import calculate_pedestrian_path, cutoff_dist
+from Algoritmi.grafo_csr import grafo_csr
+from Algoritmi.campo_verde import costruisci_campo_verde, percorso_campo_verde
+from Algoritmi.tasselli import salva_tasselli, percorso_tasselli
+
+"""
+Alberi visibili per edificio calcolati come faceva la regola 3 prima del motore vettoriale: per ogni edificio gli alberi entro
+view_buffer metri, e per ogni coppia is_unobstructed.
+@return: dizionario id edificio -> lista ordinata degli id degli alberi visibili
+"""
+def alberi_visibili_riferimento(edifici, alberi):
+    edifici_proj = edifici.to_crs("EPSG:32632")
+    alberi_proj = alberi.to_crs("EPSG:32632")
+    alberi_proj = alberi_proj[alberi_proj['natural'].fillna('').astype(str).str.lower().str.strip().isin(['tree', 'tree_row'])]
+    ostacoli_idx = edifici_proj.sindex
+
+    visibili = {}
+    for _, edificio in edifici_proj.iterrows():
+        buffer = edificio.geometry.buffer(view_buffer)
+        candidati = alberi_proj[alberi_proj.geometry.within(buffer)]
+        visibili[edificio['id']] = sorted(albero['id'] for _, albero in candidati.iterrows()
+                                         if is_unobstructed(albero, edificio, edifici_proj, ostacoli_idx))
+    return visibili
+
+"""
+Converte il risultato di run_rule_3 nello stesso formato di alberi_visibili_riferimento.
+"""
+def alberi_visibili(risultato):
+    return {id_edificio: sorted(ids) for id_edificio, ids in zip(risultato['id'], risultato['visible_trees_id'])}
+
+"""
+Confronta distanze e percorsi di due risultati di calculate_pedestrian_path.
+"""
+def stessi_percorsi(a, b):
+    return ((a['distanza_pedonale'].to_numpy() == b['distanza_pedonale'].to_numpy()).all() and
+            (a['percorso_pedonale'].fillna('') == b['percorso_pedonale'].fillna('')).all())
+
+"""
+Confronta due risultati di calculate_pedestrian_path a meno dei percorsi a pari lunghezza: il campo e Dijkstra per richiesta
+possono scegliere, tra più accessi alla stessa distanza, un percorso diverso (sul grafo a griglia succede spesso).
+Controlla distanze, presenza dei percorsi, loro lunghezza in metri ed estremo sull'edificio.
+"""
+def percorsi_equivalenti(a, b):
+    if not (a['distanza_pedonale'].to_numpy() == b['distanza_pedonale'].to_numpy()).all():
+        return False
+    for percorso_a, percorso_b in zip(a['percorso_pedonale'], b['percorso_pedonale']):
+        if (percorso_a is None) != (percorso_b is None):
+            return False
+        if percorso_a is None:
+            continue
+        linea_a = gpd.GeoSeries([shape(json.loads(percorso_a))], crs="EPSG:4326").to_crs("EPSG:32632").iloc[0]
+        linea_b = gpd.GeoSeries([shape(json.loads(percorso_b))], crs="EPSG:4326").to_crs("EPSG:32632").iloc[0]
+        if abs(linea_a.length - linea_b.length) > 1e-3 or linea_a.coords[-1] != linea_b.coords[-1]:
+            return False
+    return True
+
+"""
+Esegue calculate_pedestrian_path senza stampare i messaggi di avanzamento.
+@return: (risultato, testo stampato)
+"""
+def percorsi(*args, **kwargs):
+    uscita = io.StringIO()
+    with contextlib.redirect_stdout(uscita):
+        risultato = calculate_pedestrian_path(*args, **kwargs)
+    return risultato, uscita.getvalue()
+
+def verifica_regola3(edifici, alberi):
+    riferimento = alberi_visibili_riferimento(edifici, alberi)
+    seriale = alberi_visibili(run_rule_3(edifici.copy(), alberi.copy(), processi=1))
+    assert seriale == riferimento, "regola 3 vettoriale diversa da is_unobstructed"
+    print(f"Regola 3 vettoriale == is_unobstructed ({sum(map(len, riferimento.values()))} coppie visibili).")
+
+    #tile piccole per averne più di una anche su un quartiere piccolo
+    parallelo = alberi_visibili(run_rule_3(edifici.copy(), alberi.copy(), processi=2, dimensione_tile=150))
+    assert parallelo == seriale, "regola 3 a tile diversa dall'esecuzione seriale"
+    print("Regola 3 a tile su più processi == seriale.")
+
+def verifica_dijkstra(grafo):
+    csr = grafo_csr(grafo)
+    sorgenti = csr.nodi[::97].tolist()
+    distanze, _ = csr.dijkstra(csr.indici(sorgenti), limite=cutoff_dist)
+    attese = nx.multi_source_dijkstra_path_length(grafo, sorgenti, cutoff=cutoff_dist, weight='length')
+    raggiunti = np.flatnonzero(np.isfinite(distanze))
+    assert set(csr.nodi[raggiunti].tolist()) == set(attese), "nodi raggiunti diversi da networkx"
+    assert np.allclose(distanze[raggiunti], [attese[n] for n in csr.nodi[raggiunti].tolist()]), "distanze diverse da networkx"
+    print(f"Dijkstra CSR == nx.multi_source_dijkstra ({len(raggiunti)} nodi raggiunti).")
+
+def verifica_campo(edifici, grafo, aree_verdi, campo):
+    riferimento, _ = percorsi(edifici, aree_verdi, grafo)
+    con_campo, uscita = percorsi(edifici, aree_verdi, grafo, campo_verde=campo)
+    assert "Uso il campo" in uscita, "campo precalcolato non usato"
+    assert percorsi_equivalenti(riferimento, con_campo), "campo precalcolato diverso da Dijkstra per richiesta"
+
+    #con una parte delle aree verdi l'area più vicina può essere esterna alla richiesta: il risultato deve restare quello di Dijkstra
+    parte = aree_verdi.iloc[::2].reset_index(drop=True)
+    riferimento, _ = percorsi(edifici, parte, grafo)
+    con_campo, _ = percorsi(edifici, parte, grafo, campo_verde=campo)
+    assert percorsi_equivalenti(riferimento, con_campo), "campo precalcolato diverso da Dijkstra con una parte delle aree verdi"
+    print("Campo delle aree verdi == Dijkstra per richiesta (tutte le aree verdi e una parte).")
+
+def verifica_tasselli(edifici, grafo, aree_verdi, campo, cartella, isolati):
+    #tasselli piccoli, così le zone delle richieste ne uniscono più di uno
+    csr = grafo_csr(grafo)
+    csr.salva(os.path.join(cartella, "Test_csr"))
+    n_tasselli = salva_tasselli(csr, percorso_tasselli(cartella, "Test"), lato=300, sovrapposizione=100)
+    campo.salva(percorso_campo_verde(cartella, "Test"))
+    graphsManager.GRAPHS_DIR = cartella
+    manager = graphsManager.graphs_manager
+
+    edifici_proj = edifici.to_crs("EPSG:32632")
+    x0, y0 = ORIGINE
+    lato = isolati * (LATO_ISOLATO + LARGHEZZA_STRADA)
+    for finestra in [box(x0, y0, x0 + lato / 3, y0 + lato / 3), box(x0 + lato / 3, y0, x0 + lato, y0 + lato / 2), box(x0, y0, x0 + lato, y0 + lato)]:
+        selezionati = edifici[edifici_proj.centroid.within(finestra).values]
+        poligono = gpd.GeoSeries([finestra], crs="EPSG:32632").to_crs("EPSG:4326").iloc[0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            zona = manager.get_graph("Test", poligono=poligono)
+            campo_zona = manager.get_campo_verde("Test")
+        assert campo_zona is not None, "campo non compatibile con i tasselli"
+        completo, _ = percorsi(selezionati, aree_verdi, csr)
+        ridotto, _ = percorsi(selezionati, aree_verdi, zona)
+        assert stessi_percorsi(completo, ridotto), "zona dei tasselli diversa dal grafo completo"
+        completo, _ = percorsi(selezionati, aree_verdi, csr, campo_verde=campo)
+        ridotto, _ = percorsi(selezionati, aree_verdi, zona, campo_verde=campo_zona)
+        assert stessi_percorsi(completo, ridotto), "zona dei tasselli con campo diversa dal grafo completo"
+    print(f"Zone dei tasselli == grafo completo ({n_tasselli} tasselli).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica le versioni ottimizzate delle regole 3 e 300 contro quelle di riferimento.")
+    parser.add_argument("--isolati", type=int, default=6, help="isolati per lato del quartiere sintetico")
+    parser.add_argument("--seme", type=int, default=0, help="seme del generatore casuale")
+    args = parser.parse_args()
+
+    edifici, alberi, aree_verdi, _, grafo = genera_quartiere(args.isolati, args.seme)
+    aree_verdi = consolida_aree_verdi(aree_verdi)
+    print(f"Quartiere sintetico: {len(edifici)} edifici, {len(alberi)} alberi, {len(aree_verdi)} aree verdi, {grafo.number_of_nodes()} nodi.")
+
+    verifica_regola3(edifici, alberi)
+    verifica_dijkstra(grafo)
+    campo = costruisci_campo_verde(grafo, aree_verdi)
+    verifica_campo(edifici, grafo, aree_verdi, campo)
+    with tempfile.TemporaryDirectory() as cartella:
+        verifica_tasselli(edifici, grafo, aree_verdi, campo, cartella, args.isolati)
+    print("Tutte le verifiche superate.")